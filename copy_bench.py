@@ -0,0 +1,104 @@
+#!/bin/env python
+### Copyright (C) 2011 Peter Williams <peter@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Compare the ways that the backup module can copy a file's data on the
+local file system: the time taken by each to copy a file of a given
+size (from the page cache) and which of them the module would use.
+'''
+
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+from pyquilt_pkg import backup
+
+PARSER = argparse.ArgumentParser(description='Measure the backup module\'s ways of copying files.')
+
+PARSER.add_argument(
+    '-n',
+    help='number of copies to time for each way (default 5)',
+    dest='opt_repeat',
+    metavar='count',
+    type=int,
+    default=5,
+)
+
+PARSER.add_argument(
+    '-s',
+    help='size of the file to copy in MB (default 64)',
+    dest='opt_size',
+    metavar='megabytes',
+    type=int,
+    default=64,
+)
+
+PARSER.add_argument(
+    '-d',
+    help='directory (on the file system of interest) to make the files in (default the current directory)',
+    dest='opt_dir',
+    metavar='dir',
+    default='.',
+)
+
+def make_source(path, megabytes):
+    block = os.urandom(1 << 20)
+    with open(path, 'wb') as fobj:
+        for _ in range(megabytes):
+            fobj.write(block)
+
+def time_copy(copy_fd, from_fn, to_fn):
+    '''Return the seconds copy_fd took to copy from_fn to to_fn (or None
+    if it can't be used here)'''
+    from_fd = os.open(from_fn, os.O_RDONLY)
+    to_fd = os.open(to_fn, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0644)
+    try:
+        start = time.time()
+        copy_fd(from_fd, to_fd)
+        os.fsync(to_fd)
+        seconds = time.time() - start
+    except backup._Unsupported:
+        return None
+    finally:
+        os.close(from_fd)
+        os.close(to_fd)
+    if os.path.getsize(to_fn) != os.path.getsize(from_fn):
+        raise RuntimeError('%s: copy has the wrong size' % to_fn)
+    os.unlink(to_fn)
+    return seconds
+
+args = PARSER.parse_args()
+
+work_dir = tempfile.mkdtemp(prefix='.copy_bench', dir=args.opt_dir)
+try:
+    from_fn = os.path.join(work_dir, 'source')
+    to_fn = os.path.join(work_dir, 'target')
+    make_source(from_fn, args.opt_size)
+    print '%-16s %10s %10s %10s' % ('way', 'min (ms)', 'med (ms)', 'MB/s')
+    for name, copy_fd in backup.COPY_STRATEGIES:
+        samples = [time_copy(copy_fd, from_fn, to_fn) for _ in range(max(args.opt_repeat, 1))]
+        if None in samples:
+            print '%-16s %10s' % (name, 'unsupported')
+            continue
+        times = sorted(samples)
+        print '%-16s %10.1f %10.1f %10.1f' % (name, times[0] * 1000, times[len(times) // 2] * 1000, args.opt_size / max(times[0], 1e-6))
+    time_copy(backup._copy_fd, from_fn, to_fn)
+    key = (os.stat(work_dir).st_dev, os.stat(work_dir).st_dev)
+    print 'backup uses: %s' % backup.COPY_STRATEGIES[backup._COPY_STRATEGY_CACHE.get(key, 0)][0]
+finally:
+    shutil.rmtree(work_dir)
@@ -48,8 +48,12 @@ ARGS = PARSER.parse_args()
 # This will keep track of the order in which files were discovered
 stats_list = patchlib.DiffStat.PathStatsList()
 
-def process_text(text, strip_level=1):
-    for stat in patchlib.Patch.parse_text(text).get_diffstat_stats(strip_level):
+def process_file(fobj, strip_level=1):
+    # read a file's diff at a time so that big patches needn't fit in memory
+    reader = patchlib.PatchReader(fobj)
+    strip_level = reader.num_strip_levels if strip_level is None else int(strip_level)
+    for diff_plus in reader:
+        stat = patchlib.DiffStat.PathStats(diff_plus.get_file_path(strip_level=strip_level), diff_plus.get_diffstat_stats())
         if stat not in stats_list:
             stats_list.append(stat)
         else:
@@ -57,7 +61,7 @@ def process_text(text, strip_level=1):
 
 if len(ARGS.arg_patch_list) == 0:
     try:
-        process_text(sys.stdin.read(), ARGS.opt_strip_level)
+        process_file(sys.stdin, ARGS.opt_strip_level)
     except patchlib.ParseError as pedata:
         print 'ERROR:', pedata.message, 'LINE NO:', pedata.lineno
         sys.exit(1)
@@ -74,7 +78,7 @@ else:
         sys.exit(1)
     for patch_filename in ARGS.arg_patch_list:
         try:
-            process_text(open(patch_filename).read(), ARGS.opt_strip_level)
+            process_file(open(patch_filename), ARGS.opt_strip_level)
         except patchlib.ParseError as pedata:
             print 'ERROR:', pedata.message, 'LINE NO:', pedata.lineno, 'FILE:', patch_filename
             sys.exit(1)
@@ -0,0 +1,81 @@
+#!/bin/env python
+### Copyright (C) 2011 Peter Williams <peter@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Measure how long the patchlib module takes to parse patch files (e.g.
+a kernel stable series or the output of "git log -p"): both all at once
+(Patch.parse_text) and a file's diff at a time (PatchReader).
+'''
+
+import argparse
+import cStringIO
+import time
+import sys
+import os
+
+from pyquilt_pkg import patchlib
+
+PARSER = argparse.ArgumentParser(description='Measure the time taken to parse patches.')
+
+PARSER.add_argument(
+    '-n',
+    help='number of times to parse each patch (default 5)',
+    dest='opt_repeat',
+    metavar='count',
+    type=int,
+    default=5,
+)
+
+PARSER.add_argument(
+    'arg_patch_list',
+    help='the patch files to parse',
+    metavar='patch',
+    nargs='+',
+)
+
+def parse_text(text):
+    return len(patchlib.Patch.parse_text(text).diff_pluses)
+
+def parse_stream(text):
+    return len([diff_plus for diff_plus in patchlib.PatchReader(cStringIO.StringIO(text))])
+
+def time_parse(parse, text, repeat):
+    '''Return the number of diffs in the text and the times parse took'''
+    times = []
+    for _ in range(max(repeat, 1)):
+        start = time.time()
+        count = parse(text)
+        times.append(time.time() - start)
+    return (count, sorted(times))
+
+args = PARSER.parse_args()
+
+bad_files = [filename for filename in args.arg_patch_list if not os.path.isfile(filename)]
+if bad_files:
+    sys.stderr.write('{0}: not found\n'.format(', '.join(bad_files)))
+    sys.exit(1)
+
+print '%-24s %-6s %8s %6s %10s %10s %12s' % ('patch', 'parse', 'lines', 'diffs', 'min (ms)', 'med (ms)', 'lines/s')
+for filename in args.arg_patch_list:
+    text = open(filename).read()
+    num_lines = text.count('\n')
+    for name, parse in [('text', parse_text), ('stream', parse_stream)]:
+        try:
+            count, times = time_parse(parse, text, args.opt_repeat)
+        except patchlib.ParseError as edata:
+            print '%-24s %-6s ERROR: %s LINE NO: %s' % (os.path.basename(filename)[:24], name, edata.message, edata.lineno)
+            continue
+        print '%-24s %-6s %8d %6d %10.1f %10.1f %12d' % (os.path.basename(filename)[:24], name, num_lines, count, times[0] * 1000, times[len(times) // 2] * 1000, num_lines / max(times[0], 1e-6))
@@ -17,33 +17,5 @@
 Library functions that are ony of interest CLI programs
 '''
 
-# This should be the only place that subcmd_* modules should be imported
-# as this is sufficient to activate them.
-from pyquilt_pkg import subcmd_new
-from pyquilt_pkg import subcmd_refresh
-from pyquilt_pkg import subcmd_push
-from pyquilt_pkg import subcmd_pop
-from pyquilt_pkg import subcmd_add
-from pyquilt_pkg import subcmd_rename
-from pyquilt_pkg import subcmd_delete
-from pyquilt_pkg import subcmd_setup
-from pyquilt_pkg import subcmd_annotate
-from pyquilt_pkg import subcmd_series
-from pyquilt_pkg import subcmd_applied
-from pyquilt_pkg import subcmd_import
-from pyquilt_pkg import subcmd_header
-from pyquilt_pkg import subcmd_fork
-from pyquilt_pkg import subcmd_diff
-from pyquilt_pkg import subcmd_revert
-from pyquilt_pkg import subcmd_files
-from pyquilt_pkg import subcmd_edit
-from pyquilt_pkg import subcmd_snapshot
-from pyquilt_pkg import subcmd_top
-from pyquilt_pkg import subcmd_patches
-from pyquilt_pkg import subcmd_remove
-from pyquilt_pkg import subcmd_fold
-from pyquilt_pkg import subcmd_next
-from pyquilt_pkg import subcmd_previous
-from pyquilt_pkg import subcmd_unapplied
-from pyquilt_pkg import subcmd_mail
-from pyquilt_pkg import subcmd_grep
+# The subcmd_* modules are not imported here: cmd_line imports each of
+# them on demand when its sub command is dispatched.
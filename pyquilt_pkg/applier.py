@@ -0,0 +1,632 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Apply patches in process (using the hunks parsed by patchlib) in the
+same way that GNU patch would: the same search for the place to apply
+each hunk (offsets and fuzz), the same backup files, reject files,
+messages and exit status.  Only the options that pyquilt gives to patch
+are understood.  Everything is worked out before any file is changed
+and, if the patch needs something that is not handled here (unknown
+options, git renames, binary diffs, questions for the user, etc.), the
+caller is told to run GNU patch instead.
+'''
+
+import os
+import re
+import shlex
+import calendar
+import tempfile
+
+from pyquilt_pkg import cmd_result
+from pyquilt_pkg import patchlib
+from pyquilt_pkg import profiling
+
+class Unsupported(Exception):
+    '''The patch (or the options) must be handled by GNU patch'''
+
+DEFAULT_FUZZ = 2
+
+class _Options(object):
+    def __init__(self):
+        self.strip_level = None
+        self.reverse = False
+        self.remove_empty_files = False
+        self.silent = False
+        self.force = False
+        self.fuzz = DEFAULT_FUZZ
+        self.backup = False
+        self.backup_if_mismatch = os.getenv('POSIXLY_CORRECT') is None
+        self.prefix = None
+        self.suffix = None
+        self.reject_file = None
+        self.reject_format = None
+        self.directory = None
+
+# Short options that take an argument and the attribute that they set
+_SHORT_ARG_OPTS = {'p' : 'strip_level', 'F' : 'fuzz', 'B' : 'prefix', 'z' : 'suffix', 'r' : 'reject_file', 'd' : 'directory'}
+_SHORT_FLAG_OPTS = {'R' : 'reverse', 'E' : 'remove_empty_files', 's' : 'silent', 'f' : 'force', 'b' : 'backup', 'N' : None, 't' : None}
+_LONG_ARG_OPTS = {
+    '--strip' : 'strip_level',
+    '--fuzz' : 'fuzz',
+    '--prefix' : 'prefix',
+    '--suffix' : 'suffix',
+    '--reject-file' : 'reject_file',
+    '--reject-format' : 'reject_format',
+    '--directory' : 'directory',
+}
+_LONG_FLAG_OPTS = {
+    '--reverse' : ('reverse', True),
+    '--remove-empty-files' : ('remove_empty_files', True),
+    '--silent' : ('silent', True),
+    '--quiet' : ('silent', True),
+    '--force' : ('force', True),
+    '--backup' : ('backup', True),
+    '--backup-if-mismatch' : ('backup_if_mismatch', True),
+    '--no-backup-if-mismatch' : ('backup_if_mismatch', False),
+    '--forward' : (None, None),
+    '--batch' : (None, None),
+}
+
+def _set_option(opts, attr, value):
+    if attr is None:
+        # options that only matter when patch would ask a question (and
+        # those are left to GNU patch)
+        return
+    if attr in ['strip_level', 'fuzz']:
+        try:
+            value = int(value)
+        except ValueError:
+            raise Unsupported(value)
+    elif attr == 'reject_format' and value not in ['unified', 'context']:
+        raise Unsupported(value)
+    elif attr == 'reject_file' and value == '-':
+        raise Unsupported(value)
+    setattr(opts, attr, value)
+
+def _parse_options(patch_args):
+    opts = _Options()
+    try:
+        argv = shlex.split(patch_args)
+    except ValueError:
+        raise Unsupported(patch_args)
+    index = 0
+    while index < len(argv):
+        arg = argv[index]
+        index += 1
+        if arg.startswith('--'):
+            name, sep, value = arg.partition('=')
+            if name in _LONG_FLAG_OPTS and not sep:
+                attr, value = _LONG_FLAG_OPTS[name]
+                _set_option(opts, attr, value)
+            elif name in _LONG_ARG_OPTS:
+                if not sep:
+                    if index >= len(argv):
+                        raise Unsupported(arg)
+                    value = argv[index]
+                    index += 1
+                _set_option(opts, _LONG_ARG_OPTS[name], value)
+            else:
+                raise Unsupported(arg)
+        elif arg.startswith('-') and len(arg) > 1:
+            char_index = 1
+            while char_index < len(arg):
+                char = arg[char_index]
+                char_index += 1
+                if char in _SHORT_FLAG_OPTS:
+                    _set_option(opts, _SHORT_FLAG_OPTS[char], True)
+                elif char in _SHORT_ARG_OPTS:
+                    value = arg[char_index:]
+                    if not value:
+                        if index >= len(argv):
+                            raise Unsupported(arg)
+                        value = argv[index]
+                        index += 1
+                    _set_option(opts, _SHORT_ARG_OPTS[char], value)
+                    break
+                else:
+                    raise Unsupported(arg)
+        else:
+            # file names on the command line
+            raise Unsupported(arg)
+    if opts.strip_level is None:
+        raise Unsupported('no strip level')
+    if not (opts.prefix or opts.suffix) and (os.getenv('VERSION_CONTROL') or os.getenv('PATCH_VERSION_CONTROL')):
+        raise Unsupported('version control')
+    if opts.suffix is None:
+        opts.suffix = os.getenv('SIMPLE_BACKUP_SUFFIX', '.orig')
+    return opts
+
+class _Hunk(object):
+    '''A hunk as lists of the lines that it expects (old) and the lines
+    that it leaves (new), tagged as in a context diff'''
+    def __init__(self, first, old, newfirst, new, c_function):
+        self.first = first
+        self.old = old
+        self.newfirst = newfirst
+        self.new = new
+        self.c_function = c_function
+        self.merged = _merge(old, new)
+        self.prefix_context = 0
+        while self.prefix_context < len(self.merged) and self.merged[self.prefix_context][0] == ' ':
+            self.prefix_context += 1
+        self.suffix_context = 0
+        while self.suffix_context < len(self.merged) - self.prefix_context and self.merged[-1 - self.suffix_context][0] == ' ':
+            self.suffix_context += 1
+        self.pattern = [line for _tag, line in old]
+    def reversed(self):
+        swap = {'-' : '+', '+' : '-', ' ' : ' ', '!' : '!'}
+        return _Hunk(self.newfirst, [(swap[tag], line) for tag, line in self.new],
+            self.first, [(swap[tag], line) for tag, line in self.old], self.c_function)
+
+def _merge(old, new):
+    '''Return the hunk's lines in unified diff order (deletions before
+    insertions) tagged with ' ', '-' or '+' '''
+    merged = []
+    old_index = new_index = 0
+    while old_index < len(old):
+        if old[old_index][0] in '-!':
+            merged.append(('-', old[old_index][1]))
+            old_index += 1
+        elif new_index < len(new) and new[new_index][0] in '+!':
+            merged.append(('+', new[new_index][1]))
+            new_index += 1
+        else:
+            merged.append((' ', old[old_index][1]))
+            old_index += 1
+            new_index += 1
+    merged += [('+', line) for _tag, line in new[new_index:]]
+    return merged
+
+def _no_newline(lines, index):
+    tag, line = lines[index]
+    if line.endswith('\n'):
+        lines[index] = (tag, line[:-1])
+
+def _unified_hunk(hunk):
+    hunk_lines = hunk.get_lines()
+    c_function = hunk_lines[0].rstrip('\r\n').split('@@', 2)[2]
+    old = []
+    new = []
+    last = []
+    for line in hunk_lines[1:]:
+        if line.startswith('\\'):
+            for lines, index in last:
+                _no_newline(lines, index)
+            continue
+        tag, text = line[0], line[1:]
+        last = []
+        if tag in ' -':
+            last.append((old, len(old)))
+            old.append((tag, text))
+        if tag in ' +':
+            last.append((new, len(new)))
+            new.append((tag, text))
+    first = hunk.before.start if len(old) else hunk.before.start + 1
+    newfirst = hunk.after.start if len(new) else hunk.after.start + 1
+    return _Hunk(first, old, newfirst, new, c_function)
+
+def _context_section(lines):
+    section = []
+    for line in lines:
+        if line.startswith('\\'):
+            if section:
+                _no_newline(section, len(section) - 1)
+            continue
+        section.append((line[0], line[2:]))
+    return section
+
+def _context_hunk(hunk):
+    lines = hunk.get_lines()
+    c_function = lines[0].rstrip('\r\n')[15:]
+    old = _context_section(lines[hunk.before.offset + 1:hunk.before.offset + hunk.before.numlines])
+    new = _context_section(lines[hunk.after.offset + 1:hunk.after.offset + hunk.after.numlines])
+    # a section that is all context is left out of the diff
+    if not old:
+        old = [(tag, line) for tag, line in new if tag == ' ']
+    if not new:
+        new = [(tag, line) for tag, line in old if tag == ' ']
+    first = hunk.before.start if len(old) else hunk.before.start + 1
+    newfirst = hunk.after.start if len(new) else hunk.after.start + 1
+    return _Hunk(first, old, newfirst, new, c_function)
+
+_HEADER_CRE = re.compile('^(?:---|\+\+\+|\*\*\*) ("[^"]+"|\S+)(.*)$')
+_ISO_TS_CRE = re.compile('(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})(\.\d+)? ([-+])(\d{2})(\d{2})')
+
+def _says_nonexistent(path, timestr):
+    if path == '/dev/null':
+        return True
+    match = _ISO_TS_CRE.search(timestr)
+    if match:
+        fields = [int(match.group(i)) for i in range(1, 7)]
+        offset = (int(match.group(9)) * 60 + int(match.group(10))) * 60
+        if match.group(8) == '-':
+            offset = -offset
+        fraction = match.group(7) if match.group(7) else ''
+        return calendar.timegm(fields) - offset == 0 and not fraction.strip('.0')
+    return 'Jan  1 00:00:00 1970' in timestr
+
+class _Side(object):
+    '''One of the file names (and time stamps) in a diff's header'''
+    def __init__(self, header_line, file_data, strip):
+        match = _HEADER_CRE.match(header_line.rstrip('\r\n'))
+        self.timestr = match.group(2) if match else ''
+        self.nonexistent = _says_nonexistent(file_data.path, self.timestr)
+        self.name = None
+        if file_data.path != '/dev/null':
+            try:
+                self.name = strip(file_data.path)
+            except patchlib.TooMayStripLevels:
+                pass
+            if not self.name:
+                self.name = None
+
+def _best_name(names):
+    # as GNU patch: fewest path components then shortest base name then
+    # shortest name
+    key = lambda name: (name.count('/'), len(os.path.basename(name)), len(name))
+    return min(names, key=key)
+
+def _quote(name):
+    if re.match('^[-A-Za-z0-9_./+,:@%=]+$', name):
+        return name
+    return "'%s'" % name.replace("'", "'\\''")
+
+def _unified_range(start, count):
+    if count == 0:
+        return '%d,0' % (start - 1)
+    elif count == 1:
+        return '%d' % start
+    return '%d,%d' % (start, count)
+
+def _context_range(start, count):
+    if count == 0:
+        return '0'
+    elif count == 1:
+        return '%d' % start
+    return '%d,%d' % (start, start + count - 1)
+
+def _reject_line(tag, line):
+    # (GNU patch does not mark a missing new line in reject files either)
+    return tag + line
+
+class _FilePlan(object):
+    '''What is to be done to one file'''
+    def __init__(self, name):
+        self.name = name
+        self.old_lines = None
+        self.new_lines = None
+        self.remove = False
+        self.mismatch = False
+
+class _Applier(object):
+    def __init__(self, opts, indir):
+        self.opts = opts
+        self.indir = indir
+        self.stdout = []
+        self.plans = []
+        self.plan_for = {}
+        self.rejects = []
+        self.failed = False
+    def _path(self, name):
+        if self.indir and not os.path.isabs(name):
+            return os.path.join(self.indir, name)
+        return name
+    def _exists(self, name):
+        plan = self.plan_for.get(name, None)
+        if plan is not None:
+            return plan.new_lines is not None and not plan.remove
+        return os.path.exists(self._path(name))
+    def _get_plan(self, name):
+        plan = self.plan_for.get(name, None)
+        if plan is None:
+            plan = _FilePlan(name)
+            path = self._path(name)
+            if os.path.islink(path) or (os.path.exists(path) and not os.path.isfile(path)):
+                raise Unsupported(name)
+            if os.path.exists(path):
+                if not os.access(path, os.W_OK):
+                    raise Unsupported(name)
+                text = open(path, 'rb').read()
+                profiling.count('bytes read', len(text))
+                plan.old_lines = text.splitlines(True)
+            plan.new_lines = plan.old_lines
+            self.plan_for[name] = plan
+            self.plans.append(plan)
+        return plan
+    def _locate(self, lines, hunk, fuzz, in_offset, frozen):
+        '''Return the offset at which the hunk matches (or None) trying
+        offsets in the same order as GNU patch'''
+        first_guess = hunk.first + in_offset
+        pat_lines = len(hunk.pattern)
+        input_lines = len(lines)
+        context = max(hunk.prefix_context, hunk.suffix_context)
+        prefix_fuzz = fuzz + hunk.prefix_context - context
+        suffix_fuzz = fuzz + hunk.suffix_context - context
+        max_where = input_lines - (pat_lines - suffix_fuzz) + 1
+        min_where = frozen + 1
+        max_pos_offset = max_where - first_guess
+        max_neg_offset = first_guess - min_where
+        max_offset = max(max_pos_offset, max_neg_offset)
+        if not pat_lines:
+            return 0
+        if first_guess <= max_neg_offset:
+            max_neg_offset = first_guess - 1
+        def matches(offset, prefix_fuzz, suffix_fuzz):
+            base = first_guess + offset - 1
+            if base < 0 or base + pat_lines - suffix_fuzz > input_lines:
+                return False
+            for index in range(prefix_fuzz, pat_lines - suffix_fuzz):
+                if lines[base + index] != hunk.pattern[index]:
+                    return False
+            return True
+        if prefix_fuzz < 0 and hunk.first <= 1:
+            # can only match the start of the file
+            if suffix_fuzz < 0 and (pat_lines != input_lines or hunk.prefix_context < frozen):
+                return None
+            offset = 1 - first_guess
+            if frozen <= hunk.prefix_context and offset <= max_pos_offset and matches(offset, 0, suffix_fuzz):
+                return offset
+            return None
+        elif prefix_fuzz < 0:
+            prefix_fuzz = 0
+        if suffix_fuzz < 0:
+            # can only match the end of the file
+            offset = first_guess - (input_lines - pat_lines + 1)
+            if offset <= max_neg_offset and matches(-offset, prefix_fuzz, 0):
+                return -offset
+            return None
+        for offset in range(max_offset + 1):
+            if offset <= max_pos_offset and matches(offset, prefix_fuzz, suffix_fuzz):
+                return offset
+            if 0 < offset <= max_neg_offset and matches(-offset, prefix_fuzz, suffix_fuzz):
+                return -offset
+        return None
+    def _apply_hunk(self, lines, out, frozen, hunk, where):
+        '''Copy lines to out up to and including the hunk (applied at
+        line where) and return the number of lines of input used'''
+        def copy_till(line_num):
+            while frozen[0] < min(line_num, len(lines)):
+                out.append(lines[frozen[0]])
+                frozen[0] += 1
+        frozen = [frozen]
+        base = where - 1
+        old_index = new_index = 0
+        old = hunk.old
+        new = hunk.new
+        while old_index < len(old):
+            if old[old_index][0] in '-!':
+                copy_till(base + old_index)
+                frozen[0] += 1
+                old_index += 1
+            elif new_index < len(new) and new[new_index][0] in '+!':
+                copy_till(base + old_index)
+                out.append(new[new_index][1])
+                new_index += 1
+            else:
+                old_index += 1
+                new_index += 1
+        if new_index < len(new):
+            copy_till(base + old_index)
+            out += [line for _tag, line in new[new_index:]]
+        return frozen[0]
+    def _reject_text(self, diff, hunk, out_offset):
+        first = hunk.first + out_offset
+        newfirst = hunk.newfirst + out_offset
+        if isinstance(diff, patchlib.ContextDiff) and self.opts.reject_format != 'unified':
+            text = '***************%s\n' % hunk.c_function
+            text += '*** %s ****\n' % _context_range(first, len(hunk.old))
+            text += ''.join([_reject_line(tag + ' ', line) for tag, line in hunk.old])
+            text += '--- %s ----\n' % _context_range(newfirst, len(hunk.new))
+            text += ''.join([_reject_line(tag + ' ', line) for tag, line in hunk.new])
+            return text
+        text = '@@ -%s +%s @@%s\n' % (_unified_range(first, len(hunk.old)), _unified_range(newfirst, len(hunk.new)), hunk.c_function)
+        return text + ''.join([_reject_line(tag, line) for tag, line in hunk.merged])
+    def _reject_header(self, diff, sides):
+        if self.opts.reverse:
+            sides = (sides[1], sides[0])
+        if isinstance(diff, patchlib.ContextDiff) and self.opts.reject_format != 'unified':
+            tags = ('***', '---')
+        else:
+            tags = ('---', '+++')
+        text = ''
+        for tag, side in zip(tags, sides):
+            text += '%s %s%s\n' % (tag, side.name if side.name else '/dev/null', side.timestr)
+        return text
+    def plan_diff(self, diff_plus):
+        diff = diff_plus.diff
+        if diff is None or not diff.hunks:
+            raise Unsupported('no diff')
+        for preamble in diff_plus.preambles:
+            if preamble.preamble_type == 'git' and set(preamble.extras) - set(['index']):
+                raise Unsupported('git extensions')
+        strip = patchlib.gen_strip_level_function(self.opts.strip_level)
+        header_lines = diff.header.get_lines()
+        sides = (_Side(header_lines[0], diff.file_data.before, strip), _Side(header_lines[1], diff.file_data.after, strip))
+        if isinstance(diff, patchlib.UnifiedDiff):
+            hunks = [_unified_hunk(hunk) for hunk in diff.hunks]
+        else:
+            hunks = [_context_hunk(hunk) for hunk in diff.hunks]
+        old_side, new_side = sides
+        if self.opts.reverse:
+            hunks = [hunk.reversed() for hunk in hunks]
+            old_side, new_side = new_side, old_side
+        creates = old_side.nonexistent or (len(hunks) == 1 and hunks[0].first == 1 and not hunks[0].old)
+        names = [side.name for side in sides if side.name is not None]
+        if not names:
+            raise Unsupported('no file name')
+        existing = [name for name in names if self._exists(name)]
+        if existing:
+            name = _best_name(existing)
+        elif creates:
+            name = _best_name(names)
+        else:
+            raise Unsupported('no file to patch')
+        plan = self._get_plan(name)
+        lines = plan.new_lines
+        if lines is None or plan.remove:
+            if not creates:
+                raise Unsupported('no file to patch')
+            lines = []
+        elif old_side.nonexistent and lines:
+            raise Unsupported('file to be created already exists')
+        elif not lines and len(hunks) == 1 and hunks[0].newfirst == 1 and not hunks[0].new:
+            raise Unsupported('file to be emptied is already empty')
+        if not self.opts.silent:
+            self.stdout.append('patching file %s\n' % _quote(name))
+        out = []
+        frozen = 0
+        in_offset = out_offset = 0
+        rejects = []
+        for number, hunk in enumerate(hunks, 1):
+            context = max(hunk.prefix_context, hunk.suffix_context)
+            max_fuzz = min(self.opts.fuzz, context)
+            fuzz = 0
+            while True:
+                offset = self._locate(lines, hunk, fuzz, in_offset, frozen)
+                if offset is None and number == 1 and not self.opts.force:
+                    if self._locate(lines, hunk.reversed(), fuzz, in_offset, frozen) is not None:
+                        # patch would ask whether to assume -R
+                        raise Unsupported('reversed patch')
+                if offset is not None or fuzz >= max_fuzz:
+                    break
+                fuzz += 1
+            if offset is not None:
+                in_offset += offset
+            if offset is None or fuzz or in_offset:
+                plan.mismatch = True
+            if offset is None:
+                rejects.append(self._reject_text(diff, hunk, out_offset))
+                if not self.opts.silent:
+                    self.stdout.append('Hunk #%d FAILED at %d.\n' % (number, hunk.first + out_offset))
+                continue
+            where = hunk.first + in_offset
+            if not self.opts.silent and (fuzz or in_offset):
+                msg = 'Hunk #%d succeeded at %d' % (number, where + out_offset)
+                if fuzz:
+                    msg += ' with fuzz %d' % fuzz
+                if in_offset:
+                    msg += ' (offset %d line%s)' % (in_offset, '' if in_offset == 1 else 's')
+                self.stdout.append(msg + '.\n')
+            frozen = self._apply_hunk(lines, out, frozen, hunk, where)
+            out_offset = len(out) - frozen
+        out += lines[frozen:]
+        for line in out[:-1]:
+            if not line.endswith('\n'):
+                # GNU patch's handling of this is not simple to mimic
+                raise Unsupported('line without a new line')
+        if new_side.nonexistent and out:
+            raise Unsupported('file to be deleted is not empty')
+        plan.new_lines = out
+        plan.remove = not out and (self.opts.remove_empty_files or new_side.nonexistent)
+        if rejects:
+            self.failed = True
+            if self.opts.reject_file:
+                reject_file = self.opts.reject_file
+            else:
+                reject_file = name + '.rej'
+            self.rejects.append((reject_file, self._reject_header(diff, sides) + ''.join(rejects)))
+            self.stdout.append('%d out of %d hunk%s FAILED -- saving rejects to file %s\n' % (len(rejects), len(hunks), '' if len(hunks) == 1 else 's', _quote(reject_file)))
+    def _backup_name(self, name):
+        if self.opts.prefix:
+            return self.opts.prefix + name
+        return name + self.opts.suffix
+    def _make_backup(self, plan):
+        path = self._path(plan.name)
+        backup = self._path(self._backup_name(plan.name))
+        backup_dir = os.path.dirname(backup)
+        if backup_dir and not os.path.isdir(backup_dir):
+            os.makedirs(backup_dir)
+        if os.path.exists(backup) or os.path.islink(backup):
+            os.remove(backup)
+        if plan.old_lines is None:
+            # an empty backup for a file that did not exist
+            open(backup, 'wb').close()
+        else:
+            os.rename(path, backup)
+    def _write(self, plan, mode):
+        path = self._path(plan.name)
+        if plan.remove:
+            if os.path.exists(path):
+                os.remove(path)
+            # and any directories that have been left empty
+            dirpath = os.path.dirname(plan.name)
+            while dirpath:
+                try:
+                    os.rmdir(self._path(dirpath))
+                except OSError:
+                    break
+                dirpath = os.path.dirname(dirpath)
+            return
+        dirpath = os.path.dirname(path)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        fd, tmp_path = tempfile.mkstemp(dir=dirpath if dirpath else '.', prefix='.pyquilt')
+        try:
+            text = ''.join(plan.new_lines)
+            profiling.count('bytes written', len(text))
+            tmp_file = os.fdopen(fd, 'wb')
+            tmp_file.write(text)
+            tmp_file.close()
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    def commit(self):
+        umask = os.umask(0)
+        os.umask(umask)
+        for plan in self.plans:
+            path = self._path(plan.name)
+            mode = os.stat(path).st_mode & 07777 if plan.old_lines is not None else 0666 & ~umask
+            if self.opts.backup or (self.opts.backup_if_mismatch and plan.mismatch):
+                self._make_backup(plan)
+            self._write(plan, mode)
+        truncated = set()
+        for reject_file, text in self.rejects:
+            path = self._path(reject_file)
+            with open(path, 'ab' if path in truncated else 'wb') as fobj:
+                fobj.write(text)
+            truncated.add(path)
+
+def apply_patch_text(text, indir=None, patch_args='', parsed=None):
+    '''Apply the patch text as "patch -d indir patch_args" would and return
+    a cmd_result.Result (or None if GNU patch must be used instead).
+    parsed, if given, is the (unmodified) patchlib.Patch of the text.'''
+    with profiling.phase('apply patches'):
+        return _apply_patch_text(text, indir, patch_args, parsed)
+
+def _apply_patch_text(text, indir, patch_args, parsed):
+    try:
+        opts = _parse_options(patch_args)
+        if opts.directory is not None:
+            indir = os.path.join(indir, opts.directory) if indir else opts.directory
+        obj = parsed if parsed is not None else patchlib.Patch.parse_text(text)
+        if not obj.diff_pluses:
+            return None
+        applier = _Applier(opts, indir)
+        for diff_plus in obj.diff_pluses:
+            applier.plan_diff(diff_plus)
+    except (Unsupported, patchlib.ParseError, patchlib.TooMayStripLevels):
+        return None
+    try:
+        applier.commit()
+    except (IOError, OSError) as edata:
+        stderr = 'patch: **** %s\n' % edata
+        return cmd_result.Result(cmd_result.ERROR, ''.join(applier.stdout), stderr)
+    # patch's exit status: 1 if some hunks failed and 2 for trouble
+    eflags = cmd_result.WARNING if applier.failed else cmd_result.OK
+    return cmd_result.Result(eflags, ''.join(applier.stdout), '')
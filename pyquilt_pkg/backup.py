@@ -27,8 +27,30 @@ import sys
 import errno
 import tempfile
 import stat
+import fcntl
+import hashlib
 import collections
+import ctypes
+import ctypes.util
 from pyquilt_pkg import output
+from pyquilt_pkg import profiling
+
+# The (optional) store of backup files' contents: backup files that are
+# links to the same object share their disk space.  Objects are named by
+# the hash of their contents, their mode and their modification time and
+# are removed once no backup file links to them.  A symbolic link (named
+# by its inode number) to each object in INODES_DIR lets an object that
+# may have lost its last backup file be found without reading it.
+OBJECTS_DIR = '.objects'
+INODES_DIR = 'inodes'
+
+# The inode numbers of the files unlinked (by this process) that had just
+# one other link, which may have been a store object (see collect_garbage())
+_RELEASED_INODES = set()
+
+def _release(stat_data):
+    if stat_data.st_nlink == 2:
+        _RELEASED_INODES.add(stat_data.st_ino)
 
 def _create_parents(filename):
     last_sep = filename.rfind(os.sep)
@@ -58,16 +80,109 @@ def _remove_parents(filename):
                 raise
         last_sep = dirname.rfind(os.sep)
 
-def _copy_fd(from_fd, to_fd):
-    CNT = 16384
-    # let clients catch the exceptions
+# The ways of copying a file's data (best first).  Each copies from the
+# start of the source file to the (empty) target file and raises
+# _Unsupported if it can't be used (before it has copied anything).
+class _Unsupported(Exception):
+    pass
+
+# errors that mean a way of copying isn't available for the file systems
+_UNSUPPORTED_ERRNOS = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM])
+
+_FICLONE = 0x40049409
+_COPY_CHUNK = 1 << 30
+
+# The libc functions used for copying (None for those that libc lacks).
+# Finding libc is slow so it is only done when a file is first copied.
+_LIBC_FUNCS = {}
+
+def _get_libc_func(name):
+    if not _LIBC_FUNCS:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        except OSError:
+            libc = None
+        signatures = [
+            ('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]),
+            ('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]),
+        ]
+        funcs = {}
+        for func_name, argtypes in signatures:
+            func = getattr(libc, func_name, None) if libc is not None else None
+            if func is not None:
+                func.argtypes = argtypes
+                func.restype = ctypes.c_ssize_t
+            funcs[func_name] = func
+        # all at once for the sake of other threads
+        _LIBC_FUNCS.update(funcs)
+    return _LIBC_FUNCS[name]
+
+def _clone_fd(from_fd, to_fd):
+    try:
+        fcntl.ioctl(to_fd, _FICLONE, from_fd)
+    except IOError as edata:
+        if edata.errno in _UNSUPPORTED_ERRNOS:
+            raise _Unsupported()
+        raise OSError(edata.errno, edata.strerror)
+
+def _syscall_copy(call):
+    '''Copy with call() (which copies the next chunk) until it reports the end of the file'''
+    copied = False
+    while True:
+        count = call()
+        if count < 0:
+            err = ctypes.get_errno()
+            if not copied and err in _UNSUPPORTED_ERRNOS:
+                raise _Unsupported()
+            raise OSError(err, os.strerror(err))
+        elif count == 0:
+            return
+        copied = True
+
+def _copy_file_range_fd(from_fd, to_fd):
+    copy_file_range = _get_libc_func('copy_file_range')
+    if copy_file_range is None:
+        raise _Unsupported()
+    _syscall_copy(lambda: copy_file_range(from_fd, None, to_fd, None, _COPY_CHUNK, 0))
+
+def _sendfile_fd(from_fd, to_fd):
+    sendfile = _get_libc_func('sendfile')
+    if sendfile is None:
+        raise _Unsupported()
+    _syscall_copy(lambda: sendfile(to_fd, from_fd, None, _COPY_CHUNK))
+
+def _read_write_fd(from_fd, to_fd):
+    CNT = 1 << 20
     while True:
         data = os.read(from_fd, CNT)
         if len(data) == 0:
             break
         total = 0
         while total < len(data):
-            total += os.write(to_fd, data[total:])
+            total += os.write(to_fd, buffer(data, total))
+
+COPY_STRATEGIES = [
+    ('clone', _clone_fd),
+    ('copy_file_range', _copy_file_range_fd),
+    ('sendfile', _sendfile_fd),
+    ('read_write', _read_write_fd),
+]
+
+# The index of the first way of copying that works between two file
+# systems (keyed by their st_dev)
+_COPY_STRATEGY_CACHE = {}
+
+def _copy_fd(from_fd, to_fd):
+    # let clients catch the exceptions
+    key = (os.fstat(from_fd).st_dev, os.fstat(to_fd).st_dev)
+    index = _COPY_STRATEGY_CACHE.get(key, 0)
+    while True:
+        try:
+            COPY_STRATEGIES[index][1](from_fd, to_fd)
+            break
+        except _Unsupported:
+            index += 1
+            _COPY_STRATEGY_CACHE[key] = index
     return True
 
 def _creat(name, mode=0777):
@@ -94,6 +209,7 @@ def _copy_file(from_fn, stat_data, to_fn):
         os.close(from_fd);
         return False
     os.fchmod(to_fd, stat_data.st_mode)
+    profiling.count('bytes copied', stat_data.st_size)
     try:
         _copy_fd(from_fd, to_fd)
     except OSError as edata:
@@ -143,8 +259,85 @@ def ensure_nolinks(filename):
     else:
         return True
 
+def _get_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fobj:
+        while True:
+            data = fobj.read(65536)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def _object_name(store_dir, digest, stat_data):
+    return os.path.join(store_dir, digest[:2], '%s-%o-%d' % (digest[2:], stat.S_IMODE(stat_data.st_mode), int(stat_data.st_mtime)))
+
+def _inode_link_name(store_dir, ino):
+    return os.path.join(store_dir, INODES_DIR, str(ino))
+
+def _add_inode_link(store_dir, obj):
+    link_name = _inode_link_name(store_dir, os.stat(obj).st_ino)
+    if not os.path.isdir(os.path.dirname(link_name)):
+        os.makedirs(os.path.dirname(link_name))
+    # any link already there is left over from a removed object
+    try:
+        os.unlink(link_name)
+    except OSError as edata:
+        if edata.errno != errno.ENOENT:
+            raise
+    os.symlink(os.path.relpath(obj, os.path.dirname(link_name)), link_name)
+
+def _replace_with_link(from_fn, to_fn):
+    # the link is made under a temporary name first so that to_fn is not
+    # lost if it can't be made
+    tmp_fn = os.path.join(os.path.dirname(to_fn), '.%s.%d~' % (os.path.basename(to_fn), os.getpid()))
+    try:
+        os.link(from_fn, tmp_fn)
+        os.rename(tmp_fn, to_fn)
+    except OSError as edata:
+        if os.path.lexists(tmp_fn):
+            os.unlink(tmp_fn)
+        if edata.errno in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOSYS]:
+            return True
+        output.perror(edata, 'Could not link file \`%s\' to \`%s\'' % (from_fn, to_fn))
+        return False
+    return True
+
+def _store_file(store_dir, backup):
+    '''Make the backup file a link to the object in the store with the
+    same contents and mode (adding it as the object if there is none).
+    Backups that are empty or already have other links are left alone.'''
+    try:
+        stat_data = os.stat(backup)
+        if stat_data.st_size == 0 or stat_data.st_nlink != 1:
+            return True
+        obj = _object_name(store_dir, _get_digest(backup), stat_data)
+        if os.path.exists(obj):
+            return _replace_with_link(obj, backup)
+        if not os.path.isdir(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj))
+        os.link(backup, obj)
+        _add_inode_link(store_dir, obj)
+    except (IOError, OSError) as edata:
+        if isinstance(edata, OSError) and edata.errno == errno.EEXIST:
+            return _replace_with_link(obj, backup)
+        if isinstance(edata, OSError) and edata.errno in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOSYS]:
+            return True
+        output.perror(edata, backup)
+        return False
+    return True
+
+def _find_object(store_dir, file_nm, stat_data):
+    try:
+        obj = _object_name(store_dir, _get_digest(file_nm), stat_data)
+    except IOError:
+        return None
+    return obj if os.path.exists(obj) else None
+
 # Backup
-def backup(bu_dir, filelist, verbose=False):
+def backup(bu_dir, filelist, verbose=False, store_dir=None):
+    '''Back up the files in filelist into bu_dir (linking the backups into
+    the content store in store_dir if it is given)'''
     def backup_file(file_nm):
         backup = os.path.join(bu_dir, file_nm)
         try:
@@ -154,6 +347,7 @@ def backup(bu_dir, filelist, verbose=False):
         else:
             missing_file = False
         try:
+            _release(os.lstat(backup))
             os.unlink(backup)
         except OSError as edata:
             if edata.errno != errno.ENOENT:
@@ -171,6 +365,16 @@ def backup(bu_dir, filelist, verbose=False):
         else:
             if verbose:
                 output.write('Copying %s\n' % file_nm)
+            obj = None
+            if store_dir is not None and stat_data.st_size > 0:
+                obj = _find_object(store_dir, file_nm, stat_data)
+            if obj is not None:
+                # the contents are already stored so just link to them
+                result = _link_or_copy_file(obj, stat_data, backup)
+                if result is not True:
+                    return result
+                os.utime(backup, (stat_data.st_mtime, stat_data.st_mtime,))
+                return ensure_nolinks(file_nm) if stat_data.st_nlink > 1 else True
             if stat_data.st_nlink == 1:
                 result = _copy_file(file_nm, stat_data, backup)
                 if result is not True:
@@ -183,12 +387,82 @@ def backup(bu_dir, filelist, verbose=False):
                 if result is not True:
                     return result
             os.utime(backup, (stat_data.st_mtime, stat_data.st_mtime,))
+            if store_dir is not None:
+                return _store_file(store_dir, backup)
         return True
+    with profiling.phase('backup'):
+        for filename in filelist:
+            if not backup_file(filename):
+                return False
+    return True
+
+def add_to_store(bu_dir, store_dir, filelist=None):
+    '''Link the backup files in bu_dir (or those in filelist) into the
+    content store in store_dir'''
+    if filelist is None:
+        filelist = []
+        for basedir, dirnames, filenames in os.walk(bu_dir):
+            reldir = '' if basedir == bu_dir else os.path.relpath(basedir, bu_dir)
+            filelist += [os.path.join(reldir, filename) for filename in filenames]
     for filename in filelist:
-        if not backup_file(filename):
+        if not _store_file(store_dir, os.path.join(bu_dir, filename)):
             return False
     return True
 
+def collect_garbage(store_dir):
+    '''Remove the objects in the content store in store_dir that no
+    backup file links to any more (of those that may have lost their
+    last link to a backup file unlinked by this process)'''
+    inodes = list(_RELEASED_INODES)
+    _RELEASED_INODES.clear()
+    if not inodes or not os.path.isdir(store_dir):
+        return True
+    try:
+        for ino in inodes:
+            link_name = _inode_link_name(store_dir, ino)
+            try:
+                obj = os.path.join(os.path.dirname(link_name), os.readlink(link_name))
+            except OSError as edata:
+                if edata.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                stat_data = os.stat(obj)
+            except OSError as edata:
+                if edata.errno != errno.ENOENT:
+                    raise
+                stat_data = None
+            if stat_data is not None and stat_data.st_ino == ino:
+                if stat_data.st_nlink > 1:
+                    continue
+                os.unlink(obj)
+                if not os.listdir(os.path.dirname(obj)):
+                    os.rmdir(os.path.dirname(obj))
+            os.unlink(link_name)
+    except OSError as edata:
+        output.perror(edata)
+        return False
+    return True
+
+def discard(bu_dir):
+    '''Remove the backup directory bu_dir and everything in it (noting
+    any store objects that lose their last backup file for
+    collect_garbage())'''
+    def onerror(exception):
+        raise exception
+    for basedir, dirnames, filenames in os.walk(bu_dir, topdown=False, onerror=onerror):
+        for filename in filenames:
+            filename = os.path.join(basedir, filename)
+            _release(os.lstat(filename))
+            os.unlink(filename)
+        for dirname in dirnames:
+            dirname = os.path.join(basedir, dirname)
+            if os.path.islink(dirname):
+                os.unlink(dirname)
+            else:
+                os.rmdir(dirname)
+    os.rmdir(bu_dir)
+
 # Restore
 def restore(bu_dir, filelist=None, to_dir='.', verbose=False, keep=False, touch=False):
     def restore_file(file_nm):
@@ -210,6 +484,7 @@ def restore(bu_dir, filelist=None, to_dir='.', verbose=False, keep=False, touch=
             if verbose:
                 output.write('Removing %s\n' % file_nm)
             if not keep:
+                _release(stat_data)
                 os.unlink(backup)
                 _remove_parents(backup)
         else:
@@ -220,9 +495,15 @@ def restore(bu_dir, filelist=None, to_dir='.', verbose=False, keep=False, touch=
             except OSError as edata:
                 if edata.errno != errno.ENOENT:
                     raise
-            if not _link_or_copy_file(backup, stat_data, file_nm):
+            # a backup with other links (e.g. in the content store) is
+            # copied so that changes to the file can't get to them
+            if stat_data.st_nlink > 1:
+                if not _copy_file(backup, stat_data, file_nm):
+                    return False
+            elif not _link_or_copy_file(backup, stat_data, file_nm):
                 return False
             if not keep:
+                _release(stat_data)
                 os.unlink(backup)
                 _remove_parents(backup)
             if touch:
@@ -233,22 +514,23 @@ def restore(bu_dir, filelist=None, to_dir='.', verbose=False, keep=False, touch=
     if not os.path.isdir(bu_dir):
         return False
     status = True
-    if filelist is None or len(filelist) == 0:
-        def onerror(exception):
-            raise exception
-        try:
-            for basedir, dirnames, filenames in os.walk(bu_dir, onerror=onerror):
-                reldir = '' if basedir == bu_dir else os.path.relpath(basedir, bu_dir)
-                for filename in filenames:
-                    if not restore_file(os.path.join(reldir, filename)):
-                        return False
-        except OSError as edata:
-            output.perror(edata)
-            return False
-    else:
-        for filename in filelist:
-            if not restore_file(filename):
+    with profiling.phase('restore'):
+        if filelist is None or len(filelist) == 0:
+            def onerror(exception):
+                raise exception
+            try:
+                for basedir, dirnames, filenames in os.walk(bu_dir, onerror=onerror):
+                    reldir = '' if basedir == bu_dir else os.path.relpath(basedir, bu_dir)
+                    for filename in filenames:
+                        if not restore_file(os.path.join(reldir, filename)):
+                            return False
+            except OSError as edata:
+                output.perror(edata)
                 return False
+        else:
+            for filename in filelist:
+                if not restore_file(filename):
+                    return False
     return True
 
 # Delink
@@ -277,6 +559,7 @@ def remove(bu_dir, filelist=False, verbose=False):
         try:
             if verbose:
                 output.write('Removing %s\n' % backup)
+            _release(os.lstat(backup))
             os.unlink(backup)
         except OSError as edata:
             output.perror(edata, backup)
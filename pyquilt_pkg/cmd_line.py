@@ -19,6 +19,7 @@ mechanism for sub commands to add their components.
 '''
 
 import argparse
+import importlib
 import sys
 import os
 
@@ -38,15 +39,85 @@ PARSER.add_argument(
     metavar='file'
 )
 
+PARSER.add_argument(
+    '--profile',
+    help='''Report where the command spent its time (the functions that
+    took longest and totals for phases such as running other programs and
+    parsing patches) on standard error.  Setting the QUILT_PROFILE
+    environment variable has the same effect and if its value is a file
+    name the report is appended to that file instead.''',
+    dest='opt_profile',
+    action='store_true',
+)
+
+# The sub commands and the modules implementing them (in the order that
+# the help lists them).  A sub command's module, which adds its parser to
+# SUB_CMD_PARSER, is only imported when that sub command is used or when
+# all of them are needed (e.g. for the help).
+SUB_CMDS = [
+    ('new', 'subcmd_new'),
+    ('refresh', 'subcmd_refresh'),
+    ('push', 'subcmd_push'),
+    ('pop', 'subcmd_pop'),
+    ('add', 'subcmd_add'),
+    ('rename', 'subcmd_rename'),
+    ('delete', 'subcmd_delete'),
+    ('setup', 'subcmd_setup'),
+    ('annotate', 'subcmd_annotate'),
+    ('series', 'subcmd_series'),
+    ('applied', 'subcmd_applied'),
+    ('import', 'subcmd_import'),
+    ('header', 'subcmd_header'),
+    ('fork', 'subcmd_fork'),
+    ('diff', 'subcmd_diff'),
+    ('revert', 'subcmd_revert'),
+    ('files', 'subcmd_files'),
+    ('edit', 'subcmd_edit'),
+    ('snapshot', 'subcmd_snapshot'),
+    ('top', 'subcmd_top'),
+    ('patches', 'subcmd_patches'),
+    ('remove', 'subcmd_remove'),
+    ('fold', 'subcmd_fold'),
+    ('next', 'subcmd_next'),
+    ('previous', 'subcmd_previous'),
+    ('unapplied', 'subcmd_unapplied'),
+    ('mail', 'subcmd_mail'),
+    ('grep', 'subcmd_grep'),
+    ('serve', 'subcmd_serve'),
+]
+
 SUB_CMD_PARSER = PARSER.add_subparsers(title='commands', dest='sub_cmd_name')
 
+def load_sub_cmds(names=None):
+    '''Import the modules of the named sub commands (or of all of them)'''
+    for name, module_name in SUB_CMDS:
+        if names is None or name in names:
+            importlib.import_module('pyquilt_pkg.' + module_name)
+
+def _get_sub_cmd_name(argv):
+    '''Return the sub command named in argv (or None if there is none
+    or the main parser's help is asked for first)'''
+    index = 0
+    while index < len(argv):
+        if argv[index] in ['-h', '--help']:
+            return None
+        elif argv[index] == '--quiltrc':
+            index += 2
+        elif argv[index].startswith('-'):
+            index += 1
+        else:
+            return argv[index]
+    return None
+
 def parse_args():
     """Parse the command line, merge with (custom) defaults and return the result"""
+    sub_cmd_name = _get_sub_cmd_name(sys.argv[1:])
+    load_sub_cmds([sub_cmd_name] if sub_cmd_name in dict(SUB_CMDS) else None)
     # Handle the awkward case of the "grep" sub comand
     # which eludes argparse's capabilities
     index = 1
     grep_index = None
-    while index < len(sys.argv) and sys.argv[index] in ['--version', '--quiltrc', '--help', '-h', 'grep']:
+    while index < len(sys.argv) and sys.argv[index] in ['--version', '--quiltrc', '--profile', '--help', '-h', 'grep']:
         if sys.argv[index] == 'grep':
             if grep_index is None:
                 grep_index = index
@@ -65,5 +136,7 @@ def parse_args():
     default_args = None if args.sub_cmd_name == 'grep' else customization.get_default_args(args.sub_cmd_name).split()
     if default_args:
         # Command line has precedence so put them last
+        opt_profile = args.opt_profile
         args = PARSER.parse_args([args.sub_cmd_name] + default_args + sys.argv[sys.argv.index(args.sub_cmd_name) + 1:])
+        args.opt_profile = opt_profile
     return args
@@ -33,6 +33,13 @@ _QUILT_CONFIG_DICT = {
         'QUILT_BACKUP': False,
     }
 
+_DEFAULT_CONFIG_DICT = dict(_QUILT_CONFIG_DICT)
+
+def reset_configuration_data():
+    '''Forget any configuration data processed so far'''
+    _QUILT_CONFIG_DICT.clear()
+    _QUILT_CONFIG_DICT.update(_DEFAULT_CONFIG_DICT)
+
 _config_line_re = re.compile(r'(^[^=]+)=(.*)$')
 
 def process_configuration_data(filename=None):
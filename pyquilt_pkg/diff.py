@@ -18,10 +18,13 @@ Run diff program
 '''
 
 import os.path
+import shlex
 import time
 import shell
 
+from pyquilt_pkg import cmd_result
 from pyquilt_pkg import customization
+from pyquilt_pkg import textdiff
 
 DTFMT = r'%Y-%m-%d %H:%M:%S %z'
 
@@ -35,6 +38,10 @@ def _get_diff_opts(args):
         return diff_opts + args.opt_format
     return diff_opts + ' -u'
 
+def _use_gnu_diff():
+    # GNU diff is used if selected in the quiltrc (QUILT_DIFF_ENGINE=gnu)
+    return customization.get_config('QUILT_DIFF_ENGINE', 'builtin') == 'gnu'
+
 def _get_no_diff_index(args):
     if args.opt_no_index:
         return True
@@ -79,9 +86,15 @@ def diff_file(filnm, old_file, new_file, args):
     elif use_timestamps:
         new_date = '\t%s' % file_mtime_as_string(new_file)
     diff_opts = _get_diff_opts(args)
-    cmd = 'diff %s --label "%s" --label "%s" "%s" "%s"' % \
-        (diff_opts, old_hdr + old_date, new_hdr + new_date, old_file, new_file)
-    result = shell.run_cmd(cmd)
+    result = None
+    if not _use_gnu_diff():
+        result = textdiff.diff_files(old_file, new_file, old_hdr + old_date, new_hdr + new_date, diff_opts)
+    if result is None:
+        try:
+            argv = ['diff'] + shlex.split(diff_opts) + ['--label', old_hdr + old_date, '--label', new_hdr + new_date, old_file, new_file]
+        except ValueError as edata:
+            return cmd_result.Result(cmd_result.ERROR, '', 'diff %s: %s\n' % (diff_opts, edata))
+        result = shell.run_argv(argv)
     if result.eflags == 1:
         if not _get_no_diff_index(args):
             index_str = 'Index: %s\n%s\n' % (index, '=' * 67)
@@ -89,5 +102,7 @@ def diff_file(filnm, old_file, new_file, args):
     return result
 
 def same_contents(file1, file2):
-    result = shell.run_cmd('diff -q "%s" "%s"' % (file1, file2))
+    if not _use_gnu_diff():
+        return textdiff.same_contents(file1, file2)
+    result = shell.run_argv(['diff', '-q', file1, file2])
     return result.eflags == 0
@@ -16,34 +16,170 @@
 '''Provide utility functions for file manipulation'''
 
 import zlib
-import gzip
-import bz2
 import os
 
 from pyquilt_pkg import output
+from pyquilt_pkg import customization
+from pyquilt_pkg import profiling
+
+class _CommandReader(object):
+    '''A (read only) file object for the standard output of a command
+    (given as an argument list).  Problems reported by the command are
+    passed on when it is closed.'''
+    def __init__(self, argv):
+        import subprocess
+        profiling.count('subprocesses')
+        self._sub = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=os.name == 'posix')
+        self._fobj = self._sub.stdout
+        self.returncode = None
+    def read(self, size=-1):
+        return self._fobj.read(size)
+    def readline(self, size=-1):
+        return self._fobj.readline(size)
+    def readlines(self):
+        return self._fobj.readlines()
+    def __iter__(self):
+        return iter(self._fobj.readline, '')
+    def close(self):
+        if self._sub is None:
+            return
+        # finish reading so that the command isn't cut off part way through
+        while self._fobj.read(65536):
+            pass
+        self._fobj.close()
+        serr = self._sub.stderr.read()
+        self.returncode = self._sub.wait()
+        if self.returncode != 0:
+            output.error(serr)
+        self._sub = None
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+_XZ_FORMATS = {'.xz' : 'xz', '.lzma' : 'lzma'}
+
+# The compression modules are only imported when a compressed file is
+# met (which most commands never do)
+_LZMA = []
+
+def _get_lzma():
+    '''Return the lzma module (or None if the xz program is to be used
+    instead)'''
+    if not _LZMA:
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                lzma = None
+        _LZMA.append(lzma)
+    return _LZMA[0]
+
+def _open_decompressed(srcfile, ext):
+    if ext == '.gz':
+        import gzip
+        return gzip.open(srcfile, 'rb')
+    elif ext == '.bz2':
+        import bz2
+        return bz2.BZ2File(srcfile, 'r')
+    lzma = _get_lzma()
+    if lzma is not None:
+        return lzma.LZMAFile(srcfile, 'rb')
+    return _CommandReader(['xz', '--format=%s' % _XZ_FORMATS[ext], '-cd', srcfile])
+
+# Decompressed copies of compressed files (if QUILT_DECOMPRESS_CACHE is
+# set) are kept in the quilt meta-data directory.  Each is named after
+# the path of the compressed file and starts with a line giving the
+# identity of the file that it was made from.
+DECOMPRESS_CACHE_NAME = '.decompressed'
+
+def _get_cache_dir():
+    if customization.get_config('QUILT_DECOMPRESS_CACHE', '') not in ['1', 'y', 'yes', 'true']:
+        return None
+    pc_dir = customization.get_config('QUILT_PC', '.pc')
+    if not os.path.isdir(pc_dir):
+        return None
+    return os.path.abspath(os.path.join(pc_dir, DECOMPRESS_CACHE_NAME))
+
+def _get_identity(path):
+    try:
+        stat_data = os.stat(path)
+    except OSError:
+        return None
+    return '%d %d %r\n' % (stat_data.st_ino, stat_data.st_size, stat_data.st_mtime)
+
+def _open_cached(srcfile, ext, cache_dir):
+    identity = _get_identity(srcfile)
+    if identity is None:
+        return None
+    import hashlib
+    import shutil
+    import tempfile
+    entry = os.path.join(cache_dir, hashlib.sha1(os.path.abspath(srcfile)).hexdigest())
+    try:
+        fobj = open(entry, 'rb')
+    except IOError:
+        pass
+    else:
+        if fobj.readline() == identity:
+            return fobj
+        fobj.close()
+    # (Re)make the entry as the decompressed contents are read
+    try:
+        if not os.path.isdir(cache_dir):
+            os.mkdir(cache_dir)
+        fdesc, tmp_name = tempfile.mkstemp(dir=cache_dir)
+    except OSError:
+        return None
+    try:
+        with os.fdopen(fdesc, 'wb') as tmp_file:
+            tmp_file.write(identity)
+            with _open_decompressed(srcfile, ext) as from_fobj:
+                shutil.copyfileobj(from_fobj, tmp_file)
+                from_fobj.close()
+        fobj = open(tmp_name, 'rb')
+        if isinstance(from_fobj, _CommandReader) and from_fobj.returncode != 0:
+            # what could be decompressed (the error has been reported)
+            os.remove(tmp_name)
+        else:
+            os.rename(tmp_name, entry)
+    except (IOError, OSError, EOFError, zlib.error):
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        return None
+    fobj.readline()
+    return fobj
+
+def open_file(srcfile):
+    '''
+    Return a file object from which the contents of srcfile can be read
+    (a piece at a time) after applying decompression as indicated by
+    srcfile's suffix.
+    '''
+    _root, ext = os.path.splitext(srcfile)
+    if ext in ['.gz', '.bz2', '.xz', '.lzma']:
+        cache_dir = _get_cache_dir()
+        if cache_dir is not None:
+            fobj = _open_cached(srcfile, ext, cache_dir)
+            if fobj is not None:
+                return fobj
+        return _open_decompressed(srcfile, ext)
+    return open(srcfile)
 
 def get_file_contents(srcfile):
     '''
     Get the contents of filename to text after applying decompression
     as indicated by filename's suffix.
     '''
-    _root, ext = os.path.splitext(srcfile)
-    res = 0
-    if ext == '.gz':
-        return gzip.open(srcfile).read()
-    elif ext == '.bz2':
-        bz2f = bz2.BZ2File(srcfile, 'r')
-        text = bz2f.read()
-        bz2f.close()
-        return text
-    elif ext == '.xz':
-        res, text, serr = shell.run_cmd('xz -cd %s' % srcfile)
-    elif ext == '.lzma':
-        res, text, serr = shell.run_cmd('lzma -cd %s' % srcfile)
-    else:
-        return open(srcfile).read()
-    if res != 0:
-        output.error(serr)
+    fobj = open_file(srcfile)
+    try:
+        text = fobj.read()
+    finally:
+        fobj.close()
+    profiling.count('bytes read', len(text))
     return text
 
 def set_file_contents(filename, text):
@@ -51,15 +187,17 @@ def set_file_contents(filename, text):
     Set the contents of filename to text after applying compression
     as indicated by filename's suffix.
     '''
+    profiling.count('bytes written', len(text))
     _root, ext = os.path.splitext(filename)
-    res = 0
     if ext == '.gz':
+        import gzip
         try:
             gzip.open(filename, 'wb').write(text)
             return True
         except (IOError, zlib.error):
             return False
     elif ext == '.bz2':
+        import bz2
         try:
             bz2f = bz2.BZ2File(filename, 'w')
             text = bz2f.write(text)
@@ -67,19 +205,65 @@ def set_file_contents(filename, text):
             return True
         except IOError:
             return False
-    elif ext == '.xz':
-        res, text, serr = shell.run_cmd('xz -c', text)
-    elif ext == '.lzma':
-        res, text, serr = shell.run_cmd('lzma -c', text)
-    if res != 0:
-        output.error(serr)
-        return False
+    elif ext in _XZ_FORMATS and _get_lzma() is not None:
+        lzma = _get_lzma()
+        try:
+            with lzma.LZMAFile(filename, 'wb', format=lzma.FORMAT_XZ if ext == '.xz' else lzma.FORMAT_ALONE) as fobj:
+                fobj.write(text)
+            return True
+        except (IOError, lzma.LZMAError):
+            return False
+    elif ext in _XZ_FORMATS:
+        import subprocess
+        try:
+            with open(filename, 'wb') as fobj:
+                profiling.count('subprocesses')
+                sub = subprocess.Popen(['xz', '--format=%s' % _XZ_FORMATS[ext], '-c'], stdin=subprocess.PIPE, stdout=fobj, stderr=subprocess.PIPE, close_fds=os.name == 'posix')
+                _dummy, serr = sub.communicate(text)
+        except (IOError, OSError):
+            return False
+        if sub.returncode != 0:
+            output.error(serr)
+            return False
+        return True
     try:
         open(filename, 'w').write(text)
     except IOError:
         return False
     return True
 
+def write_file_atomically(filename, text):
+    '''
+    Replace the contents of filename with text in such a way that readers
+    see either the old or the new contents (never a partial file).
+    '''
+    import tempfile
+    profiling.count('bytes written', len(text))
+    target = os.path.realpath(filename)
+    try:
+        mode = os.stat(target).st_mode & 07777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0666 & ~umask
+    try:
+        fdesc, tmp_name = tempfile.mkstemp(prefix='.' + os.path.basename(target), dir=os.path.dirname(target))
+    except OSError:
+        return False
+    try:
+        tmp_file = os.fdopen(fdesc, 'w')
+        try:
+            tmp_file.write(text)
+        finally:
+            tmp_file.close()
+        os.chmod(tmp_name, mode)
+        os.rename(tmp_name, target)
+    except (IOError, OSError):
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        return False
+    return True
+
 def file_contents_equal(filename, text):
     '''Return whether filename exists and has contents equal to text'''
     if not os.path.isfile(filename):
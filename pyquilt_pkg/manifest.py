@@ -0,0 +1,143 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Record (in the quilt meta-data directory) the contents that the files
+of an applied patch had just after it was pushed or refreshed so that
+pop can tell whether they have been changed since without applying
+the patch again.  The record is kept next to the patch's backup
+directory (like its "~refresh" tag) as lines of:
+
+    <sha1 or -> <inode> <size> <mtime> <file name>
+
+preceded by a line giving the identity of the patch file.  The hash of
+a file is only worked out again if its stat data has changed.  The same
+format is used for the records of snapshots (see snapshots.py).
+'''
+
+import os
+import hashlib
+
+from pyquilt_pkg import fsutils
+from pyquilt_pkg import patchfns
+
+MANIFEST_SUFFIX = '~manifest'
+
+_FORMAT_LINE = 'pyquilt-manifest 1\n'
+_MISSING = '-'
+
+def manifest_file_name(patch):
+    return os.path.join(patchfns.QUILT_PC, patch + MANIFEST_SUFFIX)
+
+def get_stat_key(path):
+    try:
+        stat_data = os.stat(path)
+    except OSError:
+        return None
+    return '%d %d %r' % (stat_data.st_ino, stat_data.st_size, stat_data.st_mtime)
+
+def get_hash(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as fobj:
+            while True:
+                block = fobj.read(65536)
+                if not block:
+                    break
+                digest.update(block)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+def _missing_stat_key():
+    return ' '.join([_MISSING] * 3)
+
+def write_manifest_file(path, header, entries):
+    '''Write the manifest with the header line and the (file name, hash,
+    stat key) entries (None for the hash of a missing file and for an
+    unknown stat key) to path'''
+    lines = [_FORMAT_LINE, '%s\n' % header]
+    for filename, file_hash, stat_key in entries:
+        lines.append('%s %s %s\n' % (file_hash or _MISSING, stat_key or _missing_stat_key(), filename))
+    return fsutils.write_file_atomically(path, ''.join(lines))
+
+def read_manifest_file(path):
+    '''Return the header line and a map of file names to (hash, stat key)
+    pairs (see write_manifest_file()) of the manifest in path or None'''
+    try:
+        lines = open(path).read().splitlines()
+    except IOError:
+        return None
+    if len(lines) < 2 or lines[0] + '\n' != _FORMAT_LINE:
+        return None
+    entries = {}
+    for line in lines[2:]:
+        fields = line.split(' ', 4)
+        if len(fields) != 5:
+            return None
+        stat_key = ' '.join(fields[1:4])
+        entries[fields[4]] = (None if fields[0] == _MISSING else fields[0], None if stat_key == _missing_stat_key() else stat_key)
+    return (lines[1], entries)
+
+def file_unchanged(filename, entry):
+    '''Return True if the file is as recorded in the manifest entry'''
+    file_hash, stat_key = entry
+    if not os.path.exists(filename):
+        return file_hash is None
+    elif file_hash is None:
+        return False
+    return stat_key == get_stat_key(filename) or file_hash == get_hash(filename)
+
+def write_manifest(patch, sources=None):
+    '''Record the current state of the files in the (applied) patch.
+    sources maps file names to the paths that hold their state after the
+    patch (if not the files themselves, e.g. for files that later patches
+    change).  Return False if the record could not be written.'''
+    entries = []
+    for filename in patchfns.files_in_patch(patch):
+        path = sources.get(filename, filename) if sources else filename
+        file_hash = get_hash(path) if os.path.exists(path) else None
+        if file_hash is None and os.path.exists(path):
+            remove_manifest(patch)
+            return True
+        # the stat data of other paths says nothing about the file
+        stat_key = get_stat_key(path) if path == filename else None
+        entries.append((filename, file_hash, stat_key))
+    header = get_stat_key(patchfns.patch_file_name(patch)) or _missing_stat_key()
+    return write_manifest_file(manifest_file_name(patch), header, entries)
+
+def remove_manifest(patch):
+    try:
+        os.remove(manifest_file_name(patch))
+    except OSError:
+        pass
+
+def files_unchanged(patch, files=None):
+    '''Return True if the files in the applied patch (or the given ones
+    of them) are as they were recorded, False if any has changed and None
+    if it cannot be told (there is no record or the patch or its list of
+    files has changed since it was made).'''
+    data = read_manifest_file(manifest_file_name(patch))
+    if data is None:
+        return None
+    patch_stat_key, entries = data
+    if patch_stat_key != (get_stat_key(patchfns.patch_file_name(patch)) or _missing_stat_key()):
+        return None
+    if set(patchfns.files_in_patch(patch)) != set(entries):
+        return None
+    for filename in entries if files is None else files:
+        if not file_unchanged(filename, entries[filename]):
+            return False
+    return True
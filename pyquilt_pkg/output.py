@@ -15,7 +15,6 @@
 
 '''Output wrapper to address buffering issues, paging, etc.'''
 
-import subprocess
 import sys
 import os
 import errno
@@ -26,6 +25,7 @@ def start_pager():
     global _PAGER
     QUILT_PAGER = os.getenv('QUILT_PAGER', os.getenv('GIT_PAGER', 'less'))
     if QUILT_PAGER and QUILT_PAGER != 'cat':
+        import subprocess
         os.putenv('LESS', '-FRSX')
         _PAGER = subprocess.Popen([QUILT_PAGER], stdin=subprocess.PIPE)
 
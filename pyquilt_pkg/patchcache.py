@@ -0,0 +1,200 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Cache (in the quilt meta-data directory) of the information about patch
+files that is often needed without the rest of the patch: the paths of
+the files it changes, the extent of its header, its description and
+its per file diffstat.  Entries are keyed by the patch file's path and
+are only used while the file's identity (inode, size, modification time
+and, optionally, the hash of its contents) is unchanged.
+'''
+
+import os
+import json
+import atexit
+import hashlib
+import cStringIO
+
+from pyquilt_pkg import customization
+from pyquilt_pkg import fsutils
+from pyquilt_pkg import patchlib
+
+CACHE_NAME = '.patch_cache'
+
+FORMAT_VERSION = 1
+
+# The strip levels whose file paths are worked out when a patch is parsed
+# (others are added when they are first asked for)
+_STRIP_LEVELS = ['0', '1']
+
+# json deals in unicode: map the bytes of str values to it one for one
+def _to_json_str(text):
+    return None if text is None else text.decode('latin-1')
+
+def _fm_json_str(text):
+    return None if text is None else text.encode('latin-1')
+
+def _get_identity(path):
+    try:
+        stat_data = os.stat(path)
+    except OSError:
+        return None
+    return [stat_data.st_ino, stat_data.st_size, stat_data.st_mtime]
+
+def _use_hash():
+    return customization.get_config('QUILT_PATCH_CACHE_HASH', '') in ['1', 'y', 'yes', 'true']
+
+def _get_hash(path):
+    try:
+        return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+    except IOError:
+        return None
+
+class PatchInfo(object):
+    '''The cached information for one patch file (or the information for
+    a patch text, which is not cached and has no cache)'''
+    def __init__(self, path, entry, cache, text=None):
+        self.path = path
+        self._entry = entry
+        self._cache = cache
+        self._text = text
+    def _open(self):
+        return cStringIO.StringIO(self._text) if self._text is not None else fsutils.open_file(self.path)
+    def get_file_paths(self, strip_level=1):
+        strip_level = str(int(strip_level))
+        files = self._entry['files']
+        if strip_level not in files:
+            fobj = self._open()
+            try:
+                files[strip_level] = [_to_json_str(diff_plus.get_file_path(int(strip_level))) for diff_plus in patchlib.PatchReader(fobj)]
+            finally:
+                fobj.close()
+            if self._cache is not None:
+                self._cache.set_dirty()
+        return [_fm_json_str(path) for path in files[strip_level]]
+    def get_header(self):
+        if self._entry['header_end'] == 0:
+            return ''
+        fobj = self._open()
+        try:
+            return fobj.read(self._entry['header_end'])
+        finally:
+            fobj.close()
+    def get_description(self):
+        return _fm_json_str(self._entry['description'])
+    def get_diffstat_stats(self, strip_level=1):
+        paths = self.get_file_paths(strip_level)
+        stats_list = [patchlib.DiffStat.Stats.from_list(counts) for counts in self._entry['diffstat']]
+        return patchlib.DiffStat.PathStatsList([patchlib.DiffStat.PathStats(path, stats) for path, stats in zip(paths, stats_list)])
+
+def _make_entry(fobj):
+    # the patch is read a file at a time so big ones needn't fit in memory
+    reader = patchlib.PatchReader(fobj)
+    files = dict((strip_level, []) for strip_level in _STRIP_LEVELS)
+    diffstat = []
+    for diff_plus in reader:
+        for strip_level in list(files):
+            try:
+                files[strip_level].append(_to_json_str(diff_plus.get_file_path(int(strip_level))))
+            except patchlib.TooMayStripLevels:
+                del files[strip_level]
+        diffstat.append(list(diff_plus.get_diffstat_stats()))
+    header = reader.header
+    return {
+        'header_end' : 0 if header is None else len(str(header)),
+        'description' : _to_json_str('' if header is None else header.get_description()),
+        'files' : files,
+        'diffstat' : diffstat,
+    }
+
+class PatchCache(object):
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._flush_registered = False
+    def _load(self):
+        self._entries = {}
+        try:
+            data = json.load(open(self.path))
+        except (IOError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('version', None) == FORMAT_VERSION:
+            self._entries = data.get('entries', {})
+    def set_dirty(self):
+        self._dirty = True
+        if not self._flush_registered:
+            atexit.register(self.flush)
+            self._flush_registered = True
+    def get_info(self, path):
+        '''Return the information for the patch file at path (raises
+        IOError if it cannot be read)'''
+        if self._entries is None:
+            self._load()
+        key = _to_json_str(os.path.abspath(path))
+        identity = _get_identity(path)
+        entry = self._entries.get(key, None)
+        if entry is not None and identity is not None and entry['identity'] == identity:
+            if not _use_hash() or entry.get('hash', None) == _get_hash(path):
+                return PatchInfo(path, entry, self)
+        fobj = fsutils.open_file(path)
+        try:
+            entry = _make_entry(fobj)
+        finally:
+            fobj.close()
+        if identity is not None:
+            entry['identity'] = identity
+            entry['hash'] = _get_hash(path) if _use_hash() else None
+            self._entries[key] = entry
+            self.set_dirty()
+        return PatchInfo(path, entry, self)
+    def flush(self):
+        '''Write the cache to disk (dropping the entries for files that no
+        longer exist) if it has changed'''
+        if not self._dirty or self._entries is None:
+            return True
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return False
+        for key in list(self._entries):
+            if not os.path.exists(_fm_json_str(key)):
+                del self._entries[key]
+        text = json.dumps({'version' : FORMAT_VERSION, 'entries' : self._entries})
+        if not fsutils.write_file_atomically(self.path, text):
+            return False
+        self._dirty = False
+        return True
+
+_PATCH_CACHE = None
+
+def get_patch_cache():
+    '''Return the cache for the tree in the current directory'''
+    global _PATCH_CACHE
+    path = os.path.abspath(os.path.join(customization.get_config('QUILT_PC', '.pc'), CACHE_NAME))
+    if _PATCH_CACHE is None or _PATCH_CACHE.path != path:
+        if _PATCH_CACHE is not None:
+            _PATCH_CACHE.flush()
+        _PATCH_CACHE = PatchCache(path)
+    return _PATCH_CACHE
+
+def get_patch_info(path):
+    return get_patch_cache().get_info(path)
+
+def get_text_info(text):
+    '''Return the information for the patch text.  Texts (e.g. the diffs
+    that refresh makes) are rarely seen twice so this is not cached.'''
+    entry = _make_entry(cStringIO.StringIO(text))
+    entry['identity'] = None
+    return PatchInfo(None, entry, None, text)
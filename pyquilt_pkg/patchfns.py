@@ -20,15 +20,18 @@ Manage the patch directory and patch series file
 import os
 import re
 import sys
-import tempfile
+import stat
+import atexit
+import collections
 
 from pyquilt_pkg import customization
 from pyquilt_pkg import cmd_result
-from pyquilt_pkg import shell
-from pyquilt_pkg import putils
 from pyquilt_pkg import fsutils
-from pyquilt_pkg import backup
 from pyquilt_pkg import output
+from pyquilt_pkg import profiling
+
+# The modules only needed by some commands (shell, putils, backup and
+# tempfile) are imported when they are needed to keep start up quick.
 
 DB_VERSION = 2
 
@@ -52,6 +55,7 @@ def gen_tempfile(template=None, asdir=False):
         prefix = 'quilt'
     else:
         indir, prefix = os.path.split(template)
+    import tempfile
     if asdir:
         return tempfile.mkdtemp(prefix=prefix, dir=indir)
     else:
@@ -162,12 +166,14 @@ def create_db(dirpath=None):
 
 def quote_bre(string):
     'Quote a string for use in a basic regular expression.'
+    from pyquilt_pkg import shell
     result = shell.sed(['-e', 's:\([][^$/.*\\]\):\\\1:g'], string)
     assert result.eflags == 0
     return result.stdout
 
 def quote_bre(string):
     'Quote a string for use in anextended regular expression.'
+    from pyquilt_pkg import shell
     result = shell.sed(['-e', 's:\([][?{(|)}^$/.+*\\]\):\\\1:g'], string)
     assert result.eflags == 0
     return result.stdout
@@ -192,6 +198,467 @@ def patch_name_base(patchname):
 def patch_file_name(patch):
     return os.path.join(QUILT_PATCHES, patch)
 
+_SERIES_ENTRY = collections.namedtuple('_SERIES_ENTRY', ['name', 'args', 'lineno'])
+
+class MetadataTransaction(object):
+    '''Batch the changes made to the series file and the applied patches
+    stack so that each file is rewritten (atomically) at most once.  Used as
+    a context manager: the changes are written when the block exits, even
+    if an exception (e.g. KeyboardInterrupt) escapes it, as they record
+    what has already been done to the working tree (e.g. the patches
+    applied so far).  Nested uses join the outermost transaction.'''
+    def __init__(self):
+        self._depth = 0
+        self._enlisted = []
+        self.is_ok = True
+    def enlist(self, meta_file_index):
+        if meta_file_index not in self._enlisted:
+            self._enlisted.append(meta_file_index)
+    def commit(self):
+        for meta_file_index in self._enlisted:
+            if not meta_file_index.commit():
+                output.error('Failed to update %s\n' % meta_file_index.path)
+                self.is_ok = False
+        self._enlisted = []
+        return self.is_ok
+    def __enter__(self):
+        global _METADATA_TRANSACTION
+        self._depth += 1
+        _METADATA_TRANSACTION = self
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _METADATA_TRANSACTION
+        self._depth -= 1
+        if self._depth > 0:
+            return False
+        _METADATA_TRANSACTION = None
+        self.commit()
+        return False
+
+_METADATA_TRANSACTION = None
+
+def metadata_transaction():
+    '''Return the transaction that metadata changes should join'''
+    if _METADATA_TRANSACTION is not None:
+        return _METADATA_TRANSACTION
+    return MetadataTransaction()
+
+class _MetaFileIndex(object):
+    '''Base for the in memory indexes of quilt's meta data files.  The
+    file is parsed once and the result is reused until the file's identity
+    (inode, size or modification time) changes.'''
+    def __init__(self, path):
+        self.path = path
+        self._stat_key = None
+        self._loaded = False
+        self._present = False
+        self._pending = False
+        self.lines = []
+    @staticmethod
+    def _get_stat_key(path):
+        try:
+            stat_data = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(stat_data.st_mode):
+            return None
+        return (stat_data.st_ino, stat_data.st_size, stat_data.st_mtime)
+    def _parse(self):
+        raise NotImplementedError
+    def _load(self, stat_key):
+        self.lines = open(self.path).readlines() if stat_key is not None else []
+        profiling.count('reads of ' + os.path.basename(self.path))
+        self._parse()
+        self._present = stat_key is not None
+        self._stat_key = stat_key
+        self._loaded = True
+    def _check(self):
+        if self._pending:
+            return self
+        stat_key = self._get_stat_key(self.path)
+        if not self._loaded or stat_key != self._stat_key:
+            self._load(stat_key)
+        return self
+    def _store(self, lines, present=True):
+        '''Replace the file's contents (or remove the file if not present).
+        Inside a metadata transaction the write is deferred until it commits.'''
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        self.lines = lines
+        self._parse()
+        self._present = present
+        self._loaded = True
+        if _METADATA_TRANSACTION is not None:
+            self._pending = True
+            _METADATA_TRANSACTION.enlist(self)
+            return True
+        return self.commit()
+    def commit(self):
+        self._pending = False
+        try:
+            if self._present:
+                if not fsutils.write_file_atomically(self.path, ''.join(self.lines)):
+                    raise IOError
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+        except (IOError, OSError):
+            self.invalidate()
+            return False
+        self._stat_key = self._get_stat_key(self.path)
+        return True
+    def exists(self):
+        return self._check()._present
+    def invalidate(self):
+        self._loaded = False
+
+class SeriesIndex(_MetaFileIndex):
+    '''In memory index of the series file.'''
+    def __init__(self, path):
+        _MetaFileIndex.__init__(self, path)
+        self.entries = []
+        self._positions = {}
+    @staticmethod
+    def _parse_line(line, lineno):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            return None
+        name = fields[0]
+        remainder = line.strip()[len(name):]
+        return _SERIES_ENTRY(name, remainder.split('#', 1)[0].split(), lineno)
+    def _parse(self):
+        self.entries = []
+        self._positions = {}
+        for lineno, line in enumerate(self.lines):
+            entry = self._parse_line(line, lineno)
+            if entry is None:
+                continue
+            self._positions.setdefault(entry.name, len(self.entries))
+            self.entries.append(entry)
+    def __len__(self):
+        return len(self._check().entries)
+    def __contains__(self, patch):
+        return patch in self._check()._positions
+    def get_patches(self):
+        return [entry.name for entry in self._check().entries]
+    def get_position(self, patch):
+        return self._check()._positions.get(patch, None)
+    def get_entry(self, patch):
+        index = self.get_position(patch)
+        return None if index is None else self.entries[index]
+    def get_patches_before(self, patch):
+        index = self.get_position(patch)
+        if index is None:
+            return []
+        return [entry.name for entry in self.entries[:index]]
+    def get_patches_after(self, patch):
+        index = self.get_position(patch)
+        if index is None:
+            return self.get_patches()
+        return [entry.name for entry in self.entries[index + 1:]]
+    def get_patch_args(self, patch):
+        entry = self.get_entry(patch)
+        return None if entry is None else list(entry.args)
+    def find_candidates(self, patchname):
+        '''Return the names in the series that patchname could refer to'''
+        if patchname in self:
+            return [patchname]
+        matcher = _re_for_finding_patch_in_series(patchname)
+        return [entry.name for entry in self.entries if matcher.match(entry.name)]
+
+_SERIES_INDEX = None
+
+def get_series_index():
+    '''Return the (up to date) index for the current series file'''
+    global _SERIES_INDEX
+    if _SERIES_INDEX is None or _SERIES_INDEX.path != SERIES:
+        _SERIES_INDEX = SeriesIndex(SERIES)
+    return _SERIES_INDEX
+
+class AppliedStack(_MetaFileIndex):
+    '''In memory copy of the applied patches stack (.pc/applied-patches)
+    with each patch's position indexed for constant time lookups.  Changes
+    made through this class are written through to the file.'''
+    def __init__(self, path):
+        _MetaFileIndex.__init__(self, path)
+        self.patches = []
+        self._positions = {}
+        # changes whenever the stack is (re)read or changed
+        self.generation = 0
+        # patches removed from the stack by this process
+        self.removed = set()
+    def _parse(self):
+        self.generation += 1
+        self.patches = [line.strip() for line in self.lines if line.strip()]
+        self._positions = {}
+        for index, patch in enumerate(self.patches):
+            self._positions.setdefault(patch, index)
+    def __len__(self):
+        return len(self._check().patches)
+    def __contains__(self, patch):
+        return patch in self._check()._positions
+    def get_patches(self):
+        return list(self._check().patches)
+    def get_position(self, patch):
+        return self._check()._positions.get(patch, None)
+    def get_top(self):
+        self._check()
+        return self.patches[-1] if self.patches else None
+    def get_patches_before(self, patch):
+        index = self.get_position(patch)
+        if index is None:
+            return list(self.patches)
+        return self.patches[:index]
+    def get_patches_on_top_of(self, patch):
+        index = self.get_position(patch)
+        if index is None:
+            return []
+        return self.patches[index + 1:]
+    def _write(self, patches):
+        return self._store(['%s\n' % patch for patch in patches], present=bool(patches))
+    def push(self, patch):
+        self._check()
+        if _METADATA_TRANSACTION is not None:
+            return self._write(self.patches + [patch])
+        # Outside a transaction appending is cheaper than a rewrite
+        try:
+            open(self.path, 'a').write('%s\n' % patch)
+        except IOError:
+            self.invalidate()
+            return False
+        self.lines.append('%s\n' % patch)
+        self._parse()
+        self._present = True
+        self._stat_key = self._get_stat_key(self.path)
+        return True
+    def remove(self, patch):
+        self._check()
+        self.removed.add(patch)
+        return self._write([p for p in self.patches if p != patch])
+    def rename(self, from_name, to_name):
+        index = self.get_position(from_name)
+        if index is None:
+            return False
+        patches = list(self.patches)
+        patches[index] = to_name
+        return self._write(patches)
+
+_APPLIED_STACK = None
+
+def get_applied_stack():
+    '''Return the (up to date) stack of applied patches'''
+    global _APPLIED_STACK
+    if _APPLIED_STACK is None or _APPLIED_STACK.path != DB:
+        _APPLIED_STACK = AppliedStack(DB)
+    return _APPLIED_STACK
+
+class FileOwnerIndex(object):
+    '''Map of each file to the applied patches (in stack order) that hold
+    a backup of it.  The map is kept on disk (under QUILT_PC) alongside the
+    applied stack it was built for.  Patches pushed or popped since then
+    are accounted for incrementally by scanning (or dropping) just their
+    backup directories and anything else triggers a full rebuild from the
+    backup directories.  The identity of each patch's backup directory is
+    recorded too so that a patch popped and pushed again (perhaps with a
+    different set of files) by commands that didn't use the index is
+    scanned again.  While the in memory copy has unsaved changes the on
+    disk copy is removed (so that an interrupted command leaves nothing
+    stale behind) and it is written back when the program exits.'''
+    MAGIC = '# pyquilt file owners 2\n'
+    def __init__(self, path):
+        self.path = path
+        self._applied = None
+        self._identities = None
+        self._owners = None
+        self._generation = None
+        # whether other processes may have changed the backup directories
+        self._verify_all = True
+        self._dirty = False
+        self._flush_registered = False
+        self._stat_key = None
+    @staticmethod
+    def _get_identity(patch):
+        '''Return the identity of the patch's backup directory (which is
+        made afresh when the patch is pushed)'''
+        path = os.path.join(QUILT_PC, patch)
+        fields = []
+        for entry in [path, os.path.join(path, '.timestamp')]:
+            try:
+                stat_data = os.stat(entry)
+            except OSError:
+                fields.append('-')
+            else:
+                fields.append('%d:%r' % (stat_data.st_ino, stat_data.st_mtime))
+        return ','.join(fields)
+    def _read(self):
+        self._stat_key = _MetaFileIndex._get_stat_key(self.path)
+        try:
+            lines = open(self.path).readlines()
+        except IOError:
+            return False
+        profiling.count('reads of ' + os.path.basename(self.path))
+        if len(lines) < 3 or lines[0] != self.MAGIC or not lines[1].startswith('# applied:'):
+            return False
+        if not lines[2].startswith('# identities:'):
+            return False
+        self._applied = lines[1][len('# applied:'):].split()
+        identities = lines[2][len('# identities:'):].split()
+        if len(identities) != len(self._applied):
+            return False
+        self._identities = dict(zip(self._applied, identities))
+        self._owners = {}
+        for line in lines[3:]:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2:
+                return False
+            self._owners[fields[0]] = fields[1:]
+        return True
+    def _set_dirty(self):
+        if self._dirty:
+            return
+        self._dirty = True
+        if os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        if not self._flush_registered:
+            atexit.register(self.flush)
+            self._flush_registered = True
+    def _drop_patches(self, patches):
+        dropped = set(patches)
+        for filename in list(self._owners):
+            owners = [patch for patch in self._owners[filename] if patch not in dropped]
+            if owners:
+                self._owners[filename] = owners
+            else:
+                del self._owners[filename]
+    def _scan_patches(self, patches):
+        for patch in patches:
+            self._identities[patch] = self._get_identity(patch)
+            for filename in files_in_patch(patch):
+                self._owners.setdefault(filename, []).append(patch)
+    def _rescan_patches(self, patches):
+        '''Scan the backup directories of the (applied) patches again'''
+        self._drop_patches(patches)
+        self._scan_patches(patches)
+        applied_stack = get_applied_stack()
+        for owners in self._owners.values():
+            owners.sort(key=applied_stack.get_position)
+    def _check(self):
+        applied_stack = get_applied_stack()
+        applied_stack._check()
+        if self._owners is not None and self._generation == applied_stack.generation:
+            return self
+        applied = applied_stack.get_patches()
+        if self._owners is None and not self._read():
+            self._applied = []
+            self._identities = {}
+            self._owners = {}
+        # patches removed (and perhaps pushed again) by this process or
+        # (when the index is first used) any changed by other processes
+        verify = set(applied) if self._verify_all else applied_stack.removed
+        self._verify_all = False
+        applied_stack.removed = set()
+        common = 0
+        while common < min(len(applied), len(self._applied)) and applied[common] == self._applied[common]:
+            common += 1
+        changed = applied != self._applied
+        if common == 0:
+            self._owners = {}
+        else:
+            self._drop_patches(self._applied[common:])
+        stale = [patch for patch in applied[:common] if patch in verify and self._identities.get(patch) != self._get_identity(patch)]
+        if stale:
+            self._rescan_patches(stale)
+        self._scan_patches(applied[common:])
+        self._identities = dict((patch, self._identities[patch]) for patch in applied)
+        self._applied = applied
+        self._generation = applied_stack.generation
+        if changed or stale:
+            self._set_dirty()
+        return self
+    def flush(self):
+        '''Write any unsaved changes to disk'''
+        if not self._dirty or self._owners is None:
+            return True
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return False
+        lines = [self.MAGIC, '# applied: %s\n' % ' '.join(self._applied)]
+        lines.append('# identities: %s\n' % ' '.join(self._identities[patch] for patch in self._applied))
+        for filename in sorted(self._owners):
+            lines.append('\t'.join([filename] + self._owners[filename]) + '\n')
+        if not fsutils.write_file_atomically(self.path, ''.join(lines)):
+            return False
+        self._dirty = False
+        self._stat_key = _MetaFileIndex._get_stat_key(self.path)
+        return True
+    def revalidate(self):
+        '''Forget the in memory copy if another process has changed the
+        index since it was read or written (only long lived processes
+        need to worry about this)'''
+        if not self._dirty and _MetaFileIndex._get_stat_key(self.path) != self._stat_key:
+            self._owners = None
+        self._generation = None
+        self._verify_all = True
+    def get_owners(self, filename):
+        return list(self._check()._owners.get(filename, []))
+    def is_owner(self, patch, filename):
+        return patch in self._check()._owners.get(filename, [])
+    def next_owner(self, patch, filename):
+        '''Return the first patch applied on top of patch that holds a
+        backup of filename (or None)'''
+        applied_stack = get_applied_stack()
+        position = applied_stack.get_position(patch)
+        if position is None:
+            return None
+        for owner in self._check()._owners.get(filename, []):
+            if applied_stack.get_position(owner) > position:
+                return owner
+        return None
+    def add_file(self, patch, filename):
+        owners = self._check()._owners.setdefault(filename, [])
+        if patch in owners:
+            return
+        owners.append(patch)
+        applied_stack = get_applied_stack()
+        owners.sort(key=applied_stack.get_position)
+        self._note_change(patch)
+    def remove_file(self, patch, filename):
+        owners = self._check()._owners.get(filename, [])
+        if patch not in owners:
+            return
+        owners.remove(patch)
+        if not owners:
+            del self._owners[filename]
+        self._note_change(patch)
+    def _note_change(self, patch):
+        if patch in self._identities:
+            self._identities[patch] = self._get_identity(patch)
+        self._set_dirty()
+    def rename_patch(self, from_name, to_name):
+        if self._owners is None and not self._read():
+            return
+        if from_name in self._applied:
+            self._applied[self._applied.index(from_name)] = to_name
+            self._identities[to_name] = self._identities.pop(from_name)
+        for owners in self._owners.values():
+            if from_name in owners:
+                owners[owners.index(from_name)] = to_name
+        self._set_dirty()
+
+_FILE_OWNER_INDEX = None
+
+def get_file_owner_index():
+    '''Return the index of which applied patches hold backups of which files'''
+    global _FILE_OWNER_INDEX
+    path = os.path.join(QUILT_PC, '.file_owners')
+    if _FILE_OWNER_INDEX is None or _FILE_OWNER_INDEX.path != path:
+        _FILE_OWNER_INDEX = FileOwnerIndex(path)
+    return _FILE_OWNER_INDEX
+
+def _write_series_lines(lines):
+    return get_series_index()._store(lines)
+
 def find_first_patch():
     patches = _get_series()
     if len(patches) > 0:
@@ -205,47 +672,34 @@ def find_first_patch():
 # Also remove -R if present.
 def change_db_strip_level(level, patch):
     level = '' if level == '-p1' else level
-    if os.path.exists(SERIES):
-        rec = re.compile(r'^(' + re.escape(patch) + r')(\s+.*)?\n$')
-        lines = open(SERIES).readlines()
-        for index in range(len(lines)):
-            match = rec.match(lines[index])
-            if match:
-                if not match.group(2):
-                    if level:
-                        lines[index] = '%s %s\n' % (match.group(1), level)
-                    open(SERIES, 'w').writelines(lines)
-                    break
-                parts = match.group(2).split('#', 1)
-                patch_args = parts[0].split()
-                if '-R' in patch_args:
-                    patch_args.remove('-R')
-                changed = False
-                for aindex in range(len(patch_args)):
-                    if patch_args[aindex].startswith('-p'):
-                        patch_args[aindex] = level
-                        changed = True
-                if not changed and level:
-                    patch_args.append(level)
-                if len(parts) == 2:
-                    patch_args.append('#' + parts[1])
-                pa_str = ' '.join(patch_args).strip()
-                if pa_str:
-                    lines[index] = '%s %s\n' % (match.group(1), pa_str)
-                else:
-                    lines[index] = '%s\n' % match.group(1)
-                open(SERIES, 'w').writelines(lines)
-                break
-    else:
+    if not os.path.exists(SERIES):
+        return False
+    series_index = get_series_index()
+    entry = series_index.get_entry(patch)
+    if entry is None:
         return False
+    line = series_index.lines[entry.lineno]
+    parts = line.strip()[len(entry.name):].split('#', 1)
+    patch_args = [arg for arg in entry.args if arg != '-R']
+    changed = False
+    for aindex in range(len(patch_args)):
+        if patch_args[aindex].startswith('-p'):
+            patch_args[aindex] = level
+            changed = True
+    if not changed and level:
+        patch_args.append(level)
+    if len(parts) == 2:
+        patch_args.append('#' + parts[1])
+    pa_str = ' '.join([arg for arg in patch_args if arg]).strip()
+    new_line = '%s %s\n' % (entry.name, pa_str) if pa_str else '%s\n' % entry.name
+    if new_line == line:
+        return True
+    lines = list(series_index.lines)
+    lines[entry.lineno] = new_line
+    return _write_series_lines(lines)
 
 def patch_in_series(patch):
-    if os.path.isfile(SERIES):
-        rec = re.compile(r'^' + re.escape(patch) + r'(\s.*)?$')
-        for line in open(SERIES).readlines():
-            if rec.match(line):
-                return True
-    return False
+    return patch in get_series_index()
 
 def _canonical_patchname(patchname):
     subdir_part = ('..' + os.sep) * SUBDIR_DOWN
@@ -267,20 +721,10 @@ def find_patch(patchname):
             output.error('%s is not a regular file\n' % SERIES)
             return False
         can_pacthname = _canonical_patchname(patchname)
-        matcher = _re_for_finding_patch_in_series(can_pacthname)
-        candidates = []
-        for line in open(SERIES).readlines():
-            reres = matcher.match(line)
-            if reres:
-                candidates.append(reres.group(1))
+        candidates = get_series_index().find_candidates(can_pacthname)
         if len(candidates) == 1:
             return candidates[0]
         elif len(candidates) > 1:
-            for candidate in candidates:
-                # We may have an exact match, which overrides
-                # extension expansion.  Otherwise we're confused
-                if candidate == can_pacthname:
-                    return candidate
             output.error('%s has too many matches in series:\n' % patchname)
             for candidate in candidates:
                  output.error('\t%s\n' % candidate)
@@ -290,24 +734,14 @@ def find_patch(patchname):
     return False
 
 def cat_series():
-    if not os.path.exists(SERIES):
-       return []
-    ignore_line_cre = re.compile('(^#.*)|(^\s*$)')
-    upto_white_space_cre = re.compile('^\s*(\S+).*')
-    result = []
-    for line in open(SERIES).readlines():
-        if ignore_line_cre.match(line):
-            continue
-        result.append(upto_white_space_cre.match(line).group(1))
-    return result
+    return get_series_index().get_patches()
 
 def top_patch():
-    if not os.path.isfile(DB):
+    applied_stack = get_applied_stack()
+    if not applied_stack.exists():
         return ''
-    applied_lines = open(DB).readlines()
-    if len(applied_lines):
-        return applied_lines[-1].strip()
-    return False
+    top = applied_stack.get_top()
+    return top if top else False
 
 def find_top_patch():
     result = top_patch()
@@ -316,24 +750,13 @@ def find_top_patch():
     return result
 
 def is_applied(patchname):
-    if os.path.isfile(DB):
-        for line in open(DB).readlines():
-            if line.strip() == patchname:
-                return True
-    return False
+    return patchname in get_applied_stack()
 
 def applied_patches():
-    if not os.path.exists(DB):
-        return []
-    return [line.strip() for line in open(DB).readlines()]
+    return get_applied_stack().get_patches()
 
 def applied_before(patch):
-    patches = applied_patches()
-    if not patches:
-        return []
-    if not patch in patches:
-        return patches
-    return patches[:patches.index(patch)]
+    return get_applied_stack().get_patches_before(patch)
 
 def find_patch_in_series(name=None):
     if name:
@@ -355,37 +778,22 @@ def find_applied_patch(patchname=None):
     else:
         return find_top_patch()
 
-def _extract_patch_name(line):
-    if line[0] == '#':
-        return ''
-    return line.strip()
-
-def _rename_in_xxxx(from_name, to_name, xxxx):
-    tmpfile = os.tmpfile()
-    if not tempfile:
-        return False
-    rec = re.compile(r'^(' + re.escape(from_name) + ').*')
-    change_made = False
-    for line in open(xxxx).readlines():
-        if not change_made and rec.match(line):
-            tmpfile.write(re.sub(re.escape(from_name), to_name, line))
-            change_made = True
-        else:
-            tmpfile.write(line)
-    if not change_made:
-        return False
-    try:
-        tmpfile.seek(0)
-        open(xxxx, 'w').write(tmpfile.read())
-        return True
-    except IOError:
-        return False
-
 def rename_in_series(from_name, to_name):
-    return _rename_in_xxxx(from_name, to_name, xxxx=SERIES)
+    series_index = get_series_index()
+    entry = series_index.get_entry(from_name)
+    if entry is None:
+        return False
+    lines = list(series_index.lines)
+    line = lines[entry.lineno]
+    index = line.index(entry.name)
+    lines[entry.lineno] = line[:index] + to_name + line[index + len(entry.name):]
+    return _write_series_lines(lines)
 
 def rename_in_db(from_name, to_name):
-    return _rename_in_xxxx(from_name, to_name, xxxx=DB)
+    if not get_applied_stack().rename(from_name, to_name):
+        return False
+    get_file_owner_index().rename_patch(from_name, to_name)
+    return True
 
 def backup_dir_name(patch):
     return os.path.join(QUILT_PC, patch)
@@ -395,29 +803,32 @@ def backup_file_name(patch, *args):
         return os.path.join(QUILT_PC, patch, args[0])
     return [os.path.join(QUILT_PC, patch, filn) for filn in args]
 
+def backup_store_dir():
+    '''Return the path of the content store that backup files are to be
+    linked into (or None if QUILT_BACKUP_STORE is not set)'''
+    if customization.get_config('QUILT_BACKUP_STORE', '') in ['1', 'y', 'yes', 'true']:
+        from pyquilt_pkg import backup
+        return os.path.join(QUILT_PC, backup.OBJECTS_DIR)
+    return None
+
+def collect_backup_garbage():
+    '''Remove the contents from the store that are no longer backed up'''
+    from pyquilt_pkg import backup
+    return backup.collect_garbage(os.path.join(QUILT_PC, backup.OBJECTS_DIR))
+
 def _get_series():
-    result = []
-    if os.path.isfile(SERIES):
-        for line in open(SERIES).readlines():
-            patch_name = _extract_patch_name(line)
-            if patch_name:
-                result.append(patch_name)
-    return result
+    return get_series_index().get_patches()
 
 def patches_before(patch):
     """Return list of patches in series before the nominated patch"""
-    full_series = _get_series()
-    if not patch or patch not in full_series:
+    if not patch:
         return []
-    patch_index = full_series.index(patch)
-    return full_series[:patch_index]
+    return get_series_index().get_patches_before(patch)
 
 def patches_after(patch):
-    full_series = _get_series()
-    if not patch or patch not in full_series:
-        return full_series
-    patch_index = full_series.index(patch)
-    return full_series[patch_index+1:]
+    if not patch:
+        return _get_series()
+    return get_series_index().get_patches_after(patch)
 
 def patch_after(patch):
     patches_after_patch = patches_after(patch)
@@ -427,16 +838,16 @@ def patch_after(patch):
         return ''
 
 def insert_in_series(patch, patch_args=None, before=None):
+    return insert_patches_in_series([patch], patch_args, before)
+
+def insert_patches_in_series(patches, patch_args=None, before=None):
+    '''Insert the patches (in the given order) into the series with a
+    single rewrite of the series file'''
     if os.path.exists(SERIES) and not os.path.isfile(SERIES):
         output.error('%s is not a regular file\n' % SERIES)
         sys.exit(cmd_result.ERROR)
     if before is None:
         before = patch_after(top_patch())
-    try:
-        tmpfile = os.tmpfile()
-    except OSError:
-        output.error('Unable to create temporary file\n')
-        sys.exit(cmd_result.ERROR)
     series_dir = os.path.dirname(SERIES)
     if not os.path.isdir(series_dir):
         try:
@@ -445,86 +856,42 @@ def insert_in_series(patch, patch_args=None, before=None):
             output.error('Could not create directory %s\n' % series_dir)
             sys.exit(cmd_result.ERROR)
     if isinstance(patch_args, str):
-        new_line = patch if not patch_args else ' '.join([patch, patch_args])
-    else:
-        new_line = patch if not patch_args else ' '.join([patch] + patch_args)
-    if before:
-        rec = re.compile(r'^' + re.escape(before) + r'(\s.*)?$')
-        series_lines = open(SERIES).readlines()
-        num_lines = len(series_lines)
-        index = 0
-        while index < num_lines:
-            if rec.match(series_lines[index]):
-                tmpfile.write('%s\n' % new_line)
-                break
-            else:
-                tmpfile.write(series_lines[index])
-                index += 1
-        while index < num_lines:
-            tmpfile.write(series_lines[index])
-            index += 1
+        patch_args = [patch_args] if patch_args else []
+    elif not patch_args:
+        patch_args = []
+    new_lines = ['%s\n' % ' '.join([patch] + patch_args) for patch in patches]
+    series_index = get_series_index()
+    lines = list(series_index._check().lines)
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    entry = series_index.get_entry(before) if before else None
+    if entry is not None:
+        lines[entry.lineno:entry.lineno] = new_lines
     else:
-        if os.path.exists(SERIES):
-            for line in open(SERIES).readlines():
-                tmpfile.write(line)
-        tmpfile.write('%s\n' % new_line)
-    try:
-        tmpfile.seek(0)
-        open(SERIES, 'w').write(tmpfile.read())
-        return True
-    except IOError:
-        return False
+        lines += new_lines
+    return _write_series_lines(lines)
 
 def remove_from_series(patch):
-    rec = re.compile(r'^(' + re.escape(patch) + ').*')
-    lines = []
-    for line in open(SERIES).readlines():
-        if not rec.match(line):
-            lines.append(line)
-    try:
-        open(SERIES, 'w').writelines(lines)
+    series_index = get_series_index()
+    if series_index.get_position(patch) is None:
         return True
-    except IOError:
-        return False
+    lines = list(series_index.lines)
+    for entry in reversed(series_index.entries):
+        if entry.name == patch:
+            del lines[entry.lineno]
+    return _write_series_lines(lines)
 
 def patches_on_top_of(patch):
-    seen = False
-    patches = []
-    for entry in open(DB).readlines():
-        if seen:
-            patches.append(entry.strip())
-        elif entry.strip() == patch:
-            seen = True
-    return patches
+    return get_applied_stack().get_patches_on_top_of(patch)
 
 def next_patch_for_file(patch, filnm):
-    patches_on_top = patches_on_top_of(patch)
-    for patch in patches_on_top:
-        if os.path.isfile(backup_file_name(patch, filnm)):
-            return patch
-    return None
+    return get_file_owner_index().next_owner(patch, filnm)
 
 def add_to_db(patch):
-    try:
-        open(DB, 'a').write('%s\n' % patch)
-        return True
-    except IOError:
-        return False
+    return get_applied_stack().push(patch)
 
 def remove_from_db(patch):
-    rec = re.compile(r'^(' + re.escape(patch) + ').*')
-    lines = []
-    for line in open(DB).readlines():
-        if not rec.match(line):
-            lines.append(line)
-    try:
-        if not lines:
-            os.remove(DB)
-        else:
-            open(DB, 'w').writelines(lines)
-        return True
-    except IOError:
-        return False
+    return get_applied_stack().remove(patch)
 
 def find_patch_file(name):
     """Find the patch file with the given name"""
@@ -546,6 +913,8 @@ def files_in_patch(patch):
     return []
 
 def file_in_patch(filename, patch):
+    if is_applied(patch):
+        return get_file_owner_index().is_owner(patch, filename)
     return os.path.isfile(os.path.join(QUILT_PC, patch, filename))
 
 def file_names_in_patch(patch):
@@ -554,6 +923,7 @@ def file_names_in_patch(patch):
         patch_level = patch_strip_level(patch)
         if patch_level == 'ab':
             patch_level = 1
+        from pyquilt_pkg import putils
         return putils.get_patch_files(patch_file, strip_level=patch_level)
     return []
 
@@ -567,21 +937,13 @@ def files_in_patch_ordered(patch):
     return files + sorted(files_in_dir)
 
 def patch_args(patch):
-    if os.path.isfile(SERIES):
-        rec = re.compile(r'^' + re.escape(patch) + r'(\s+.*)\n$')
-        for line in open(SERIES).readlines():
-            match = rec.match(line)
-            if match:
-                p_seen = False
-                args = []
-                for arg in match.group(1).split('#')[0].split():
-                    args.append(arg)
-                    if arg[:2] == '-p':
-                        p_seen = True
-                if not p_seen:
-                    args.append('-p1')
-                return args
-    return ['-p1']
+    args = get_series_index().get_patch_args(patch)
+    if not args:
+        return ['-p1']
+    for arg in args:
+        if arg[:2] == '-p':
+            return args
+    return args + ['-p1']
 
 def patch_strip_level(patch):
     for arg in patch_args(patch):
@@ -590,13 +952,17 @@ def patch_strip_level(patch):
     return '1'
 
 def patch_header(patch_filnm):
+    from pyquilt_pkg import putils
     return putils.get_patch_hdr(patch_filnm)
 
 def first_modified_by(filename, patches):
     if not patches:
         patches = applied_patches()
+    owners = get_file_owner_index().get_owners(filename)
     for patch in patches:
-        if os.path.isfile(os.path.join(QUILT_PC, patch, filename)):
+        if patch in owners:
+            return patch
+        elif not is_applied(patch) and os.path.isfile(os.path.join(QUILT_PC, patch, filename)):
             return patch
     return None
 
@@ -604,6 +970,8 @@ def apply_patch_temporarily(workdir, patch, files=None):
     patch_file = patch_file_name(patch)
     args = patch_args(patch)
     srcdir = os.path.join(QUILT_PC, patch)
+    from pyquilt_pkg import backup
+    from pyquilt_pkg import putils
     if not backup.restore(srcdir, to_dir=workdir, filelist=files, keep=True):
         output.error('Failed to copy files to temporary directory\n')
         return False
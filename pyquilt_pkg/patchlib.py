@@ -16,9 +16,12 @@
 '''Classes and functions for operations on patch files'''
 
 import collections
+import email
+import array
 import re
 import os
-import email
+
+from pyquilt_pkg import profiling
 
 # Useful named tuples to make code clearer
 _CHUNK = collections.namedtuple('_CHUNK', ['start', 'length'])
@@ -109,6 +112,12 @@ class DiffStat(object):
             for key in DiffStat._ORDERED_KEYS:
                 self._counts[key] = 0
             assert len(self._counts) == len(DiffStat._ORDERED_KEYS)
+        @staticmethod
+        def from_list(counts):
+            stats = DiffStat.Stats()
+            for key, count in zip(DiffStat._ORDERED_KEYS, counts):
+                stats._counts[key] = count
+            return stats
         def __add__(self, other):
             result = DiffStat.Stats()
             for key in DiffStat._ORDERED_KEYS:
@@ -204,16 +213,80 @@ class DiffStat(object):
                 string += '\n'
             return string
 
+class _LineStore(object):
+    '''The text of a sequence of lines and the offsets in it of the start
+    of each of them (and of its end)'''
+    __slots__ = ('text', 'offsets')
+    def __init__(self, lines, text=None):
+        self.text = ''.join(lines) if text is None else text
+        self.offsets = array.array('L', [0])
+        append = self.offsets.append
+        total = 0
+        for line in lines:
+            total += len(line)
+            append(total)
+
+class _LineView(object):
+    '''The lines from start up to (but not including) end in a _LineStore'''
+    __slots__ = ('store', 'start', 'end')
+    def __init__(self, store, start, end):
+        self.store = store
+        self.start = start
+        self.end = end
+    def __len__(self):
+        return self.end - self.start
+    def __iter__(self):
+        return iter(self.get_lines())
+    def __str__(self):
+        return self.store.text[self.store.offsets[self.start]:self.store.offsets[self.end]]
+    def get_lines(self):
+        text, offsets = self.store.text, self.store.offsets
+        return [text[offsets[i]:offsets[i + 1]] for i in xrange(self.start, self.end)]
+
+class _LineBuffer(list):
+    '''A list of lines for the parsers to work on whose (simple) slices
+    are views of its lines in a shared _LineStore rather than copies of
+    them.  So the objects made by the parsers hold a few numbers instead
+    of their own lists of strings.'''
+    def __init__(self, lines, text=None):
+        list.__init__(self, lines)
+        self.store = _LineStore(self, text)
+    def __getslice__(self, start, end):
+        start = max(start, 0)
+        end = max(min(end, len(self)), start)
+        return _LineView(self.store, start, end)
+
 class _Lines(object):
+    # The lines are kept as a view (if that's what they were made from)
+    # until they are changed
+    __slots__ = ('_lines', '_view')
     def __init__(self, contents=None):
+        self._view = None
         if contents is None:
-            self.lines = list()
+            self._lines = list()
         elif isinstance(contents, str):
-            self.lines = contents.splitlines(True)
+            self._lines = contents.splitlines(True)
+        elif isinstance(contents, _LineView):
+            self._lines = None
+            self._view = contents
         else:
-            self.lines = list(contents)
+            self._lines = list(contents)
+    @property
+    def lines(self):
+        '''The list of lines (which may be changed)'''
+        if self._lines is None:
+            self._lines = self._view.get_lines()
+            self._view = None
+        return self._lines
+    @lines.setter
+    def lines(self, lines):
+        self._lines = lines
+        self._view = None
+    def get_lines(self):
+        '''Return a list of the lines (not to be changed)'''
+        return self._lines if self._lines is not None else self._view.get_lines()
     def __str__(self):
-        return ''.join(self.lines)
+        return ''.join(self._lines) if self._lines is not None else str(self._view)
     def append(self, data):
         if isinstance(data, str):
             self.lines += data.splitlines(True)
@@ -310,11 +383,13 @@ class FilePathPlus(object):
         return FilePathPlus(path=path, status=status, expath=None)
 
 class Preamble(_Lines):
+    __slots__ = ('preamble_type', 'file_data', 'extras')
     subtypes = list()
     @staticmethod
     def get_preamble_at(lines, index, raise_if_malformed, exclude_subtypes_in=set()):
+        line = lines[index]
         for subtype in Preamble.subtypes:
-            if subtype in exclude_subtypes_in:
+            if subtype in exclude_subtypes_in or not line.startswith(subtype.PREFIX):
                 continue
             preamble, next_index = subtype.get_preamble_at(lines, index, raise_if_malformed)
             if preamble is not None:
@@ -355,6 +430,8 @@ class Preamble(_Lines):
         return None
 
 class GitPreamble(Preamble):
+    __slots__ = ()
+    PREFIX = 'diff'
     DIFF_CRE = re.compile("^diff\s+--git\s+({0})\s+({1})$".format(_PATH_RE_STR, _PATH_RE_STR))
     EXTRAS_CRES = {
         'old mode' : re.compile('^(old mode)\s+(\d*)$'),
@@ -379,16 +456,16 @@ class GitPreamble(Preamble):
         extras = {}
         next_index = index + 1
         while next_index < len(lines):
-            found = False
-            for cre in GitPreamble.EXTRAS_CRES:
-                match = GitPreamble.EXTRAS_CRES[cre].match(lines[next_index])
+            line = lines[next_index]
+            match = None
+            for cre in GitPreamble.EXTRAS_CRES_BY_CHAR.get(line[:1], ()):
+                match = cre.match(line)
                 if match:
-                    extras[match.group(1)] = match.group(2)
-                    next_index += 1
-                    found = True
                     break
-            if not found:
+            if not match:
                 break
+            extras[match.group(1)] = match.group(2)
+            next_index += 1
         return (GitPreamble(lines[index:next_index], _PAIR(file1, file2), extras), next_index)
     def __init__(self, lines, file_data, extras=None):
         if extras is None:
@@ -409,9 +486,16 @@ class GitPreamble(Preamble):
                 return strip(self.extras[key])
         return None
 
+# Only the extras' expressions for lines starting with their first letter are tried
+GitPreamble.EXTRAS_CRES_BY_CHAR = {}
+for _key, _cre in GitPreamble.EXTRAS_CRES.items():
+    GitPreamble.EXTRAS_CRES_BY_CHAR.setdefault(_key[0], []).append(_cre)
+
 Preamble.subtypes.append(GitPreamble)
 
 class DiffPreamble(Preamble):
+    __slots__ = ()
+    PREFIX = 'diff'
     CRE = re.compile('^diff(\s.+)\s+({0})\s+({1})$'.format(_PATH_RE_STR, _PATH_RE_STR))
     @staticmethod
     def get_preamble_at(lines, index, raise_if_malformed):
@@ -431,6 +515,8 @@ class DiffPreamble(Preamble):
 Preamble.subtypes.append(DiffPreamble)
 
 class IndexPreamble(Preamble):
+    __slots__ = ()
+    PREFIX = 'Index:'
     FILE_RCE = re.compile("^Index:\s+({0})(.*)$".format(_PATH_RE_STR))
     SEP_RCE = re.compile("^==*$")
     @staticmethod
@@ -521,6 +607,7 @@ class Preambles(list):
         return None
 
 class DiffHunk(_Lines):
+    __slots__ = ('before', 'after')
     def __init__(self, lines, before, after):
         _Lines.__init__(self, lines)
         self.before = before
@@ -535,7 +622,9 @@ class DiffHunk(_Lines):
 class Diff(object):
     subtypes = list()
     @staticmethod
-    def _get_file_data_at(cre, lines, index):
+    def _get_file_data_at(prefix, cre, lines, index):
+        if not lines[index].startswith(prefix):
+            return (None, index)
         match = cre.match(lines[index])
         if not match:
             return (None, index)
@@ -626,32 +715,35 @@ class Diff(object):
             return None
 
 class UnifiedDiffHunk(DiffHunk):
+    __slots__ = ()
     def __init__(self, lines, before, after):
         DiffHunk.__init__(self, lines, before, after)
     def _process_tws(self, fix=False):
         bad_lines = list()
         after_count = 0
-        for index in range(len(self.lines)):
-            if self.lines[index].startswith('+'):
+        lines = self.get_lines()
+        for index in range(len(lines)):
+            if lines[index].startswith('+'):
                 after_count += 1
-                repl_line = _trim_trailing_ws(self.lines[index])
-                if len(repl_line) != len(self.lines[index]):
+                repl_line = _trim_trailing_ws(lines[index])
+                if len(repl_line) != len(lines[index]):
                     bad_lines.append(str(self.after.start + after_count - 1))
                     if fix:
                         self.lines[index] = repl_line
-            elif self.lines[index].startswith(' '):
+            elif lines[index].startswith(' '):
                 after_count += 1
-            elif DEBUG and not self.lines[index].startswith('-'):
+            elif DEBUG and not lines[index].startswith('-'):
                 raise Bug('Unexpected end of unified diff hunk.')
         return bad_lines
     def get_diffstat_stats(self):
         stats = DiffStat.Stats()
-        for index in range(len(self.lines)):
-            if self.lines[index].startswith('-'):
+        for line in self.get_lines():
+            char = line[:1]
+            if char == '-':
                 stats.incr('deleted')
-            elif self.lines[index].startswith('+'):
+            elif char == '+':
                 stats.incr('inserted')
-            elif DEBUG and not self.lines[index].startswith(' '):
+            elif DEBUG and char != ' ':
                 raise Bug('Unexpected end of unified diff hunk.')
         return stats
     def fix_trailing_whitespace(self):
@@ -660,17 +752,22 @@ class UnifiedDiffHunk(DiffHunk):
         return self._process_tws(fix=False)
 
 class UnifiedDiff(Diff):
+    BEFORE_FILE_PREFIX = '--- '
+    AFTER_FILE_PREFIX = '+++ '
+    HUNK_DATA_PREFIX = '@@'
     BEFORE_FILE_CRE = re.compile('^--- ({0})(\s+{1})?(.*)$'.format(_PATH_RE_STR, _EITHER_TS_RE_STR))
     AFTER_FILE_CRE = re.compile('^\+\+\+ ({0})(\s+{1})?(.*)$'.format(_PATH_RE_STR, _EITHER_TS_RE_STR))
     HUNK_DATA_CRE = re.compile("^@@\s+-(\d+)(,(\d+))?\s+\+(\d+)(,(\d+))?\s+@@\s*(.*)$")
     @staticmethod
     def get_before_file_data_at(lines, index):
-        return Diff._get_file_data_at(UnifiedDiff.BEFORE_FILE_CRE, lines, index)
+        return Diff._get_file_data_at(UnifiedDiff.BEFORE_FILE_PREFIX, UnifiedDiff.BEFORE_FILE_CRE, lines, index)
     @staticmethod
     def get_after_file_data_at(lines, index):
-        return Diff._get_file_data_at(UnifiedDiff.AFTER_FILE_CRE, lines, index)
+        return Diff._get_file_data_at(UnifiedDiff.AFTER_FILE_PREFIX, UnifiedDiff.AFTER_FILE_CRE, lines, index)
     @staticmethod
     def get_hunk_at(lines, index):
+        if not lines[index].startswith(UnifiedDiff.HUNK_DATA_PREFIX):
+            return (None, index)
         match = UnifiedDiff.HUNK_DATA_CRE.match(lines[index])
         if not match:
             return (None, index)
@@ -681,14 +778,15 @@ class UnifiedDiff(Diff):
         before_count = after_count = 0
         try:
             while before_count < before_length or after_count < after_length:
-                if lines[index].startswith('-'):
+                char = lines[index][:1]
+                if char == '-':
                     before_count += 1
-                elif lines[index].startswith('+'):
+                elif char == '+':
                     after_count += 1
-                elif lines[index].startswith(' '):
+                elif char == ' ':
                     before_count += 1
                     after_count += 1
-                elif not lines[index].startswith('\\'):
+                elif char != '\\':
                     raise ParseError('Unexpected end of unified diff hunk.', index)
                 index += 1
             if index < len(lines) and lines[index].startswith('\\'):
@@ -707,36 +805,39 @@ class UnifiedDiff(Diff):
 Diff.subtypes.append(UnifiedDiff)
 
 class ContextDiffHunk(DiffHunk):
+    __slots__ = ()
     def __init__(self, lines, before, after):
         DiffHunk.__init__(self, lines, before, after)
     def _process_tws(self, fix=False):
         bad_lines = list()
+        lines = self.get_lines()
         for index in range(self.after.offset + 1, self.after.offset + self.after.numlines):
-            if self.lines[index].startswith('+ ') or self.lines[index].startswith('! '):
-                repl_line = self.lines[index][:2] + _trim_trailing_ws(self.lines[index][2:])
+            if lines[index].startswith('+ ') or lines[index].startswith('! '):
+                repl_line = lines[index][:2] + _trim_trailing_ws(lines[index][2:])
                 after_count = index - (self.after.offset + 1)
-                if len(repl_line) != len(self.lines[index]):
+                if len(repl_line) != len(lines[index]):
                     bad_lines.append(str(self.after.start + after_count))
                     if fix:
                         self.lines[index] = repl_line
-            elif DEBUG and not self.lines[index].startswith('  '):
+            elif DEBUG and not lines[index].startswith('  '):
                 raise Bug('Unexpected end of context diff hunk.')
         return bad_lines
     def get_diffstat_stats(self):
         stats = DiffStat.Stats()
+        lines = self.get_lines()
         for index in range(self.before.offset + 1, self.before.offset + self.before.numlines):
-            if self.lines[index].startswith('- '):
+            if lines[index].startswith('- '):
                 stats.incr('deleted')
-            elif self.lines[index].startswith('! '):
+            elif lines[index].startswith('! '):
                 stats.incr('modified')
-            elif DEBUG and not self.lines[index].startswith('  '):
+            elif DEBUG and not lines[index].startswith('  '):
                 raise Bug('Unexpected end of context diff "before" hunk.')
         for index in range(self.after.offset + 1, self.after.offset + self.after.numlines):
-            if self.lines[index].startswith('+ '):
+            if lines[index].startswith('+ '):
                 stats.incr('inserted')
-            elif self.lines[index].startswith('! '):
+            elif lines[index].startswith('! '):
                 stats.incr('modified')
-            elif DEBUG and not self.lines[index].startswith('  '):
+            elif DEBUG and not lines[index].startswith('  '):
                 raise Bug('Unexpected end of context diff "after" hunk.')
         return stats
     def fix_trailing_whitespace(self):
@@ -745,6 +846,11 @@ class ContextDiffHunk(DiffHunk):
         return self._process_tws(fix=False)
 
 class ContextDiff(Diff):
+    BEFORE_FILE_PREFIX = '*** '
+    AFTER_FILE_PREFIX = '--- '
+    HUNK_START_PREFIX = '*' * 15
+    HUNK_BEFORE_PREFIX = '***'
+    HUNK_AFTER_PREFIX = '---'
     BEFORE_FILE_CRE = re.compile('^\*\*\* ({0})(\s+{1})?$'.format(_PATH_RE_STR, _EITHER_TS_RE_STR))
     AFTER_FILE_CRE = re.compile('^--- ({0})(\s+{1})?$'.format(_PATH_RE_STR, _EITHER_TS_RE_STR))
     HUNK_START_CRE = re.compile('^\*{15}\s*(.*)$')
@@ -752,10 +858,10 @@ class ContextDiff(Diff):
     HUNK_AFTER_CRE = re.compile('^---\s+(\d+)(,(\d+))?\s+----(.*)$')
     @staticmethod
     def get_before_file_data_at(lines, index):
-        return Diff._get_file_data_at(ContextDiff.BEFORE_FILE_CRE, lines, index)
+        return Diff._get_file_data_at(ContextDiff.BEFORE_FILE_PREFIX, ContextDiff.BEFORE_FILE_CRE, lines, index)
     @staticmethod
     def get_after_file_data_at(lines, index):
-        return Diff._get_file_data_at(ContextDiff.AFTER_FILE_CRE, lines, index)
+        return Diff._get_file_data_at(ContextDiff.AFTER_FILE_PREFIX, ContextDiff.AFTER_FILE_CRE, lines, index)
     @staticmethod
     def _chunk(match):
         start = int(match.group(1))
@@ -767,19 +873,23 @@ class ContextDiff(Diff):
         return _CHUNK(start, length)
     @staticmethod
     def _get_before_chunk_at(lines, index):
+        if not lines[index].startswith(ContextDiff.HUNK_BEFORE_PREFIX):
+            return (None, index)
         match = ContextDiff.HUNK_BEFORE_CRE.match(lines[index])
         if not match:
             return (None, index)
         return (ContextDiff._chunk(match), index + 1)
     @staticmethod
     def _get_after_chunk_at(lines, index):
+        if not lines[index].startswith(ContextDiff.HUNK_AFTER_PREFIX):
+            return (None, index)
         match = ContextDiff.HUNK_AFTER_CRE.match(lines[index])
         if not match:
             return (None, index)
         return (ContextDiff._chunk(match), index + 1)
     @staticmethod
     def get_hunk_at(lines, index):
-        if not ContextDiff.HUNK_START_CRE.match(lines[index]):
+        if not lines[index].startswith(ContextDiff.HUNK_START_PREFIX) or not ContextDiff.HUNK_START_CRE.match(lines[index]):
             return (None, index)
         start_index = index
         before_start_index = index + 1
@@ -832,6 +942,8 @@ class DiffPlus(object):
     Includes (optional) preambles and trailing junk such as quilt's separators.'''
     @staticmethod
     def get_diff_plus_at(lines, start_index, raise_if_malformed=False):
+        if start_index < len(lines) and not lines[start_index].startswith(DiffPlus.START_PREFIXES):
+            return (None, start_index)
         preambles, index = Preambles.get_preambles_at(lines, start_index, raise_if_malformed)
         if index >= len(lines):
             if preambles:
@@ -895,12 +1007,23 @@ class DiffPlus(object):
             path_plus.expath = self.preambles.get_file_expath(strip_level=strip_level)
         return path_plus
 
+# The beginnings of the lines that a DiffPlus can start with
+DiffPlus.START_PREFIXES = tuple(set([subtype.PREFIX for subtype in Preamble.subtypes] + [subtype.BEFORE_FILE_PREFIX for subtype in Diff.subtypes]))
+
 class Patch(object):
     '''Class to hold patch information relavent to multiple files with
     an optional header (or a single file with a header).'''
     @staticmethod
-    def parse_lines(lines, num_strip_levels=0):
-        '''Parse list of lines and return a Patch instance'''
+    def parse_lines(lines, num_strip_levels=0, text=None):
+        '''Parse list of lines (whose text, if given, is text) and return a
+        Patch instance'''
+        profiling.count('patch parses')
+        with profiling.phase('parse patches'):
+            return Patch._parse_lines(lines, num_strip_levels, text)
+    @staticmethod
+    def _parse_lines(lines, num_strip_levels, text):
+        if not isinstance(lines, _LineBuffer):
+            lines = _LineBuffer(lines, text)
         diff_starts_at = None
         diff_pluses = list()
         index = 0
@@ -920,12 +1043,20 @@ class Patch(object):
             index += 1
         patch = Patch(num_strip_levels=num_strip_levels)
         patch.diff_pluses = diff_pluses
-        patch.set_header(''.join(lines[0:diff_starts_at]))
+        patch.set_header(str(lines[0:len(lines) if diff_starts_at is None else diff_starts_at]))
         return patch
     @staticmethod
     def parse_text(text, num_strip_levels=0):
         '''Parse text and return a Patch instance.'''
-        return Patch.parse_lines(text.splitlines(True), num_strip_levels=num_strip_levels)
+        return Patch.parse_lines(text.splitlines(True), num_strip_levels=num_strip_levels, text=text)
+    @staticmethod
+    def parse_file(fobj, num_strip_levels=0):
+        '''Parse the lines read from the file object and return a Patch instance.'''
+        reader = PatchReader(fobj, num_strip_levels=num_strip_levels)
+        patch = Patch(num_strip_levels=num_strip_levels)
+        patch.diff_pluses = list(reader)
+        patch.header = reader.header
+        return patch
     @staticmethod
     def parse_email_text(text, num_strip_levels=0):
         '''Parse email text and return a Patch instance.'''
@@ -1052,3 +1183,84 @@ class Patch(object):
                 path = diff_plus.get_file_path(strip_level=strip_level)
                 reports.append(_FILE_AND_TWS_LINES(path, bad_lines))
         return reports
+
+class PatchReader(object):
+    '''Read a patch from a file object (or anything else with a readline()
+    method, e.g. an mmap) a DiffPlus at a time so that only the header
+    and the diff of the current file are held in memory.  Iterating over
+    the reader yields the DiffPlus objects (each once any junk trailing
+    it has been read) and the header is available (as the header
+    attribute) once the first of them has been yielded or the iteration
+    is over.  The results are the same as Patch.parse_lines()'s.'''
+    CHUNK_LINES = 1024
+    # how far beyond the lines that it takes the parser may look
+    _LOOKAHEAD = 2
+    def __init__(self, fobj, num_strip_levels=0):
+        self._readline = fobj.readline
+        self.num_strip_levels = int(num_strip_levels)
+        self.header = None
+    def _read_lines(self, count):
+        lines = []
+        for _dummy in xrange(count):
+            line = self._readline()
+            if not line:
+                break
+            lines.append(line)
+        if profiling.ENABLED:
+            profiling.count('bytes read', sum(len(line) for line in lines))
+        return lines
+    def __iter__(self):
+        profiling.count('patch parses')
+        return profiling.timed_iter('parse patches', self._generate())
+    def _generate(self):
+        lines = _LineBuffer([])
+        start = 0
+        lineno = 0 # of lines[0] in the patch
+        eof = False
+        header_lines = []
+        last_diff_plus = None
+        while True:
+            if start >= len(lines):
+                if eof:
+                    break
+                lineno += start
+                lines = _LineBuffer(self._read_lines(self.CHUNK_LINES))
+                start = 0
+                eof = len(lines) < self.CHUNK_LINES
+                continue
+            try:
+                diff_plus, index = DiffPlus.get_diff_plus_at(lines, start, last_diff_plus is not None)
+                complete = eof or index + self._LOOKAHEAD < len(lines)
+            except (ParseError, IndexError) as edata:
+                if eof:
+                    if isinstance(edata, ParseError) and edata.lineno is not None:
+                        edata.lineno += lineno
+                    raise
+                complete = False
+            if not complete:
+                # the result may depend on lines that haven't been read yet
+                count = max(len(lines) - start, self.CHUNK_LINES)
+                more_lines = self._read_lines(count)
+                eof = len(more_lines) < count
+                lineno += start
+                lines = _LineBuffer(lines[start:].get_lines() + more_lines)
+                start = 0
+                continue
+            if diff_plus:
+                if last_diff_plus is not None:
+                    yield last_diff_plus
+                else:
+                    self.header = Header(''.join(header_lines))
+                    header_lines = None
+                last_diff_plus = diff_plus
+                start = index
+            else:
+                if last_diff_plus is not None:
+                    last_diff_plus.trailing_junk.append(lines[start])
+                else:
+                    header_lines.append(lines[start])
+                start += 1
+        if last_diff_plus is not None:
+            yield last_diff_plus
+        else:
+            self.header = Header(''.join(header_lines))
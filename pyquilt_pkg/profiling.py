@@ -0,0 +1,158 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Find out where a command spends its time.  When profiling is turned on
+(by the --profile option or the QUILT_PROFILE environment variable) the
+sub command is run under cProfile and the time spent in each of a few
+phases (e.g. running other programs or parsing patches) is added up
+along with counts of things such as the programs run and the bytes read
+and written.  A summary of these is written to standard error or (if
+QUILT_PROFILE names one) appended to a file when the command finishes.
+Phase times are the sum over all threads and work done in worker
+processes (see workers.py) is not included.  When profiling is off the
+counting and timing functions do nothing.
+'''
+
+import thread
+import time
+import sys
+import os
+
+ENABLED = False
+
+# the number of functions listed in the summary
+NUM_FUNCTIONS = 25
+
+_DESTINATION = None
+_LOCK = thread.allocate_lock()
+_COUNTERS = {}
+_PHASES = {}
+
+def configure(opt_profile=False):
+    '''Turn profiling on if opt_profile is True or QUILT_PROFILE is set
+    (to a true value or the name of the file for the summaries) and
+    forget anything counted so far'''
+    global ENABLED, _DESTINATION
+    setting = os.getenv('QUILT_PROFILE', '')
+    if setting in ['', '0', 'n', 'no', 'false']:
+        ENABLED = opt_profile
+        _DESTINATION = None
+    else:
+        ENABLED = True
+        _DESTINATION = None if setting in ['1', 'y', 'yes', 'true', '-'] else setting
+    with _LOCK:
+        _COUNTERS.clear()
+        _PHASES.clear()
+
+def count(name, amount=1):
+    '''Add amount to the named counter'''
+    if not ENABLED:
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + amount
+
+def _add_time(name, seconds):
+    with _LOCK:
+        total, calls = _PHASES.get(name, (0.0, 0))
+        _PHASES[name] = (total + seconds, calls + 1)
+
+class _Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        _add_time(self.name, time.time() - self.start)
+        return False
+
+class _NoPhase(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NO_PHASE = _NoPhase()
+
+def phase(name):
+    '''Return a context manager that adds the time spent in its block to
+    the named phase'''
+    return _Phase(name) if ENABLED else _NO_PHASE
+
+def timed_iter(name, iterable):
+    '''Return an iterator over iterable that adds the time spent getting
+    each item to the named phase (e.g. for generators that parse their
+    input as it is asked for)'''
+    if not ENABLED:
+        return iterable
+    return _timed_iter(name, iter(iterable))
+
+def _timed_iter(name, iterator):
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        finally:
+            _add_time(name, time.time() - start)
+        yield item
+
+def format_summary(seconds, stats_text=None):
+    '''Return the summary (as text) of a run that took seconds'''
+    lines = ['pyquilt profile: %s (%.3fs)\n' % (' '.join(sys.argv[1:]), seconds)]
+    with _LOCK:
+        phases = sorted(_PHASES.items(), key=lambda item: -item[1][0])
+        counters = sorted(_COUNTERS.items())
+    if phases:
+        lines.append('%-24s %10s %8s\n' % ('phase', 'secs', 'calls'))
+        for name, (total, calls) in phases:
+            lines.append('%-24s %10.3f %8d\n' % (name, total, calls))
+    if counters:
+        lines.append('%-24s %10s\n' % ('counter', 'value'))
+        for name, value in counters:
+            lines.append('%-24s %10d\n' % (name, value))
+    if stats_text:
+        lines.append(stats_text)
+    return ''.join(lines)
+
+def _write_summary(text):
+    if _DESTINATION is None:
+        sys.stderr.write(text)
+        return
+    try:
+        with open(_DESTINATION, 'a') as fobj:
+            fobj.write(text + '\n')
+    except IOError as edata:
+        sys.stderr.write('%s: %s\n' % (_DESTINATION, edata.strerror))
+
+def run(func, *args):
+    '''Return func(*args) (profiling it and writing out the summary if
+    profiling is on)'''
+    if not ENABLED:
+        return func(*args)
+    import cStringIO
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        seconds = time.time() - start
+        stats_buffer = cStringIO.StringIO()
+        stats = pstats.Stats(profiler, stream=stats_buffer)
+        stats.sort_stats('cumulative').print_stats(NUM_FUNCTIONS)
+        _write_summary(format_summary(seconds, stats_buffer.getvalue()))
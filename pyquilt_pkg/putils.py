@@ -18,12 +18,59 @@
 '''Provide functions for manipulating patch files and/or text buffers'''
 
 import os.path
+import shlex
 import tempfile
 
 from pyquilt_pkg import shell
 from pyquilt_pkg import fsutils
 from pyquilt_pkg import cmd_result
 from pyquilt_pkg import patchlib
+from pyquilt_pkg import patchcache
+from pyquilt_pkg import applier
+from pyquilt_pkg import profiling
+
+# The texts of patch files and the patches parsed from them (keyed by
+# path) along with the identity of the file when it was read.  Only
+# patches read ahead of their use (see load_patch()'s keep argument) are
+# held here and each is dropped when it is next loaded so that the cache
+# never holds more than the read ahead window.  The cached objects are
+# shared so must not be modified.
+_PARSED_PATCHES = {}
+
+def load_patch(path, keep=False):
+    '''Return the (decompressed) text of the patch file at path and the
+    patchlib.Patch parsed from it.  If keep is True they are also held
+    (until the next call for path or forget_patches()) for a later call
+    that will use them.  Either may be shared with others so must not be
+    modified.  Safe to call from worker threads.'''
+    try:
+        stat_data = os.stat(path)
+        stat_key = (stat_data.st_ino, stat_data.st_size, stat_data.st_mtime)
+    except OSError:
+        stat_key = None
+    cached = _PARSED_PATCHES.pop(path, None)
+    if stat_key is not None and cached is not None and cached[0] == stat_key:
+        if keep:
+            _PARSED_PATCHES[path] = cached
+        return cached[1:]
+    fobj = fsutils.open_file(path)
+    try:
+        lines = fobj.readlines()
+    finally:
+        fobj.close()
+    text = ''.join(lines)
+    profiling.count('bytes read', len(text))
+    obj = patchlib.Patch.parse_lines(lines)
+    if keep and stat_key is not None:
+        _PARSED_PATCHES[path] = (stat_key, text, obj)
+    return (text, obj)
+
+def forget_patches():
+    '''Drop any patches held by load_patch() that were never used'''
+    _PARSED_PATCHES.clear()
+
+def _get_parsed_patch(path):
+    return load_patch(path)[1]
 
 def get_patch_descr_fm_text(text):
     obj = patchlib.Patch.parse_text(text)
@@ -31,10 +78,9 @@ def get_patch_descr_fm_text(text):
 
 def get_patch_descr(path):
     try:
-        buf = fsutils.get_file_contents(path)
+        return patchcache.get_patch_info(path).get_description()
     except IOError:
         return ''
-    return get_patch_descr_fm_text(buf)
 
 def get_patch_hdr_fm_text(text, omit_diffstat=False):
     obj = patchlib.Patch.parse_text(text)
@@ -45,10 +91,14 @@ def get_patch_hdr_fm_text(text, omit_diffstat=False):
 
 def get_patch_hdr(path, omit_diffstat=False):
     try:
-        buf = fsutils.get_file_contents(path)
+        text = patchcache.get_patch_info(path).get_header()
     except IOError:
         return ''
-    return get_patch_hdr_fm_text(buf, omit_diffstat)
+    if omit_diffstat:
+        hdr = patchlib.Header(text)
+        hdr.set_diffstat('')
+        return str(hdr)
+    return text
 
 def get_patch_diff_fm_text(text, file_list=None, strip_level=0):
     obj = patchlib.Patch.parse_text(text)
@@ -59,7 +109,12 @@ def get_patch_diff_fm_text(text, file_list=None, strip_level=0):
         return ''.join([str(x) for x in obj.diff_pluses if x.get_file_path(num_strip_level) in file_list])
 
 def get_patch_diff(path, file_list=None, strip_level=0):
-    return get_patch_diff_fm_text(fsutils.get_file_contents(path), file_list, strip_level)
+    obj = _get_parsed_patch(path)
+    if not file_list:
+        return ''.join([str(x) for x in obj.diff_pluses])
+    else:
+        num_strip_level = int(strip_level)
+        return ''.join([str(x) for x in obj.diff_pluses if x.get_file_path(num_strip_level) in file_list])
 
 def _write_via_temp(path, text):
     tmpdir = os.path.dirname(path)
@@ -103,25 +158,34 @@ def set_patch_hdr(path, text, omit_diffstat=False):
 
 def get_patch_files(path, strip_level=1):
     try:
-        buf = fsutils.get_file_contents(path)
+        info = patchcache.get_patch_info(path)
     except IOError:
         return (False, 'Problem(s) open file "%s" not found' % path)
-    obj = patchlib.Patch.parse_text(buf)
-    return obj.get_file_paths(int(strip_level))
+    return info.get_file_paths(strip_level)
 
-def apply_patch_text(text, indir=None, patch_args=''):
+def apply_patch_text(text, indir=None, patch_args='', parsed=None):
     from pyquilt_pkg import customization
     patch_opts = customization.get_default_opts('patch')
-    if indir:
-        cmd = 'patch -d %s' % indir
-    else:
-        cmd = 'patch'
-    cmd += ' %s %s' % (patch_opts, patch_args)
-    return shell.run_cmd(cmd, input_text=text)
+    # GNU patch is used if selected in the quiltrc (QUILT_PATCH_APPLIER=gnu)
+    # or if the patch needs something that the builtin applier lacks
+    if customization.get_config('QUILT_PATCH_APPLIER', 'builtin') != 'gnu':
+        result = applier.apply_patch_text(text, indir=indir, patch_args='%s %s' % (patch_opts, patch_args), parsed=parsed)
+        if result is not None:
+            return result
+    argv = ['patch', '-d', indir] if indir else ['patch']
+    try:
+        argv += shlex.split(patch_opts) + shlex.split(patch_args)
+    except ValueError as edata:
+        return cmd_result.Result(cmd_result.ERROR, '', 'patch %s %s: %s\n' % (patch_opts, patch_args, edata))
+    return shell.run_argv(argv, input_text=text)
 
-def apply_patch(patch_file, indir=None, patch_args=''):
-    text = fsutils.get_file_contents(patch_file)
-    return apply_patch_text(text, indir=indir, patch_args=patch_args)
+def apply_patch(patch_file, indir=None, patch_args='', keep=False):
+    try:
+        text, obj = load_patch(patch_file, keep=keep)
+    except patchlib.ParseError:
+        # leave it to patch to complain
+        text, obj = fsutils.get_file_contents(patch_file), None
+    return apply_patch_text(text, indir=indir, patch_args=patch_args, parsed=obj)
 
 def remove_trailing_ws(text, strip_level, dry_run=False):
     obj = patchlib.Patch.parse_text(text)
@@ -0,0 +1,298 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Answer queries about a tree from a long lived process (so that the
+configuration, series, applied stack and parsed patches need not be
+reloaded for every query) and forward queries to such a process.
+'''
+
+import os
+import sys
+
+from pyquilt_pkg import cmd_result
+
+# The client side is on every command's start up path so the modules only
+# needed by the server (or to talk to it) are imported when they are
+# needed (json and socket once a server is found)
+
+SOCKET_NAME = '.pyquilt_socket'
+
+# Sub commands that only inspect the tree and may therefore be served
+SERVED_SUB_CMDS = frozenset(['top', 'applied', 'unapplied', 'series', 'next', 'previous', 'files', 'patches', 'header'])
+
+# How long (in seconds) a client waits for the server to accept its
+# connection and then for each part of the reply before giving up and
+# running the command itself (which is safe as served commands only
+# inspect the tree)
+_CONNECT_TIMEOUT = 1.0
+_REPLY_TIMEOUT = 5.0
+
+def _is_served(args):
+    if args.sub_cmd_name not in SERVED_SUB_CMDS:
+        return False
+    if args.sub_cmd_name == 'header':
+        return not (args.opt_append or args.opt_replace or args.opt_edit)
+    return True
+
+def _with_short_path(path, func):
+    # Unix socket addresses are limited to about 100 bytes so use a
+    # relative address for long paths
+    if len(path) < 100:
+        return func(path)
+    saved_dir = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    try:
+        return func(os.path.basename(path))
+    finally:
+        os.chdir(saved_dir)
+
+def _send(sock, data):
+    import json
+    # json escapes new lines so a message is terminated by the only one
+    sock.sendall(json.dumps(data) + '\n')
+
+def _receive(sock):
+    import json
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith('\n'):
+            break
+    return json.loads(''.join(chunks))
+
+def _connect(path):
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(_CONNECT_TIMEOUT)
+    try:
+        _with_short_path(path, sock.connect)
+    except (socket.error, OSError):
+        sock.close()
+        return None
+    return sock
+
+def find_socket(dirpath=None):
+    '''Return the path of the socket of the server for the tree containing
+    dirpath (or None if there is no server)'''
+    if dirpath is None:
+        dirpath = os.getcwd()
+    quilt_pc = os.getenv('QUILT_PC', '.pc')
+    quilt_patches = os.getenv('QUILT_PATCHES', 'patches')
+    while True:
+        if os.path.isdir(os.path.join(dirpath, quilt_pc)):
+            path = os.path.join(dirpath, quilt_pc, SOCKET_NAME)
+            return path if os.path.exists(path) else None
+        elif os.path.isdir(os.path.join(dirpath, quilt_patches)):
+            return None
+        dirpath, basename = os.path.split(dirpath)
+        if not basename:
+            return None
+
+def _get_sub_cmd_name(argv):
+    index = 0
+    while index < len(argv) and argv[index].startswith('-'):
+        index += 2 if argv[index] == '--quiltrc' else 1
+    return argv[index] if index < len(argv) else None
+
+def forward(argv):
+    '''Have the tree's server run the command (if there is a server and
+    the command is one that it serves).  Return the command's exit status
+    or None if the command needs to be run locally.'''
+    if _get_sub_cmd_name(argv) not in SERVED_SUB_CMDS:
+        return None
+    try:
+        path = find_socket()
+        request = {
+            'argv' : argv,
+            'cwd' : os.getcwd(),
+            'env' : dict(os.environ),
+            'isatty' : [sys.stdout.isatty(), sys.stderr.isatty()],
+        }
+    except OSError:
+        return None
+    if path is None:
+        return None
+    import socket
+    sock = _connect(path)
+    if sock is None:
+        return None
+    try:
+        sock.settimeout(_REPLY_TIMEOUT)
+        _send(sock, request)
+        reply = _receive(sock)
+    except (socket.timeout, socket.error, ValueError, UnicodeError):
+        return None
+    finally:
+        sock.close()
+    if not reply.get('handled', False):
+        return None
+    for fileno, text in reply['output']:
+        stream = sys.stdout if fileno == 1 else sys.stderr
+        stream.write(text.encode('latin-1'))
+        stream.flush()
+    return reply['status']
+
+class _CapturedStream(object):
+    '''Stand in for stdout or stderr that records what is written to it
+    (interleaved with the other stream's output) for sending to a client'''
+    def __init__(self, fileno, chunks, isatty):
+        self._fileno = fileno
+        self._chunks = chunks
+        self._isatty = isatty
+    def write(self, text):
+        self._chunks.append((self._fileno, text))
+    def flush(self):
+        pass
+    def isatty(self):
+        return self._isatty
+
+def _run_request(request):
+    import traceback
+    from pyquilt_pkg import cmd_line
+    from pyquilt_pkg import customization
+    from pyquilt_pkg import output
+    from pyquilt_pkg import patchcache
+    from pyquilt_pkg import patchfns
+    from pyquilt_pkg import profiling
+    chunks = []
+    saved_state = (sys.stdout, sys.stderr, sys.argv, dict(os.environ), os.getcwd())
+    try:
+        # json hands back unicode but the commands expect (utf-8) str
+        os.environ.clear()
+        for key, value in request['env'].items():
+            os.environ[key.encode('utf-8')] = value.encode('utf-8')
+        os.environ['QUILT_PAGER'] = 'cat'
+        os.chdir(request['cwd'].encode('utf-8'))
+        sys.stdout = _CapturedStream(1, chunks, request['isatty'][0])
+        sys.stderr = _CapturedStream(2, chunks, request['isatty'][1])
+        sys.argv = ['pyquilt'] + [arg.encode('utf-8') for arg in request['argv']]
+        customization.reset_configuration_data()
+        patchfns.SUBDIR = ''
+        patchfns.SUBDIR_DOWN = 0
+        patchfns.get_file_owner_index().revalidate()
+        try:
+            args = cmd_line.parse_args()
+            if not _is_served(args):
+                return {'handled' : False}
+            profiling.configure(args.opt_profile)
+            status = profiling.run(args.run_cmd, args)
+        except SystemExit as edata:
+            if edata.code is None or isinstance(edata.code, int):
+                status = edata.code
+            else:
+                output.error('%s\n' % edata.code)
+                status = cmd_result.ERROR
+        except Exception:
+            output.error(traceback.format_exc())
+            status = cmd_result.ERROR
+        patchfns.get_file_owner_index().flush()
+        patchcache.get_patch_cache().flush()
+    finally:
+        sys.stdout, sys.stderr, sys.argv, environ, cwd = saved_state
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+    return {
+        'handled' : True,
+        'status' : status if status is not None else cmd_result.OK,
+        'output' : [(fileno, text.decode('latin-1')) for fileno, text in chunks],
+    }
+
+def _terminate(_signum, _frame):
+    sys.exit(cmd_result.OK)
+
+def serve(idle_timeout=None):
+    '''Serve requests for the tree in the current directory until stopped
+    or idle_timeout seconds pass without a request'''
+    import errno
+    import signal
+    import socket
+    from pyquilt_pkg import output
+    from pyquilt_pkg import patchfns
+    patchfns.create_db()
+    path = os.path.join(os.getcwd(), patchfns.QUILT_PC, SOCKET_NAME)
+    if os.path.exists(path):
+        sock = _connect(path)
+        if sock is not None:
+            sock.close()
+            output.error('A server is already running for this tree.\n')
+            return cmd_result.ERROR
+        os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the owner may connect: the socket is made with these
+    # permissions rather than changed to them after anyone could connect
+    umask = os.umask(0177)
+    try:
+        _with_short_path(path, listener.bind)
+        listener.listen(16)
+    except (socket.error, OSError) as edata:
+        output.error('Could not listen on %s: %s\n' % (path, edata))
+        listener.close()
+        return cmd_result.ERROR
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, _terminate)
+    listener.settimeout(idle_timeout)
+    try:
+        while True:
+            try:
+                conn, _address = listener.accept()
+            except socket.timeout:
+                break
+            except socket.error as edata:
+                if edata.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                conn.settimeout(60.0)
+                request = _receive(conn)
+                if request.get('stop', False):
+                    _send(conn, {'handled' : True})
+                    break
+                _send(conn, _run_request(request))
+            except (socket.error, ValueError, KeyError):
+                pass
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+    return cmd_result.OK
+
+def stop():
+    '''Stop the current tree's server'''
+    import socket
+    from pyquilt_pkg import output
+    from pyquilt_pkg import patchfns
+    path = os.path.join(os.getcwd(), patchfns.QUILT_PC, SOCKET_NAME)
+    sock = _connect(path) if os.path.exists(path) else None
+    if sock is None:
+        output.error('No server is running for this tree.\n')
+        return cmd_result.ERROR
+    try:
+        _send(sock, {'stop' : True})
+        _receive(sock)
+    except (socket.error, ValueError):
+        pass
+    finally:
+        sock.close()
+    return cmd_result.OK
@@ -21,31 +21,66 @@ import subprocess
 
 from pyquilt_pkg import cmd_result
 from pyquilt_pkg import customization
+from pyquilt_pkg import profiling
+
+def _restore_sigpipe():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 def run_cmd(cmd, input_text=None, use_shell=True):
     """Run the given command and report the outcome as a cmd_result tuple.
     If input_text is not None pass it to the command as standard input.
+    A command given as a string is run by the shell (unless use_shell is
+    False) and one given as an argument list is run directly (see
+    run_argv()).  Safe to call from worker threads: the process'
+    environment and signal dispositions are left alone (the child's are
+    set up separately).
     """
     if not cmd:
         return cmd_result.Result(0, None, None)
-    try:
-        oldterm = os.environ['TERM']
-        os.environ['TERM'] = "dumb"
-    except LookupError:
-        oldterm = None
-    is_posix = os.name == 'posix'
-    if is_posix:
-        savedsh = signal.getsignal(signal.SIGPIPE)
-        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     if not isinstance(cmd, str):
         use_shell = False
-    sub = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE, shell=use_shell, close_fds=is_posix, bufsize=-1)
-    outd, errd = sub.communicate(input_text)
-    if is_posix:
-        signal.signal(signal.SIGPIPE, savedsh)
-    if oldterm:
-        os.environ['TERM'] = oldterm
+    return _run(cmd, input_text, use_shell)
+
+def run_argv(argv, input_text=None):
+    """Run the program with the argument list argv (without the shell so
+    the arguments need no quoting) and report the outcome as a cmd_result
+    tuple.  If input_text is not None pass it to the program as standard
+    input.  Safe to call from worker threads (see run_cmd()).
+    """
+    if not argv:
+        return cmd_result.Result(0, None, None)
+    return _run(list(argv), input_text, False)
+
+def run_argvs(argvs, input_texts=None, jobs=None):
+    """Generate the results (in order) of running the programs with the
+    argument lists in argvs (and the corresponding input_texts if given)
+    as run_argv() would.  Up to jobs (default the configured number, see
+    workers.get_jobs()) of them are run at once from worker threads.
+    """
+    from pyquilt_pkg import workers
+    if input_texts is None:
+        input_texts = [None] * len(argvs)
+    items = zip(argvs, input_texts)
+    return workers.ordered_map(_run_argv_item, items, workers.get_jobs(jobs), processes=False)
+
+def _run_argv_item(item):
+    return run_argv(*item)
+
+def _run(cmd, input_text, use_shell):
+    env = dict(os.environ)
+    if 'TERM' in env:
+        env['TERM'] = "dumb"
+    is_posix = os.name == 'posix'
+    profiling.count('subprocesses')
+    with profiling.phase('subprocesses'):
+        try:
+            sub = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE, shell=use_shell, close_fds=is_posix, bufsize=-1,
+                  env=env, preexec_fn=_restore_sigpipe if is_posix else None)
+        except OSError as edata:
+            # report it as the shell would have
+            return cmd_result.Result(eflags=127, stdout='', stderr='%s: %s\n' % (cmd if use_shell else cmd[0], edata.strerror))
+        outd, errd = sub.communicate(input_text)
     return cmd_result.Result(eflags=sub.returncode, stdout=outd, stderr=errd)
 
 if os.name == 'nt' or os.name == 'dos':
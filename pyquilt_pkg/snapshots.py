@@ -0,0 +1,140 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Snapshots of the files of the applied patches (for `diff --snapshot').
+Each snapshot is a directory (".snap" or ".snap-<name>") in the quilt
+meta-data directory holding copies of the files with a manifest of them
+(see manifest.py) alongside.  The copies of files that have not changed
+since an existing snapshot was taken are shared with it (hard linked)
+rather than made again and the manifest lets diff skip the files that
+have not changed since the snapshot.
+'''
+
+import os
+import errno
+import tempfile
+
+from pyquilt_pkg import backup
+from pyquilt_pkg import manifest
+from pyquilt_pkg import output
+from pyquilt_pkg import patchfns
+
+SNAP_DIR = '.snap'
+
+def valid_name(name):
+    return bool(name) and os.sep not in name
+
+def snapshot_dir_name(name=None):
+    if name:
+        return os.path.join(patchfns.QUILT_PC, '%s-%s' % (SNAP_DIR, name))
+    return os.path.join(patchfns.QUILT_PC, SNAP_DIR)
+
+def manifest_file_name(snap_dir):
+    return snap_dir + manifest.MANIFEST_SUFFIX
+
+def snapshot_dirs():
+    '''Return the directories of the existing snapshots'''
+    try:
+        names = os.listdir(patchfns.QUILT_PC)
+    except OSError:
+        return []
+    snap_dirs = []
+    for name in sorted(names):
+        if name == SNAP_DIR or name.startswith(SNAP_DIR + '-'):
+            path = os.path.join(patchfns.QUILT_PC, name)
+            if os.path.isdir(path):
+                snap_dirs.append(path)
+    return snap_dirs
+
+def read_manifest(snap_dir):
+    '''Return the manifest entries (see manifest.read_manifest_file()) of
+    the snapshot in snap_dir or None if it has none'''
+    data = manifest.read_manifest_file(manifest_file_name(snap_dir))
+    return None if data is None else data[1]
+
+def remove_snapshot(snap_dir):
+    if os.path.isdir(snap_dir):
+        backup.discard(snap_dir)
+    try:
+        os.remove(manifest_file_name(snap_dir))
+    except OSError as edata:
+        if edata.errno != errno.ENOENT:
+            raise
+
+def _link_file(from_fn, to_fn):
+    try:
+        if not os.path.isdir(os.path.dirname(to_fn)):
+            os.makedirs(os.path.dirname(to_fn))
+        os.link(from_fn, to_fn)
+    except OSError:
+        return False
+    return True
+
+def _find_copy(filename, stat_key, sources):
+    '''Return the path and hash of a copy of the file's current contents
+    in the existing snapshots (or (None, None) if there is none)'''
+    file_hash = None
+    for snap_dir, entries in sources:
+        entry = entries.get(filename)
+        if entry is None or entry[0] is None:
+            continue
+        if entry[1] != stat_key:
+            if file_hash is None:
+                file_hash = manifest.get_hash(filename)
+            if file_hash != entry[0]:
+                continue
+        path = os.path.join(snap_dir, filename)
+        if os.path.isfile(path):
+            return (path, entry[0])
+    return (None, None)
+
+def take_snapshot(snap_dir, files):
+    '''Take a snapshot of the files into snap_dir (replacing any that is
+    there already)'''
+    sources = []
+    for other_dir in snapshot_dirs():
+        entries = read_manifest(other_dir)
+        if entries:
+            sources.append((other_dir, entries))
+    store_dir = patchfns.backup_store_dir()
+    work_dir = tempfile.mkdtemp(prefix=os.path.basename(snap_dir) + '.', dir=patchfns.QUILT_PC)
+    try:
+        entries = []
+        for filename in sorted(files):
+            stat_key = manifest.get_stat_key(filename)
+            copy, file_hash = (None, None) if stat_key is None else _find_copy(filename, stat_key, sources)
+            if copy is None or not _link_file(copy, os.path.join(work_dir, filename)):
+                if not backup.backup(work_dir, [filename], store_dir=store_dir):
+                    return False
+                if stat_key is not None:
+                    file_hash = manifest.get_hash(os.path.join(work_dir, filename))
+                    # no telling what was copied if it changed meanwhile
+                    if manifest.get_stat_key(filename) != stat_key:
+                        stat_key = None
+            entries.append((filename, file_hash, stat_key))
+        remove_snapshot(snap_dir)
+        os.rename(work_dir, snap_dir)
+        work_dir = None
+    except OSError as edata:
+        output.perror(edata)
+        return False
+    finally:
+        if work_dir is not None:
+            backup.discard(work_dir)
+    # without its manifest diff just compares all of the snapshot's files
+    manifest.write_manifest_file(manifest_file_name(snap_dir), os.path.basename(snap_dir), entries)
+    patchfns.collect_backup_garbage()
+    return True
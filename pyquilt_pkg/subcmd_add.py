@@ -24,6 +24,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'add',
+    help='Add file(s) to the topmost or named patch.',
     description='Add one or more files to the topmost or named patch.',
     epilog='''Files must be
     added to the patch before being modified.  Files that are modified by
@@ -56,7 +57,7 @@ def run_add(args):
         if not patchfns.in_valid_dir(filename):
             status = 1
             continue
-        if patchfns.file_in_patch(patch, filename):
+        if patchfns.file_in_patch(filename, patch):
             output.error('File %s is already in patch %s\n' % (filename, patchfns.print_patch(patch)))
             status = 2 if status != 1 else 1
         next_patch = patchfns.next_patch_for_file(patch, filename)
@@ -68,10 +69,11 @@ def run_add(args):
             output.error('Cannot add symbolic link %s\n' % filename)
             status = 1
             continue
-        if not backup.backup(patch_dir, [filename]):
+        if not backup.backup(patch_dir, [filename], store_dir=patchfns.backup_store_dir()):
             output.error('Failed to back up file %s\n' % filename)
             status = 1
             continue
+        patchfns.get_file_owner_index().add_file(patch, filename)
         if os.path.exists(filename):
             # The original tree may be read-only.
             os.chmod(filename, os.stat(filename).st_mode|stat.S_IWUSR)
@@ -26,6 +26,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'annotate',
+    help='Show which patches modify which lines of a file.',
     description='''Print an annotated listing of the specified
         file showing which patches modify which lines.
         Only applied patches are included.''',
@@ -44,13 +45,17 @@ parser.add_argument(
     metavar='patch',
 )
 
-def annotation_for(old_file, new_file, annotation):
-    """Return diff for annotation for changes from osd_file to new_file"""
+def diff_argv(old_file, new_file):
+    """Return the arguments for "diff -e" of old_file and new_file"""
     if not os.path.exists(old_file) or os.path.getsize(old_file) == 0:
         old_file = '/dev/null'
     if not os.path.exists(new_file) or os.path.getsize(new_file) == 0:
         new_file = '/dev/null'
-    result = shell.run_cmd('diff -e "%s" "%s"' % (old_file, new_file))
+    return ['diff', '-e', old_file, new_file]
+
+def annotation_for(result, annotation):
+    """Return diff for annotation for the changes in result (of running
+    the command from diff_argv())"""
     if result.eflags > 1:
         output.error(result.stderr)
         sys.exit(result.eflags)
@@ -95,11 +100,11 @@ def run_annotate(args):
     patches = []
     files = []
     next_patch = None
+    owners = patchfns.get_file_owner_index().get_owners(opt_file)
     for patch in patchfns.applied_patches():
-        old_file = patchfns.backup_file_name(patch, opt_file)
-        if os.path.isfile(old_file):
+        if patch in owners:
             patches.append(patch)
-            files.append(old_file)
+            files.append(patchfns.backup_file_name(patch, opt_file))
         if patch == args.opt_patch:
             next_patch = patchfns.next_patch_for_file(patch, opt_file)
             break
@@ -112,11 +117,12 @@ def run_annotate(args):
             output.write('\t%s\n' % line)
         return cmd_result.OK
     difftxt = ''
-    for index in range(len(patches)):
-        difftxt += annotation_for(files[index], files[index + 1], index + 1)
+    argvs = [diff_argv(files[index], files[index + 1]) for index in range(len(patches))]
+    for index, result in enumerate(shell.run_argvs(argvs)):
+        difftxt += annotation_for(result, index + 1)
     template = patchfns.gen_tempfile()
     open(template, 'w').write('\n' * len(open(files[0]).readlines()))
-    shell.run_cmd('patch %s' % template, difftxt)
+    shell.run_argv(['patch', template], difftxt)
     annotations = [line.rstrip() for line in open(template).readlines()]
     os.remove(template)
     output.start_pager()
@@ -23,6 +23,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'applied',
+    help='Print the list of applied patches.',
     description='''Print a list of applied patches, or all patches
         up to and including the specified patch in the file series.''',
 )
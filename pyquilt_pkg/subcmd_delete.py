@@ -22,6 +22,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'delete',
+    help='Remove the topmost or named patch from the series file.',
     description='Remove the specified or topmost patch from the series file.',
     epilog='''If thepatch is applied, quilt will attempt to remove it
            first. (Only the topmost patch can be removed right now.)'''
@@ -26,9 +26,14 @@ from pyquilt_pkg import customization
 from pyquilt_pkg import output
 from pyquilt_pkg import diff
 from pyquilt_pkg import colour
+from pyquilt_pkg import shell
+from pyquilt_pkg import workers
+from pyquilt_pkg import manifest
+from pyquilt_pkg import snapshots
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'diff',
+    help='Produce a diff of the topmost or named patch.',
     description='''Produces a diff of the specified file(s) in the
         topmost or specified patch.  If no files are specified, all
         files that are modified are included.''',
@@ -135,6 +140,13 @@ parser.add_argument(
     action='store_true',
 )
 
+parser.add_argument(
+    '--snapshot-name',
+    help='Diff against the snapshot with the given name (implies --snapshot).',
+    dest='opt_snapshot_name',
+    metavar='name',
+)
+
 parser.add_argument(
     '--diff',
     help='''Use the specified utility for generating the diff. The
@@ -160,6 +172,16 @@ parser.add_argument(
     action='store_true',
 )
 
+parser.add_argument(
+    '--jobs',
+    help='''Work out the diffs of up to num files at once (0 for one per
+        processor) while earlier ones are being shown.  The default is
+        QUILT_JOBS from the quiltrc or 1.''',
+    dest='opt_jobs',
+    type=int,
+    metavar='num',
+)
+
 parser.add_argument(
     'opt_files',
     help='File(s) to be included in diff.',
@@ -193,11 +215,32 @@ def colorize(text):
                 ctext += line
     return ctext
 
-def do_diff(filename, old_file, new_file, args):
-    """Output the diff for the nominated files"""
+def get_diff(filename, old_file, new_file, args):
+    """Return the result of diffing the nominated files"""
     if args.opt_reverse:
         old_file, new_file = new_file, old_file
+    return diff.diff_file(filename, old_file, new_file, args)
+
+def write_diff(result, args):
+    """Output a diff got by get_diff()"""
+    output.error(result.stderr)
+    if args.opt_color:
+        output.write(colorize(result.stdout))
+    else:
+        output.write(result.stdout)
+    return result.eflags < 2
+
+def _get_diff_job(job):
+    filename, old_file, new_file, message, args = job
+    if message:
+        return cmd_result.Result(cmd_result.OK, '', message)
+    return get_diff(filename, old_file, new_file, args)
+
+def do_diff(filename, old_file, new_file, args):
+    """Output the diff for the nominated files"""
     if args.opt_diff:
+        if args.opt_reverse:
+            old_file, new_file = new_file, old_file
         if not os.path.exists(old_file):
             old_file = '/dev/null'
         if not os.path.exists(new_file):
@@ -206,15 +249,9 @@ def do_diff(filename, old_file, new_file, args):
             os.environ['LANG'] = patchfns.ORIGINAL_LANG
             shell.run_cmd('%s %s %s' % (args.opt_diff, old_file, new_file))
             os.environ['LANG'] = 'POSIX'
-            return True
+        return True
     else:
-        result = diff.diff_file(filename, old_file, new_file, args)
-        output.error(result.stderr)
-        if args.opt_color:
-            output.write(colorize(result.stdout))
-        else:
-            output.write(result.stdout)
-        return result.eflags < 2
+        return write_diff(get_diff(filename, old_file, new_file, args), args)
 
 def clean_up(workdir):
     if workdir and os.path.exists(workdir):
@@ -222,7 +259,16 @@ def clean_up(workdir):
 
 def run_diff(args):
     patchfns.chdir_to_base_dir()
-    snap_subdir = os.path.join(patchfns.QUILT_PC, '.snap') if args.opt_snapshot else None
+    if args.opt_snapshot_name is not None:
+        args.opt_snapshot = True
+        snap_subdir = snapshots.snapshot_dir_name(args.opt_snapshot_name)
+        if not snapshots.valid_name(args.opt_snapshot_name) or not os.path.isdir(snap_subdir):
+            output.error('Snapshot %s does not exist\n' % args.opt_snapshot_name)
+            return cmd_result.ERROR
+    else:
+        snap_subdir = snapshots.snapshot_dir_name() if args.opt_snapshot else None
+    # the files known to be unchanged since the snapshot needn't be diffed
+    snap_entries = (snapshots.read_manifest(snap_subdir) if snap_subdir else None) or {}
     if args.opt_combine:
         first_patch = '-' if args.opt_combine == '-' else patchfns.find_applied_patch(args.opt_combine)
         if not first_patch:
@@ -287,7 +333,9 @@ def run_diff(args):
     files_were_shadowed = False
     if args.opt_color:
         colour.set_up()
-    output.start_pager()
+    # Work out what to compare (and what to complain about) for each
+    # file in order first
+    jobs = []
     for filename in files:
         snapshot_path = os.path.join(snap_subdir, filename) if snap_subdir else None
         if snapshot_path and os.path.exists(snapshot_path):
@@ -298,18 +346,33 @@ def run_diff(args):
             patch = patchfns.first_modified_by(filename, patches)
             if not patch:
                 if not args.opt_snapshot:
-                    output.error('File %s is not being modified\n' % filename)
+                    jobs.append((filename, None, None, 'File %s is not being modified\n' % filename, args))
                 continue
             old_file = patchfns.backup_file_name(patch, filename)
         next_patch = patchfns.next_patch_for_file(last_patch, filename)
         if not next_patch:
             new_file = filename
+            if old_file == snapshot_path and filename in snap_entries and manifest.file_unchanged(filename, snap_entries[filename]):
+                continue
         else:
             new_file = patchfns.backup_file_name(next_patch, filename)
             files_were_shadowed = True
-        if not do_diff(filename, old_file, new_file, args):
-            output.error('Diff failed, aborting\n')
-            return cmd_result.ERROR
+        jobs.append((filename, old_file, new_file, None, args))
+    output.start_pager()
+    if args.opt_diff:
+        for filename, old_file, new_file, message, _args in jobs:
+            if message:
+                output.error(message)
+            elif not do_diff(filename, old_file, new_file, args):
+                output.error('Diff failed, aborting\n')
+                return cmd_result.ERROR
+    else:
+        # The diffs are worked out ahead (in worker processes) and written
+        # as soon as those of all the files before them have been
+        for result in workers.ordered_map(_get_diff_job, jobs, workers.get_jobs(args.opt_jobs)):
+            if not write_diff(result, args):
+                output.error('Diff failed, aborting\n')
+                return cmd_result.ERROR
     if files_were_shadowed:
         output.error('Warning: more recent patches modify files in patch %s\n' % patchfns.print_patch(last_patch))
     output.wait_for_pager()
@@ -24,6 +24,7 @@ from pyquilt_pkg import shell
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'edit',
+    help='Edit file(s) after adding them to the topmost patch.',
     description='''Edit the specified file(s) in $EDITOR (%s) after
         adding it (them) to the topmost patch.''' % os.getenv('EDITOR', 'None'),
 )
@@ -23,6 +23,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'files',
+    help='Print the list of files that a patch changes.',
     description='''Print the list of files that the topmost or specified patch changes.''',
 )
 
@@ -27,6 +27,7 @@ from pyquilt_pkg import fsutils
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'fold',
+    help='Integrate a patch read from standard input into the topmost patch.',
     description='''Integrate the patch read from standard input into
         the topmost patch: After making sure that all files modified
         are part of the topmost patch, the patch is applied with the
@@ -104,6 +105,7 @@ def run_fold(args):
                         if backup_file_dir and not os.path.exists(backup_file_dir):
                             os.makedirs(backup_file_dir)
                         os.link(os.path.join(workdir, filename), backup_file)
+                        patchfns.get_file_owner_index().add_file(top, filename)
                     except OSError as edata:
                         failed = True
                         break
@@ -24,6 +24,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'fork',
+    help='Fork the topmost patch.',
     description='''Fork the topmost patch.  Forking a patch means
         creating a verbatim copy of it under a new name, and use that
         new name instead of the original one in the current series.
@@ -25,6 +25,7 @@ from pyquilt_pkg import shell
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'grep',
+    help='Grep through the source files.',
     description='''Grep through the source files, recursively, skipping
         patches and quilt meta-information. If no filename argument is
         given, the whole source tree is searched.
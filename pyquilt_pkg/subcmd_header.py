@@ -27,6 +27,7 @@ from pyquilt_pkg import putils
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'header',
+    help='Print or change the header of a patch.',
     description='''Print or change the header of the topmost or specified patch.''',
     epilog='''If none of the options -a, -r or -e is given, print the patch header.''',
 )
@@ -24,9 +24,11 @@ from pyquilt_pkg import output
 from pyquilt_pkg import putils
 from pyquilt_pkg import shell
 from pyquilt_pkg import fsutils
+from pyquilt_pkg import workers
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'import',
+    help='Import external patches.',
     description='''Import external patches.  The patches will be
         inserted following the  current top patch, and must be pushed
         after import to apply them.''',
@@ -71,6 +73,15 @@ parser.add_argument(
     choices=['o', 'a', 'n'],
 )
 
+parser.add_argument(
+    '--jobs',
+    help='''Copy up to num patches at once (0 for one per processor).
+    The default is QUILT_JOBS from the quiltrc or 4.''',
+    dest='opt_jobs',
+    type=int,
+    metavar='num',
+)
+
 parser.add_argument(
     'patchfiles',
     help='Patch file(s) to be imported',
@@ -90,7 +101,7 @@ def merge_patches(old, new, opt_desc):
         elif os.path.getsize(new_desc) == 0:
             opt_desc = 'o'
         if opt_desc is None:
-            result = shell.run_cmd('diff -u %s %s' % (old_desc, new_desc))
+            result = shell.run_argv(['diff', '-u', old_desc, new_desc])
             diff_lines = result.stdout.splitlines(True)
             if len(diff_lines) > 2:
                 output.error('Patch headers differ:\n')
@@ -110,6 +121,24 @@ def merge_patches(old, new, opt_desc):
     os.remove(new_desc)
     return patchtext
 
+# Copying patches is mostly waiting for the disk (and for compressed
+# patches zlib, which releases the GIL) so a few threads pay off even
+# when QUILT_JOBS is not set
+_COPY_THREADS = 4
+
+def _copy_patch_file(job):
+    '''Store the (possibly merged) patch at its destination converting
+    its compression as necessary.  Run in worker threads.'''
+    patch_file_name, dest, merged_patch = job
+    try:
+        if merged_patch is not None:
+            return fsutils.set_file_contents(dest, merged_patch)
+        # just in case dest == patch_file do it this way
+        text = fsutils.get_file_contents(patch_file_name)
+        return fsutils.set_file_contents(dest, text)
+    except IOError:
+        return False
+
 def run_import(args):
     patchfns.chdir_to_base_dir()
     if args.opt_patch and len(args.patchfiles) > 1:
@@ -119,17 +148,27 @@ def run_import(args):
     if args.opt_reverse:
         patch_args = '-R' if not patch_args else patch_args + ' -R'
     before = patchfns.patch_after(patchfns.top_patch())
+    # Validate everything against one snapshot of the series before
+    # touching anything
+    series_index = patchfns.get_series_index()
+    imports = []
+    seen = set()
     for patch_file in args.patchfiles:
         patch = args.opt_patch if args.opt_patch else os.path.basename(patch_file)
         patch_file_name = patchfns.find_patch_file(patch_file)
         if not patch_file_name:
             return cmd_result.ERROR
-        merged = False
+        if patch in seen:
+            output.error('Patch %s is given more than once\n' % patchfns.print_patch(patch))
+            return cmd_result.ERROR
+        seen.add(patch)
         if patchfns.is_applied(patch):
             output.error('Patch %s is applied\n' % patchfns.print_patch(patch))
             return cmd_result.ERROR
         dest = patchfns.patch_file_name(patch)
-        if patchfns.patch_in_series(patch):
+        merged_patch = None
+        in_series = patch in series_index
+        if in_series:
             if patch_file_name == dest:
                 output.error('Patch %s already exists in series.\n' % patchfns.print_patch(patch))
                 return cmd_result.ERROR
@@ -140,27 +179,32 @@ def run_import(args):
                 merged_patch = merge_patches(dest, patch_file_name, args.opt_desc)
                 if merged_patch is False:
                     return cmd_result.ERROR
-                merged = True
-            output.error('Replacing patch %s with new version\n' % patchfns.print_patch(patch))
+            message = (output.error, 'Replacing patch %s with new version\n' % patchfns.print_patch(patch))
         elif os.path.exists(dest):
-            output.write('Importing patch %s\n' % patchfns.print_patch(patch))
+            message = (output.write, 'Importing patch %s\n' % patchfns.print_patch(patch))
         else:
-            output.write('Importing patch %s (stored as %s)\n' % (patch_file, patchfns.print_patch(patch)))
-            dest_dir = os.path.dirname(dest)
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-        try:
-            if merged:
-                fsutils.set_file_contents(dest, merged_patch)
-            else:
-                # just in case dest == patch_file do it this way
-                text = fsutils.get_file_contents(patch_file_name)
-                fsutils.set_file_contents(dest, text)
-        except IOError as edata:
+            message = (output.write, 'Importing patch %s (stored as %s)\n' % (patch_file, patchfns.print_patch(patch)))
+        imports.append((patch, patch_file_name, dest, merged_patch, in_series, message))
+    for dest_dir in set([os.path.dirname(item[2]) for item in imports]):
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+    jobs = [(patch_file_name, dest, merged_patch) for _patch, patch_file_name, dest, merged_patch, _in_series, _message in imports]
+    # Carry on past failures so that every patch that was copied (perhaps
+    # by another worker already) makes it into the series
+    new_patches = []
+    is_ok = True
+    for index, copied in enumerate(workers.ordered_map(_copy_patch_file, jobs, workers.get_jobs(args.opt_jobs, default=_COPY_THREADS), processes=False)):
+        patch, _patch_file_name, _dest, _merged_patch, in_series, message = imports[index]
+        message[0](message[1])
+        if not copied:
             output.error('Failed to import patch %s\n' % patchfns.print_patch(patch))
-            return cmd_result.ERROR
-        if not patchfns.patch_in_series(patch) and not patchfns.insert_in_series(patch, patch_args, before):
+            is_ok = False
+        elif not in_series:
+            new_patches.append(patch)
+    if new_patches and not patchfns.insert_patches_in_series(new_patches, patch_args, before):
+        for patch in new_patches:
             output.error('Failed to insert patch %s into file series\n' % patchfns.print_patch(patch))
-    return cmd_result.OK
+        is_ok = False
+    return cmd_result.OK if is_ok else cmd_result.ERROR
 
 parser.set_defaults(run_cmd=run_import)
@@ -33,6 +33,7 @@ from pyquilt_pkg import putils
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'mail',
+    help='Create mail messages from a range of patches.',
     description='''Create mail messages from a specified range of
         patches, or all patches in the series file, and either store
         them in a mailbox file, or send them immediately. The editor
@@ -22,6 +22,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'new',
+    help='Create a new patch.',
     description='Create a new patch with the specified file name, and insert it after the topmost patch',
     epilog='''"%(prog)s" can be used in sub-directories of a source tree.
     It determines the root of a source tree by searching directories above the
@@ -21,6 +21,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'next',
+    help='Print the name of the next patch in the series.',
     description='''Print the name of the next patch after the
         specified or topmost patch in the series file.''',
 )
@@ -25,6 +25,7 @@ from pyquilt_pkg import putils
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'patches',
+    help='Print the list of patches that modify file(s).',
     description='''Print the list of patches that modify the specified
         file. (Uses a heuristic to determine which files are modified
         by unapplied patches.  Note that this heuristic is much slower
@@ -55,10 +56,13 @@ parser.add_argument(
 )
 
 def scan_applied(category, prefix, file_paths, patches):
+    owner_index = patchfns.get_file_owner_index()
+    owners = set()
+    for file_path in file_paths:
+        owners.update(owner_index.get_owners(file_path))
     for patch in patches:
-        for file_path in file_paths:
-            if os.path.isfile(patchfns.backup_file_name(patch, file_path)):
-                output.write(colour.wrap('%s%s\n' % (prefix, patchfns.print_patch(patch)), category))
+        if patch in owners:
+            output.write(colour.wrap('%s%s\n' % (prefix, patchfns.print_patch(patch)), category))
 
 def scan_unapplied(category, prefix, file_paths, patches):
     for patch in patches:
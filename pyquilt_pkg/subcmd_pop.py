@@ -18,6 +18,7 @@ import shutil
 import argparse
 import re
 import errno
+import signal
 
 from pyquilt_pkg import cmd_line
 from pyquilt_pkg import cmd_result
@@ -30,9 +31,11 @@ from pyquilt_pkg import shell
 from pyquilt_pkg import colour
 from pyquilt_pkg import backup
 from pyquilt_pkg import output
+from pyquilt_pkg import manifest
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'pop',
+    help='Remove patch(es) from the stack of applied patches.',
     description='''
         Remove patch(es) from the stack of applied patches.  Without options,
         the topmost patch is removed.  When a number is specified, remove the
@@ -102,7 +105,7 @@ def list_patches(number=None, stop_at_patch=None):
         return patches[:number]
     return patches
 
-def files_may_have_changed(patch):
+def files_may_have_changed(patch, files=None):
     patch_file = patchfns.patch_file_name(patch)
     if not patch_file or not os.path.exists(patch_file):
         return True
@@ -113,12 +116,25 @@ def files_may_have_changed(patch):
         return True
     if tsf_mt < os.path.getmtime(patch_file):
         return True
-    for file_nm in patchfns.files_in_patch(patch):
+    for file_nm in patchfns.files_in_patch(patch) if files is None else files:
         if os.path.exists(file_nm) and tsf_mt < os.path.getmtime(file_nm):
             return True
     return False
 
-def check_for_pending_changes(patch):
+def _does_not_remove_cleanly(patch):
+    output.error('Patch %s does not remove cleanly (refresh it or enforce with -f)\n' % patchfns.print_patch(patch))
+    return cmd_result.ERROR_SUGGEST_FORCE
+
+def check_for_pending_changes(patch, use_manifest=True, files=None):
+    '''Check that the (given) files in the patch are as the patch left them'''
+    if files is None:
+        files = patchfns.files_in_patch(patch)
+    if use_manifest:
+        # The files' contents after the patch was pushed or refreshed may
+        # have been recorded (saving having to apply the patch again)
+        unchanged = manifest.files_unchanged(patch, files)
+        if unchanged is not None:
+            return True if unchanged else _does_not_remove_cleanly(patch)
     patch_file = patchfns.patch_file_name(patch)
     workdir = patchfns.gen_tempfile(template='quilt', asdir=True)
     patchdir = os.path.join(patchfns.QUILT_PC, patch)
@@ -137,7 +153,7 @@ def check_for_pending_changes(patch):
             shutil.rmtree(workdir)
             return False
     failed = False
-    for file_nm in patchfns.files_in_patch(patch):
+    for file_nm in files:
         wfile_nm = os.path.join(workdir, file_nm)
         if not os.path.exists(file_nm):
             if os.path.exists(wfile_nm):
@@ -153,15 +169,14 @@ def check_for_pending_changes(patch):
             break
     shutil.rmtree(workdir)
     if failed:
-        output.error('Patch %s does not remove cleanly (refresh it or enforce with -f)\n' % patchfns.print_patch(patch))
-        return cmd_result.ERROR_SUGGEST_FORCE
+        return _does_not_remove_cleanly(patch)
     return True
 
 def remove_patch(patch, force, check, silent):
     try:
         status = True
         if not force and (check or files_may_have_changed(patch)):
-            status = check_for_pending_changes(patch)
+            status = check_for_pending_changes(patch, use_manifest=not check)
         if status is True:
             patchdir = os.path.join(patchfns.QUILT_PC, patch)
             try:
@@ -181,6 +196,7 @@ def remove_patch(patch, force, check, silent):
                 if not backup.restore(patchdir, touch=True, verbose=not silent):
                     status = False
             patchfns.remove_from_db(patch)
+            manifest.remove_manifest(patch)
             try:
                 os.remove(os.path.join(patchdir + '~refresh'))
             except OSError as edata:
@@ -191,6 +207,105 @@ def remove_patch(patch, force, check, silent):
     except KeyboardInterrupt:
         return False
 
+def _move_into_place(staged, file_nm):
+    '''Replace file_nm by the staged file (or remove it if there is no
+    staged file)'''
+    try:
+        if os.path.exists(staged):
+            if os.path.dirname(file_nm) and not os.path.isdir(os.path.dirname(file_nm)):
+                os.makedirs(os.path.dirname(file_nm))
+            os.rename(staged, file_nm)
+        elif os.path.lexists(file_nm):
+            os.unlink(file_nm)
+    except OSError as edata:
+        output.perror(edata, file_nm)
+        return False
+    return True
+
+def remove_patches(patches, force, check, silent):
+    '''Remove the patches (topmost first) in one go: each file is restored
+    once (from the earliest of the patches' backups of it), the others'
+    backups are just dropped and the applied patches are rewritten once.
+    Each file is only checked for changes against the last of the patches
+    to change it and only the patches above the first one to fail its
+    check are removed.'''
+    patch_files = dict((patch, patchfns.files_in_patch(patch)) for patch in patches)
+    status = True
+    if not force:
+        last_owner = {}
+        for patch in patches:
+            for file_nm in patch_files[patch]:
+                last_owner.setdefault(file_nm, patch)
+        for index, patch in enumerate(patches):
+            files = [file_nm for file_nm in patch_files[patch] if last_owner[file_nm] == patch]
+            if check or files_may_have_changed(patch, files):
+                status = check_for_pending_changes(patch, use_manifest=not check, files=files)
+                if status is not True:
+                    patches = patches[:index]
+                    break
+    if not patches:
+        return status
+    first_owner = {}
+    for patch in patches:
+        for file_nm in patch_files[patch]:
+            first_owner[file_nm] = patch
+    # The files are restored into a directory beside the backups first and
+    # only moved into place (and the patches removed) once all of them
+    # have been so that a failure or an interruption leaves every patch
+    # applied with its backups and the working files as they were
+    staging = patchfns.gen_tempfile(template=os.path.join(patchfns.QUILT_PC, '.pop'), asdir=True)
+    try:
+        try:
+            for patch in patches:
+                if not patch_files[patch]:
+                    output.write('Patch %s appears to be empty, removing\n' % patchfns.print_patch(patch))
+                else:
+                    output.write('Removing patch %s\n' % patchfns.print_patch(patch))
+                    patchdir = os.path.join(patchfns.QUILT_PC, patch)
+                    files = [file_nm for file_nm in patch_files[patch] if first_owner[file_nm] == patch]
+                    if files and not backup.restore(patchdir, filelist=files, to_dir=staging, keep=True, touch=True):
+                        return False
+                    if not silent:
+                        for file_nm in files:
+                            if os.path.exists(os.path.join(staging, file_nm)):
+                                output.write('Restoring %s\n' % file_nm)
+                            else:
+                                output.write('Removing %s\n' % file_nm)
+                if not silent:
+                    output.write('\n')
+        except KeyboardInterrupt:
+            output.error('Interrupted by user; no patches were removed.\n')
+            return False
+        # once the files start to be moved into place they all must be
+        sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            for file_nm in sorted(first_owner):
+                if not _move_into_place(os.path.join(staging, file_nm), file_nm):
+                    # keep the records and backups of the patches to
+                    # allow "pop -f" to finish the job
+                    return False
+        finally:
+            signal.signal(signal.SIGINT, sigint_handler)
+    finally:
+        shutil.rmtree(staging)
+    with patchfns.metadata_transaction() as transaction:
+        for patch in patches:
+            patchfns.remove_from_db(patch)
+    if not transaction.is_ok:
+        return False
+    for patch in patches:
+        patchdir = os.path.join(patchfns.QUILT_PC, patch)
+        try:
+            if os.path.isdir(patchdir):
+                backup.discard(patchdir)
+            if os.path.exists(patchdir + '~refresh'):
+                os.remove(patchdir + '~refresh')
+        except OSError as edata:
+            output.perror(edata)
+            status = False
+        manifest.remove_manifest(patch)
+    return status
+
 def run_pop(args):
     number = stop_at_patch = None
     patchfns.chdir_to_base_dir()
@@ -212,12 +327,20 @@ def run_pop(args):
         output.error('No patch removed\n')
         return cmd_result.ERROR
     is_ok = True
-    for patch in patches:
-        result = remove_patch(patch, force=args.opt_force, check=args.opt_remove, silent=silent)
+    try:
+        if len(patches) > 1:
+            result = remove_patches(patches, force=args.opt_force, check=args.opt_remove, silent=silent)
+        else:
+            result = remove_patch(patches[0], force=args.opt_force, check=args.opt_remove, silent=silent)
+            if result is True and not args.opt_quiet:
+                output.write('\n')
+        patchfns.collect_backup_garbage()
         if result is not True:
             return cmd_result.ERROR if result is False else result
-        if not args.opt_quiet:
-            output.write('\n')
+    except KeyboardInterrupt:
+        # Stop here but keep the record of the patches already removed
+        output.error('Interrupted by user\n')
+        return cmd_result.ERROR
     if not patchfns.top_patch():
         output.write('No patches applied\n')
     else:
@@ -21,6 +21,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'previous',
+    help='Print the name of the previous patch in the series.',
     description='''Print the name of the previous patch before
         the specified or topmost    patch in the series file.''',
 )
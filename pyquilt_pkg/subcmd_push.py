@@ -17,6 +17,7 @@ import sys
 import os
 import shutil
 import argparse
+import itertools
 import re
 
 from pyquilt_pkg import cmd_line
@@ -30,9 +31,12 @@ from pyquilt_pkg import shell
 from pyquilt_pkg import colour
 from pyquilt_pkg import backup
 from pyquilt_pkg import output
+from pyquilt_pkg import workers
+from pyquilt_pkg import manifest
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'push',
+    help='Apply patch(es) from the series file.',
     description='''
         Apply patch(es) from the series file.  Without options, the next patch
         in the series file is applied.  When a number is specified, apply the
@@ -191,6 +195,21 @@ def colorize(text):
             ret += line
     return ret
 
+# While a patch is being applied the next few are read (decompressing
+# them as necessary) and parsed in the background
+_PREFETCH_THREADS = 2
+_PREFETCH_DEPTH = 4
+
+def _prefetch_patch(patch_file):
+    '''Have putils read and parse the patch file ready for its use (in
+    apply_patch() etc.).  Run in worker threads.'''
+    try:
+        if os.path.exists(patch_file):
+            putils.load_patch(patch_file, keep=True)
+    except Exception:
+        # the problem will be reported when the patch is applied
+        pass
+
 def rollback_patch(patch, verbose=False):
     backup_dir = os.path.join(patchfns.QUILT_PC, patch)
     return backup.restore(backup_dir, verbose=verbose)
@@ -200,7 +219,8 @@ def run_push(args):
         def apply_patch(patch_file, patch_args):
             if not os.path.exists(patch_file) or os.path.getsize(patch_file) == 0:
                 return cmd_result.Result(0, '', '')
-            return putils.apply_patch(patch_file, patch_args=patch_args)
+            # kept for the check below that the patch is not empty
+            return putils.apply_patch(patch_file, patch_args=patch_args, keep=True)
         tmp = None
         patch_file = patchfns.patch_file_name(patch)
         output.write('Applying patch %s\n' % patchfns.print_patch(patch))
@@ -239,8 +259,16 @@ def run_push(args):
             patch_dir = os.path.join(patchfns.QUILT_PC, patch)
             if os.path.exists(patch_dir):
                 fsutils.touch(os.path.join(patch_dir, '.timestamp'))
+                store_dir = patchfns.backup_store_dir()
+                if store_dir is not None:
+                    backup.add_to_store(patch_dir, store_dir, patchfns.files_in_patch(patch))
             else:
                 os.mkdir(patch_dir)
+            # Record the files' contents for pop's check for changes
+            if result.eflags == 0:
+                manifest.write_manifest(patch)
+            else:
+                manifest.remove_manifest(patch)
             if not os.path.exists(patch_file):
                 output.write('Patch %s does not exist; applied empty patch\n' % patchfns.print_patch(patch))
             elif not putils.get_patch_diff(patch_file):
@@ -294,12 +322,23 @@ def run_push(args):
     if do_colorize:
         colour.set_up()
     is_ok = True
-    for patch in patches:
-        is_ok = add_patch(patch)
-        if not is_ok:
-            break
-        if not args.opt_quiet:
-            output.write('\n')
+    patch_files = [patchfns.patch_file_name(patch) for patch in patches]
+    prefetched = workers.ordered_map(_prefetch_patch, patch_files, _PREFETCH_THREADS, window=_PREFETCH_DEPTH + 1, processes=False)
+    try:
+        # prefetched first so that it is used up (and its threads ended)
+        for _dummy, patch in itertools.izip(prefetched, patches):
+            is_ok = add_patch(patch)
+            if not is_ok:
+                break
+            if not args.opt_quiet:
+                output.write('\n')
+    except KeyboardInterrupt:
+        # Stop here but keep the record of the patches already applied
+        output.error('Interrupted by user\n')
+        is_ok = False
+    finally:
+        prefetched.close()
+        putils.forget_patches()
     if is_ok:
         output.write('Now at patch %s\n' % patchfns.print_top_patch())
     return cmd_result.OK if is_ok else cmd_result.ERROR
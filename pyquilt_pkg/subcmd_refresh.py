@@ -26,9 +26,13 @@ from pyquilt_pkg import fsutils
 from pyquilt_pkg import shell
 from pyquilt_pkg import output
 from pyquilt_pkg import diffstat
+from pyquilt_pkg import workers
+from pyquilt_pkg import manifest
+from pyquilt_pkg import backup
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'refresh',
+    help='Refresh the topmost or named patch.',
     description='''
         Refreshes the specified patch, or the topmost patch by default.
         Documentation that comes before the actual patch in the patch file is
@@ -163,6 +167,19 @@ parser.add_argument(
     action='store_true',
 )
 
+parser.add_argument(
+    '--jobs',
+    help='''Diff up to num files at once (0 for one per processor).
+    The default is QUILT_JOBS from the quiltrc or 1.''',
+    dest='opt_jobs',
+    type=int,
+    metavar='num',
+)
+
+def _diff_file(job):
+    filn, old_file, new_file, args = job
+    return diff.diff_file(filn, old_file, new_file, args)
+
 def run_refresh(args):
     workdir = None
     def clean_up(status):
@@ -203,8 +220,10 @@ def run_refresh(args):
         workdir = patchfns.gen_tempfile(asdir=True, template=os.path.join(os.getcwd(), 'quilt'))
         if not patchfns.apply_patch_temporarily(workdir, old_patch):
             return clean_up(cmd_result.ERROR)
-    patch_content = ''
     files_were_shadowed = False
+    jobs = []
+    # Where the files' states after the patch are (for the manifest)
+    sources = {}
     for filn in files:
         if args.opt_new_name:
             old_file = os.path.join(workdir, filn)
@@ -217,9 +236,13 @@ def run_refresh(args):
             else:
                 new_file = patchfns.backup_file_name(next_patch, filn)
                 files_were_shadowed = True
-        result = diff.diff_file(filn, old_file, new_file, args)
+        sources[filn] = new_file
+        jobs.append((filn, old_file, new_file, args))
+    # The results come back in the order of the files
+    patch_content = ''
+    for result in workers.ordered_map(_diff_file, jobs, workers.get_jobs(args.opt_jobs)):
         if result.eflags > 1:
-            output.error('\n'.join(result.stderr, 'Diff failed, aborting\n'))
+            output.error(result.stderr + 'Diff failed, aborting\n')
             return clean_up(cmd_result.ERROR)
         elif result.eflags == 0 or not result.stdout:
             continue
@@ -275,10 +298,13 @@ def run_refresh(args):
             try:
                 patch_dir = os.path.join(QUILT_PC, patch)
                 if os.path.exists(patch_dir):
-                    shutil.rmtree(patch_dir)
+                    backup.discard(patch_dir)
+                    patchfns.collect_backup_garbage()
                 os.rename(workdir, patch_dir)
-                open(patchfns.DB, 'a').write(patch + '\n')
+                db_ok = patchfns.add_to_db(patch)
             except:
+                db_ok = False
+            if not db_ok:
                 output.error('Failed to create patch %s\n' % patchfns.print_patch(patch))
                 return clean_up(cmd_result.ERROR)
             output.write('Fork of patch %s created as %s\n' % (patchfns.print_patch(old_patch), patchfns.print_patch(patch)))
@@ -290,6 +316,8 @@ def run_refresh(args):
         if os.path.exists(tagf):
             os.remove(tagf)
         is_ok = patchfns.change_db_strip_level('-p%s' % num_strip_level, patch)
+        if is_ok and patch_content:
+            manifest.write_manifest(patch, sources)
     return clean_up(cmd_result.OK if is_ok and patch_content else cmd_result.ERROR)
 
 parser.set_defaults(run_cmd=run_refresh)
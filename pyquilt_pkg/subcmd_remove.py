@@ -25,6 +25,7 @@ from pyquilt_pkg import fsutils
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'remove',
+    help='Remove file(s) from the topmost or named patch.',
     description='''Remove one or more files from the topmost or named
         patch.  Files that  are modified by patches on top of the
         specified patch cannot be removed.''',
@@ -72,9 +73,11 @@ def run_remove(args):
             output.error('Failed to remove file %s from patch %s\n' % (filename, prpatch))
             is_ok = False
             continue
+        patchfns.get_file_owner_index().remove_file(patch, filename)
         if os.path.exists(patchrefrdir) and os.path.exists(patchfn):
             fsutils.touch(patchrefrfile)
         output.write('File %s removed from patch %s\n' % (filename, prpatch))
+    patchfns.collect_backup_garbage()
     return cmd_result.OK if is_ok else cmd_result.ERROR
 
 parser.set_defaults(run_cmd=run_remove)
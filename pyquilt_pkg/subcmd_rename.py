@@ -22,6 +22,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'rename',
+    help='Rename the topmost or named patch.',
     description='Rename the topmost or named patch.',
 )
 
@@ -26,6 +26,7 @@ from pyquilt_pkg import diff
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'revert',
+    help='Revert uncommitted changes to file(s) in a patch.',
     description='''Revert uncommitted changes to the topmost or named
         patch for the specified file(s): after the revert,
         'pyquilt diff -z' will show no differences for those files.
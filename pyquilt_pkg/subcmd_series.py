@@ -24,6 +24,7 @@ from pyquilt_pkg import colour
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'series',
+    help='Print the names of all patches in the series file.',
     description='''Print the names of all patches in the series file.''',
 )
 
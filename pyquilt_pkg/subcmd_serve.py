@@ -0,0 +1,52 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from pyquilt_pkg import cmd_line
+from pyquilt_pkg import cmd_result
+from pyquilt_pkg import patchfns
+from pyquilt_pkg import server
+
+parser = cmd_line.SUB_CMD_PARSER.add_parser(
+    'serve',
+    help='Serve queries about the tree from a long lived process.',
+    description='''Serve queries about the current tree from a long lived
+        process listening on a socket in the quilt meta-data directory.
+        While it is running, commands that only inspect the tree (top,
+        applied, unapplied, series, next, previous, files, patches and
+        header without -a, -r or -e) are handed to it automatically.''',
+)
+
+parser.add_argument(
+    '--stop',
+    help='''Stop the server running for the current tree.''',
+    dest='opt_stop',
+    action='store_true',
+)
+
+parser.add_argument(
+    '--idle-timeout',
+    help='''Exit after the given number of seconds without a request.''',
+    dest='opt_idle_timeout',
+    type=float,
+    metavar='seconds',
+)
+
+def run_serve(args):
+    patchfns.chdir_to_base_dir()
+    if args.opt_stop:
+        return server.stop()
+    return server.serve(args.opt_idle_timeout)
+
+parser.set_defaults(run_cmd=run_serve)
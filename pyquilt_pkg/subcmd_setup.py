@@ -24,6 +24,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'setup',
+    help='Initialize a source tree from a spec or series file.',
     description='Initializes a source tree from an rpm spec file or a quilt series file.',
 )
 
@@ -13,23 +13,21 @@
 ### along with this program; if not, write to the Free Software
 ### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-import os
-import shutil
-
 from pyquilt_pkg import cmd_line
 from pyquilt_pkg import cmd_result
 from pyquilt_pkg import patchfns
-from pyquilt_pkg import customization
 from pyquilt_pkg import output
-from pyquilt_pkg import backup
+from pyquilt_pkg import snapshots
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'snapshot',
+    help='Take a snapshot of the current working state.',
     description='''Take a snapshot of the current working state.  After
         taking the snapshot, the tree can be modified in the usual
         ways, including pushing and popping patches.  A diff against
         the tree at the moment of the snapshot can be generated with
-        `quilt diff --snapshot'.''',
+        `quilt diff --snapshot'.  Files that are unchanged since an
+        existing snapshot was taken share its copies of them.''',
 )
 
 parser.add_argument(
@@ -39,20 +37,29 @@ parser.add_argument(
     action='store_true',
 )
 
+parser.add_argument(
+    '-n',
+    help='''Take (or remove) the snapshot with the given name instead of
+        the default one (see `quilt diff --snapshot-name').''',
+    dest='opt_name',
+    metavar='name',
+)
+
 def run_snapshot(args):
     patchfns.chdir_to_base_dir()
-    snap_subdir = '.snap'
-    snap_subdir_path = os.path.join(patchfns.QUILT_PC, snap_subdir)
-    if os.path.exists(snap_subdir_path):
-        shutil.rmtree(snap_subdir_path)
+    if args.opt_name is not None and not snapshots.valid_name(args.opt_name):
+        output.error('Invalid snapshot name %s\n' % args.opt_name)
+        return cmd_result.ERROR
+    snap_dir = snapshots.snapshot_dir_name(args.opt_name)
     if args.opt_remove:
+        snapshots.remove_snapshot(snap_dir)
+        patchfns.collect_backup_garbage()
         return cmd_result.OK
-    os.makedirs(snap_subdir_path)
-    files = []
-    for patch in patchfns.applied_patches():
-        files += patchfns.files_in_patch(patch)
     # Use set functionality to remove duplicates
-    result = backup.backup(snap_subdir_path, set(files))
+    files = set()
+    for patch in patchfns.applied_patches():
+        files.update(patchfns.files_in_patch(patch))
+    result = snapshots.take_snapshot(snap_dir, files)
     return cmd_result.OK if result else cmd_result.ERROR
 
 parser.set_defaults(run_cmd=run_snapshot)
@@ -21,6 +21,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'top',
+    help='Print the name of the topmost patch.',
     description='''Print the name of the topmost patch on the current
         stack of applied patches.''',
 )
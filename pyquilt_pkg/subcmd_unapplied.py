@@ -21,6 +21,7 @@ from pyquilt_pkg import output
 
 parser = cmd_line.SUB_CMD_PARSER.add_parser(
     'unapplied',
+    help='Print the list of patches that are not applied.',
     description='''Print a list of patches that are not applied, or
         all patches that follow the specified patch in the series
         file.''',
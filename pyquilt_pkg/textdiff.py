@@ -0,0 +1,675 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Compare files in process and produce the same unified or context diff
+that GNU diff would.  GNU diff's choices are followed step by step (the
+identical ends that are set aside, the discarding of lines that cannot
+or are unlikely to match, the Myers comparison with its cost limit and
+the sliding of changes to their final positions) because a different
+but equally short set of changes would make a different patch.  Only
+the options that pyquilt gives to diff are understood and, for anything
+else (or binary files), the caller is told to run GNU diff instead.
+'''
+
+import os
+import shlex
+
+from pyquilt_pkg import cmd_result
+
+class Unsupported(Exception):
+    '''The comparison (or the options) must be handled by GNU diff'''
+
+UNIFIED = 'u'
+CONTEXT = 'c'
+
+DEFAULT_CONTEXT = 3
+
+# Comparisons of very different files are left to GNU diff (which does
+# the same work much faster) once this many diagonals have been searched
+WORK_LIMIT = 1000000
+
+def _parse_options(diff_opts):
+    '''Return the output style and number of context lines that the
+    diff options ask for'''
+    try:
+        words = shlex.split(diff_opts)
+    except ValueError:
+        raise Unsupported(diff_opts)
+    style = None
+    context = -1
+    index = 0
+    while index < len(words):
+        word = words[index]
+        index += 1
+        value = None
+        if word in ['-u', '--unified']:
+            word_style = UNIFIED
+        elif word in ['-c', '--context']:
+            word_style = CONTEXT
+        elif word[:2] in ['-U', '-C']:
+            word_style = UNIFIED if word[1] == 'U' else CONTEXT
+            if len(word) > 2:
+                value = word[2:]
+            elif index < len(words):
+                value = words[index]
+                index += 1
+            else:
+                raise Unsupported(diff_opts)
+        elif word.startswith('--unified=') or word.startswith('--context='):
+            word_style = UNIFIED if word.startswith('--unified=') else CONTEXT
+            value = word.split('=', 1)[1]
+        else:
+            raise Unsupported(word)
+        if style is not None and style != word_style:
+            raise Unsupported(diff_opts)
+        style = word_style
+        if value is None:
+            context = max(context, DEFAULT_CONTEXT)
+        elif value.isdigit():
+            context = max(context, int(value))
+        else:
+            raise Unsupported(value)
+    if style is None:
+        raise Unsupported(diff_opts)
+    return (style, context)
+
+def _split_lines(text):
+    '''Split text into lines (keeping the new lines) at new lines only'''
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+_BLOCK_SIZE = 65536
+
+def _common_prefix_len(text0, text1):
+    limit = min(len(text0), len(text1))
+    start = 0
+    while start < limit and text0[start:start + _BLOCK_SIZE] == text1[start:start + _BLOCK_SIZE]:
+        start += _BLOCK_SIZE
+    # The first difference is in the block at start (if anywhere)
+    end = min(start + _BLOCK_SIZE, limit)
+    while start < end:
+        mid = (start + end) // 2
+        if text0[start:mid + 1] == text1[start:mid + 1]:
+            start = mid + 1
+        else:
+            end = mid
+    return start
+
+def _common_suffix_len(text0, text1, limit):
+    len0 = len(text0)
+    len1 = len(text1)
+    count = 0
+    while count < limit:
+        size = min(_BLOCK_SIZE, limit - count)
+        if text0[len0 - count - size:len0 - count] != text1[len1 - count - size:len1 - count]:
+            break
+        count += size
+    end = min(count + _BLOCK_SIZE, limit)
+    while count < end:
+        mid = (count + end) // 2
+        if text0[len0 - mid - 1:len0 - count] == text1[len1 - mid - 1:len1 - count]:
+            count = mid + 1
+        else:
+            end = mid
+    return count
+
+def _find_identical_ends(text0, text1, horizon):
+    '''Return the offsets at which the part of the texts that is compared
+    line by line starts (the same for both) and ends (one for each).
+    As in GNU diff, horizon lines of the identical prefix and suffix are
+    kept in the part that is compared.'''
+    len0 = len(text0)
+    len1 = len(text1)
+    missing0 = 1 if text0 and not text0.endswith('\n') else 0
+    missing1 = 1 if text1 and not text1.endswith('\n') else 0
+    pos = _common_prefix_len(text0, text1)
+    # Don't count a missing new line as part of the prefix
+    if (len0 - missing0 < pos) != (len1 - missing1 < pos):
+        pos -= 1
+    # Back up to the start of the line and then horizon lines more
+    pos = text0.rfind('\n', 0, pos) + 1
+    count = horizon
+    while pos and count:
+        pos = text0.rfind('\n', 0, pos - 1) + 1
+        count -= 1
+    prefix_end = pos
+    if missing0 != missing1:
+        return (prefix_end, len0, len1)
+    stop = prefix_end + (0 if len0 < len1 else len0 - len1)
+    suffix_len = _common_suffix_len(text0, text1, len0 - stop)
+    pos0 = len0 - suffix_len
+    pos1 = len1 - suffix_len
+    start0 = pos0
+    at_line_start = (pos0 == 0 or text0[pos0 - 1] == '\n') and (pos1 == 0 or text1[pos1 - 1] == '\n')
+    count = horizon + (0 if at_line_start else 1)
+    while count and pos0 != len0:
+        pos0 = text0.find('\n', pos0)
+        pos0 = len0 if pos0 == -1 else pos0 + 1
+        count -= 1
+    return (prefix_end, pos0, pos1 + pos0 - start0)
+
+def _discard_confusing_lines(equivs, nclasses):
+    '''Return (for each file) which lines should be set aside as changed
+    without being compared: those that match nothing in the other file
+    and, in the middle of runs of those, lines that match very many'''
+    counts = []
+    for file_equivs in equivs:
+        file_counts = [0] * nclasses
+        for equiv in file_equivs:
+            file_counts[equiv] += 1
+        counts.append(file_counts)
+    discarded = []
+    for findex in range(2):
+        file_equivs = equivs[findex]
+        other_counts = counts[1 - findex]
+        end = len(file_equivs)
+        many = 5
+        tem = end // 64
+        while True:
+            tem >>= 2
+            if tem <= 0:
+                break
+            many *= 2
+        discards = [0] * end
+        for i in xrange(end):
+            nmatch = other_counts[file_equivs[i]]
+            if nmatch == 0:
+                discards[i] = 1
+            elif nmatch > many:
+                discards[i] = 2
+        discarded.append(discards)
+    for discards in discarded:
+        end = len(discards)
+        i = 0
+        while i < end:
+            if discards[i] == 2:
+                discards[i] = 0
+            elif discards[i] != 0:
+                # A run of discardable lines starting with a definite one
+                provisional = 0
+                j = i
+                while j < end and discards[j] != 0:
+                    if discards[j] == 2:
+                        provisional += 1
+                    j += 1
+                while j > i and discards[j - 1] == 2:
+                    j -= 1
+                    discards[j] = 0
+                    provisional -= 1
+                length = j - i
+                if provisional * 4 > length:
+                    while j > i:
+                        j -= 1
+                        if discards[j] == 2:
+                            discards[j] = 0
+                else:
+                    minimum = 1
+                    tem = length >> 2
+                    while True:
+                        tem >>= 2
+                        if tem <= 0:
+                            break
+                        minimum <<= 1
+                    minimum += 1
+                    # Cancel any subrun of minimum or more provisionals
+                    j = 0
+                    consec = 0
+                    while j < length:
+                        if discards[i + j] != 2:
+                            consec = 0
+                        else:
+                            consec += 1
+                            if minimum == consec:
+                                j -= consec
+                            elif minimum < consec:
+                                discards[i + j] = 0
+                        j += 1
+                    # Cancel provisionals near the ends of the run
+                    j = 0
+                    consec = 0
+                    while j < length:
+                        if j >= 8 and discards[i + j] == 1:
+                            break
+                        if discards[i + j] == 2:
+                            consec = 0
+                            discards[i + j] = 0
+                        elif discards[i + j] == 0:
+                            consec = 0
+                        else:
+                            consec += 1
+                        if consec == 3:
+                            break
+                        j += 1
+                    i += length - 1
+                    j = 0
+                    consec = 0
+                    while j < length:
+                        if j >= 8 and discards[i - j] == 1:
+                            break
+                        if discards[i - j] == 2:
+                            consec = 0
+                            discards[i - j] = 0
+                        elif discards[i - j] == 0:
+                            consec = 0
+                        else:
+                            consec += 1
+                        if consec == 3:
+                            break
+                        j += 1
+            i += 1
+    return discarded
+
+class _Comparer(object):
+    '''Myers' comparison of two sequences (finding the middle snake from
+    both ends) as done by GNU diff, marking the changed elements in the
+    two change vectors (via the real indexes of the elements)'''
+    def __init__(self, xvec, yvec, xindexes, yindexes, xchanged, ychanged):
+        self.xvec = xvec
+        self.yvec = yvec
+        self.xindexes = xindexes
+        self.yindexes = yindexes
+        self.xchanged = xchanged
+        self.ychanged = ychanged
+        diags = len(xvec) + len(yvec) + 3
+        self.fdiag = [0] * diags
+        self.bdiag = [0] * diags
+        self.offset = len(yvec) + 1
+        too_expensive = 1
+        while diags != 0:
+            too_expensive <<= 1
+            diags >>= 2
+        self.too_expensive = max(4096, too_expensive)
+        self.work = 0
+    def _diag(self, xoff, xlim, yoff, ylim, find_minimal):
+        '''Return the point (and whether the halves should be found
+        minimally) at which to split the comparison'''
+        xv = self.xvec
+        yv = self.yvec
+        fd = self.fdiag
+        bd = self.bdiag
+        off = self.offset
+        dmin = xoff - ylim
+        dmax = xlim - yoff
+        fmid = xoff - yoff
+        bmid = xlim - ylim
+        fmin = fmax = fmid
+        bmin = bmax = bmid
+        odd = (fmid - bmid) & 1
+        fd[fmid + off] = xoff
+        bd[bmid + off] = xlim
+        big = xlim + ylim + 1
+        cost = 0
+        while True:
+            cost += 1
+            self.work += fmax - fmin + bmax - bmin + 2
+            if self.work > WORK_LIMIT:
+                raise Unsupported('too expensive')
+            if fmin > dmin:
+                fmin -= 1
+                fd[fmin - 1 + off] = -1
+            else:
+                fmin += 1
+            if fmax < dmax:
+                fmax += 1
+                fd[fmax + 1 + off] = -1
+            else:
+                fmax -= 1
+            for d in xrange(fmax, fmin - 1, -2):
+                tlo = fd[d - 1 + off]
+                thi = fd[d + 1 + off]
+                x = thi if tlo < thi else tlo + 1
+                y = x - d
+                while x < xlim and y < ylim and xv[x] == yv[y]:
+                    x += 1
+                    y += 1
+                fd[d + off] = x
+                if odd and bmin <= d <= bmax and bd[d + off] <= x:
+                    return (x, y, True, True)
+            if bmin > dmin:
+                bmin -= 1
+                bd[bmin - 1 + off] = big
+            else:
+                bmin += 1
+            if bmax < dmax:
+                bmax += 1
+                bd[bmax + 1 + off] = big
+            else:
+                bmax -= 1
+            for d in xrange(bmax, bmin - 1, -2):
+                tlo = bd[d - 1 + off]
+                thi = bd[d + 1 + off]
+                x = tlo if tlo < thi else thi - 1
+                y = x - d
+                while xoff < x and yoff < y and xv[x - 1] == yv[y - 1]:
+                    x -= 1
+                    y -= 1
+                bd[d + off] = x
+                if not odd and fmin <= d <= fmax and x <= fd[d + off]:
+                    return (x, y, True, True)
+            if find_minimal or cost < self.too_expensive:
+                continue
+            # Give up and use the better of the furthest points reached
+            fxybest = -1
+            fxbest = 0
+            for d in xrange(fmax, fmin - 1, -2):
+                x = min(fd[d + off], xlim)
+                y = x - d
+                if ylim < y:
+                    x = ylim + d
+                    y = ylim
+                if fxybest < x + y:
+                    fxybest = x + y
+                    fxbest = x
+            bxybest = big + xlim + ylim
+            bxbest = 0
+            for d in xrange(bmax, bmin - 1, -2):
+                x = max(xoff, bd[d + off])
+                y = x - d
+                if y < yoff:
+                    x = yoff + d
+                    y = yoff
+                if x + y < bxybest:
+                    bxybest = x + y
+                    bxbest = x
+            if (xlim + ylim) - bxybest < fxybest - (xoff + yoff):
+                return (fxbest, fxybest - fxbest, True, False)
+            return (bxbest, bxybest - bxbest, False, True)
+    def compare(self, xoff, xlim, yoff, ylim, find_minimal=False):
+        xv = self.xvec
+        yv = self.yvec
+        while xoff < xlim and yoff < ylim and xv[xoff] == yv[yoff]:
+            xoff += 1
+            yoff += 1
+        while xoff < xlim and yoff < ylim and xv[xlim - 1] == yv[ylim - 1]:
+            xlim -= 1
+            ylim -= 1
+        if xoff == xlim:
+            for y in xrange(yoff, ylim):
+                self.ychanged[self.yindexes[y] + 1] = 1
+        elif yoff == ylim:
+            for x in xrange(xoff, xlim):
+                self.xchanged[self.xindexes[x] + 1] = 1
+        else:
+            xmid, ymid, lo_minimal, hi_minimal = self._diag(xoff, xlim, yoff, ylim, find_minimal)
+            self.compare(xoff, xmid, yoff, ymid, lo_minimal)
+            self.compare(xmid, xlim, ymid, ylim, hi_minimal)
+
+# Change vectors have an unchanged sentinel at each end so line i's
+# flag is at index i + 1
+
+def _shift_boundaries(changes, equivs):
+    '''Slide each run of changes as far forward as it will go (merging
+    with following runs) but back to where it lines up with a run of
+    changes in the other file if that is possible'''
+    for findex in range(2):
+        changed = changes[findex]
+        other_changed = changes[1 - findex]
+        file_equivs = equivs[findex]
+        i = 0
+        j = 0
+        i_end = len(file_equivs)
+        while True:
+            while i < i_end and not changed[i + 1]:
+                while other_changed[j + 1]:
+                    j += 1
+                j += 1
+                i += 1
+            if i == i_end:
+                break
+            start = i
+            i += 1
+            while changed[i + 1]:
+                i += 1
+            while other_changed[j + 1]:
+                j += 1
+            while True:
+                runlength = i - start
+                while start and file_equivs[start - 1] == file_equivs[i - 1]:
+                    start -= 1
+                    changed[start + 1] = 1
+                    i -= 1
+                    changed[i + 1] = 0
+                    while changed[start]:
+                        start -= 1
+                    j -= 1
+                    while other_changed[j + 1]:
+                        j -= 1
+                corresponding = i if other_changed[j] else i_end
+                while i != i_end and file_equivs[start] == file_equivs[i]:
+                    changed[start + 1] = 0
+                    start += 1
+                    changed[i + 1] = 1
+                    i += 1
+                    while changed[i + 1]:
+                        i += 1
+                    j += 1
+                    while other_changed[j + 1]:
+                        corresponding = i
+                        j += 1
+                if runlength == i - start:
+                    break
+            while corresponding < i:
+                start -= 1
+                changed[start + 1] = 1
+                i -= 1
+                changed[i + 1] = 0
+                j -= 1
+                while other_changed[j + 1]:
+                    j -= 1
+
+def _build_script(changed0, changed1, len0, len1):
+    '''Return the changes as (line0, line1, deleted, inserted) tuples'''
+    script = []
+    i0 = i1 = 0
+    while i0 < len0 or i1 < len1:
+        if changed0[i0 + 1] or changed1[i1 + 1]:
+            start0 = i0
+            start1 = i1
+            while changed0[i0 + 1]:
+                i0 += 1
+            while changed1[i1 + 1]:
+                i1 += 1
+            script.append((start0, start1, i0 - start0, i1 - start1))
+        else:
+            i0 += 1
+            i1 += 1
+    return script
+
+def _get_changes(text0, text1, lines0, lines1, context):
+    '''Return the changes that GNU diff would find between the texts'''
+    prefix_end, suffix_begin0, suffix_begin1 = _find_identical_ends(text0, text1, context)
+    prefix_lines = text0.count('\n', 0, prefix_end)
+    end0 = len(lines0) if suffix_begin0 >= len(text0) else text0.count('\n', 0, suffix_begin0)
+    end1 = len(lines1) if suffix_begin1 >= len(text1) else text1.count('\n', 0, suffix_begin1)
+    classes = {}
+    equivs = []
+    for lines, end in [(lines0, end0), (lines1, end1)]:
+        file_equivs = []
+        for index in xrange(prefix_lines, end):
+            file_equivs.append(classes.setdefault(lines[index], len(classes) + 1))
+        equivs.append(file_equivs)
+    discarded = _discard_confusing_lines(equivs, len(classes) + 1)
+    changes = []
+    undiscarded = []
+    for file_equivs, discards in zip(equivs, discarded):
+        changed = [0] * (len(file_equivs) + 2)
+        kept = []
+        indexes = []
+        for index, equiv in enumerate(file_equivs):
+            if discards[index]:
+                changed[index + 1] = 1
+            else:
+                kept.append(equiv)
+                indexes.append(index)
+        changes.append(changed)
+        undiscarded.append((kept, indexes))
+    (xvec, xindexes), (yvec, yindexes) = undiscarded
+    comparer = _Comparer(xvec, yvec, xindexes, yindexes, changes[0], changes[1])
+    comparer.compare(0, len(xvec), 0, len(yvec))
+    _shift_boundaries(changes, equivs)
+    script = _build_script(changes[0], changes[1], len(equivs[0]), len(equivs[1]))
+    return [(line0 + prefix_lines, line1 + prefix_lines, deleted, inserted) for line0, line1, deleted, inserted in script]
+
+def _get_hunks(script, context):
+    '''Group the changes that are close enough to share context'''
+    hunks = []
+    for change in script:
+        if hunks:
+            last = hunks[-1][-1]
+            if change[0] - (last[0] + last[2]) < 2 * context + 1:
+                hunks[-1].append(change)
+                continue
+        hunks.append([change])
+    return hunks
+
+def _line_text(tag, line):
+    if line.endswith('\n'):
+        return tag + line
+    return tag + line + '\n\\ No newline at end of file\n'
+
+def _unified_range(first, last):
+    if last < first:
+        return '%d,0' % (last + 1)
+    elif last == first:
+        return '%d' % (first + 1)
+    return '%d,%d' % (first + 1, last - first + 1)
+
+def _context_range(first, last):
+    if last <= first:
+        return '%d' % (last + 1)
+    return '%d,%d' % (first + 1, last + 1)
+
+def _hunk_extent(hunk, context, len0, len1):
+    first0 = max(hunk[0][0] - context, 0)
+    first1 = max(hunk[0][1] - context, 0)
+    last0 = hunk[-1][0] + hunk[-1][2] - 1
+    last1 = hunk[-1][1] + hunk[-1][3] - 1
+    last0 = last0 + context if last0 < len0 - context else len0 - 1
+    last1 = last1 + context if last1 < len1 - context else len1 - 1
+    return (first0, last0, first1, last1)
+
+def _unified_hunk(out, hunk, lines0, lines1, context):
+    first0, last0, first1, last1 = _hunk_extent(hunk, context, len(lines0), len(lines1))
+    out.append('@@ -%s +%s @@\n' % (_unified_range(first0, last0), _unified_range(first1, last1)))
+    i = first0
+    j = first1
+    changes = iter(hunk)
+    change = next(changes, None)
+    while i <= last0 or j <= last1:
+        if change is None or i < change[0]:
+            out.append(_line_text(' ', lines0[i]))
+            i += 1
+            j += 1
+        else:
+            for line in lines0[i:i + change[2]]:
+                out.append(_line_text('-', line))
+            for line in lines1[j:j + change[3]]:
+                out.append(_line_text('+', line))
+            i += change[2]
+            j += change[3]
+            change = next(changes, None)
+
+def _context_section(out, hunk, lines, first, last, index, replace_index):
+    changes = iter(hunk)
+    change = next(changes, None)
+    for i in xrange(first, last + 1):
+        while change is not None and change[index] + change[index + 2] <= i:
+            change = next(changes, None)
+        tag = '  '
+        if change is not None and change[index] <= i:
+            if change[replace_index + 2] > 0:
+                tag = '! '
+            else:
+                tag = '- ' if index == 0 else '+ '
+        out.append(_line_text(tag, lines[i]))
+
+def _context_hunk(out, hunk, lines0, lines1, context):
+    first0, last0, first1, last1 = _hunk_extent(hunk, context, len(lines0), len(lines1))
+    out.append('***************\n*** %s ****\n' % _context_range(first0, last0))
+    if any(change[2] for change in hunk):
+        _context_section(out, hunk, lines0, first0, last0, 0, 1)
+    out.append('--- %s ----\n' % _context_range(first1, last1))
+    if any(change[3] for change in hunk):
+        _context_section(out, hunk, lines1, first1, last1, 1, 0)
+
+def diff_texts(text0, text1, label0, label1, style=UNIFIED, context=DEFAULT_CONTEXT):
+    '''Return the result that "diff -u" ("diff -c" if style is CONTEXT)
+    with the given labels and context would have for files holding the
+    two texts'''
+    if text0 == text1:
+        return cmd_result.Result(cmd_result.OK, '', '')
+    if '\0' in text0 or '\0' in text1:
+        raise Unsupported('binary')
+    lines0 = _split_lines(text0)
+    lines1 = _split_lines(text1)
+    script = _get_changes(text0, text1, lines0, lines1, context)
+    if style == UNIFIED:
+        out = ['--- %s\n+++ %s\n' % (label0, label1)]
+        make_hunk = _unified_hunk
+    else:
+        out = ['*** %s\n--- %s\n' % (label0, label1)]
+        make_hunk = _context_hunk
+    for hunk in _get_hunks(script, context):
+        make_hunk(out, hunk, lines0, lines1, context)
+    return cmd_result.Result(cmd_result.WARNING, ''.join(out), '')
+
+def _read_file(path):
+    try:
+        return open(path, 'rb').read()
+    except IOError:
+        raise Unsupported(path)
+
+def diff_files(path0, path1, label0, label1, diff_opts):
+    '''Return the result that "diff <diff_opts> --label <label0> --label
+    <label1> <path0> <path1>" would have or None if GNU diff needs to be
+    run to get it'''
+    try:
+        style, context = _parse_options(diff_opts)
+        for path in [path0, path1]:
+            if not os.path.isfile(path) and path != '/dev/null':
+                return None
+        if same_contents(path0, path1):
+            return cmd_result.Result(cmd_result.OK, '', '')
+        return diff_texts(_read_file(path0), _read_file(path1), label0, label1, style, context)
+    except Unsupported:
+        return None
+
+def same_contents(path1, path2):
+    '''Return True if the two files have the same contents'''
+    try:
+        stat1 = os.stat(path1)
+        stat2 = os.stat(path2)
+    except OSError:
+        return False
+    if (stat1.st_dev, stat1.st_ino) == (stat2.st_dev, stat2.st_ino):
+        return True
+    if stat1.st_size != stat2.st_size:
+        return False
+    try:
+        with open(path1, 'rb') as fobj1:
+            with open(path2, 'rb') as fobj2:
+                while True:
+                    block = fobj1.read(_BLOCK_SIZE)
+                    if block != fobj2.read(_BLOCK_SIZE):
+                        return False
+                    if not block:
+                        return True
+    except IOError:
+        return False
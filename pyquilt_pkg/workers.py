@@ -0,0 +1,138 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Run a function over a sequence of items in parallel while handing back
+the results in the order of the items.
+'''
+
+import sys
+import collections
+import threading
+import Queue
+import multiprocessing
+from multiprocessing import pool
+
+from pyquilt_pkg import customization
+
+# AsyncResult.get() without a time out cannot be interrupted (by ^C)
+_FOREVER = 60 * 60 * 24 * 365
+
+def get_jobs(opt_jobs=None, default=1):
+    '''Return the number of jobs to run at once: opt_jobs if given
+    else QUILT_JOBS from the quiltrc (default if neither is set).  0
+    means one per processor.'''
+    jobs = opt_jobs
+    if jobs is None:
+        try:
+            jobs = int(customization.get_config('QUILT_JOBS', str(default)))
+        except ValueError:
+            jobs = default
+    if jobs == 0:
+        try:
+            jobs = multiprocessing.cpu_count()
+        except NotImplementedError:
+            jobs = 1
+    return max(1, jobs)
+
+class _ThreadTask(object):
+    '''The work of applying func to an item in a worker thread (with the
+    same get() as multiprocessing's AsyncResult)'''
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+    def run(self):
+        try:
+            self.result = self.func(self.item)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+    def get(self, timeout):
+        self.done.wait(timeout)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+def _run_thread_tasks(tasks):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task.run()
+
+class _ThreadPool(object):
+    '''A minimal pool of worker threads.  multiprocessing's ThreadPool
+    takes a tenth of a second to shut down (however little it did) which
+    is more than the work that commands such as push give it.'''
+    def __init__(self, jobs):
+        self._tasks = Queue.Queue()
+        self._threads = [threading.Thread(target=_run_thread_tasks, args=(self._tasks,)) for _dummy in range(jobs)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+    def apply_async(self, func, args):
+        task = _ThreadTask(func, args[0])
+        self._tasks.put(task)
+        return task
+    def close(self):
+        for _dummy in self._threads:
+            self._tasks.put(None)
+    def terminate(self):
+        # drop the work that has not been started
+        try:
+            while True:
+                self._tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        self.close()
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+def ordered_map(func, items, jobs, window=None, processes=True):
+    '''Generate func(item) for each of the items (in their order) using
+    up to jobs worker processes (threads if processes is False).  No
+    more than window results (default two per job) are held or being
+    worked on at once and no more work is started once the caller stops
+    asking for results.  func and the items must be picklable if
+    processes are used and exceptions raised by func are passed on.'''
+    items = list(items)
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if window is None:
+        window = 2 * jobs
+    worker_pool = pool.Pool(jobs) if processes else _ThreadPool(jobs)
+    pending = collections.deque()
+    completed = False
+    try:
+        for item in items:
+            pending.append(worker_pool.apply_async(func, (item,)))
+            if len(pending) >= window:
+                yield pending.popleft().get(_FOREVER)
+        while pending:
+            yield pending.popleft().get(_FOREVER)
+        completed = True
+    finally:
+        if completed:
+            worker_pool.close()
+        else:
+            worker_pool.terminate()
+        worker_pool.join()
@@ -0,0 +1,263 @@
+#!/bin/env python
+### Copyright (C) 2011 Peter Williams <peter@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Measure the time taken by (the pyquilt script in this directory for)
+the common operations on patch stacks in synthetic trees: one with
+many patches, one with many files per patch, one where every patch
+changes the same files and one with a single huge patch.  The results
+can be saved (as JSON) and compared with those of an earlier run to
+find regressions.
+'''
+
+import argparse
+import subprocess
+import tempfile
+import difflib
+import random
+import shutil
+import json
+import time
+import sys
+import os
+
+PARSER = argparse.ArgumentParser(description='Measure the time taken by operations on patch stacks.')
+
+PARSER.add_argument(
+    '-n',
+    help='number of times to time each operation (default 3)',
+    dest='opt_repeat',
+    metavar='count',
+    type=int,
+    default=3,
+)
+
+PARSER.add_argument(
+    '-s',
+    help='scale the size of the trees and series by this factor (default 1.0)',
+    dest='opt_scale',
+    metavar='factor',
+    type=float,
+    default=1.0,
+)
+
+PARSER.add_argument(
+    '-o',
+    help='write the results (as JSON) to this file',
+    dest='opt_output',
+    metavar='file',
+)
+
+PARSER.add_argument(
+    '-i',
+    help='read the results from this file (written by -o) instead of running the benchmarks',
+    dest='opt_input',
+    metavar='file',
+)
+
+PARSER.add_argument(
+    '-c',
+    help='compare the results with those in this (baseline) file and report regressions',
+    dest='opt_compare',
+    metavar='file',
+)
+
+PARSER.add_argument(
+    '-t',
+    help='percentage by which an operation must be slower than the baseline to be a regression (default 10)',
+    dest='opt_threshold',
+    metavar='percent',
+    type=float,
+    default=10.0,
+)
+
+PARSER.add_argument(
+    'arg_scenarios',
+    help='the scenarios to run (default all)',
+    metavar='scenario',
+    nargs='*',
+)
+
+FORMAT_VERSION = 1
+
+# Differences smaller than this (in seconds) are put down to noise
+_MIN_DELTA = 0.005
+
+# name: (number of files, lines per file, number of patches, files per
+# patch, changes per file, number of files the patches choose from)
+SCENARIOS = [
+    ('many-patches', (200, 200, 300, 2, 3, 200)),
+    ('many-files', (1000, 100, 10, 200, 2, 1000)),
+    ('overlap', (20, 400, 100, 4, 3, 4)),
+    ('huge-patch', (20, 5000, 1, 20, 2000, 20)),
+]
+
+def _operations(target):
+    '''The operations to time (in the order they are run) as (name,
+    arguments) pairs.  target is a file in the topmost patch.'''
+    return [
+        ('push -a', ['push', '-a']),
+        ('series -v', ['series', '-v']),
+        ('files -a', ['files', '-a']),
+        ('patches', ['patches', target]),
+        ('annotate', ['annotate', target]),
+        ('diff', ['diff']),
+        ('snapshot', ['snapshot']),
+        ('refresh', ['refresh']),
+        ('pop -a', ['pop', '-a']),
+    ]
+
+def _scaled(count, scale, minimum=1):
+    return max(int(count * scale), minimum)
+
+def make_tree(work_dir, params, scale, seed=0):
+    '''Make the files and the patch series for the scenario in work_dir
+    and return the name of a file in the topmost patch'''
+    num_files, num_lines, num_patches, files_per_patch, changes_per_file, pool_size = params
+    num_files = _scaled(num_files, scale)
+    num_patches = _scaled(num_patches, scale)
+    pool_size = min(_scaled(pool_size, scale), num_files)
+    files_per_patch = min(files_per_patch, pool_size)
+    changes_per_file = min(_scaled(changes_per_file, scale), num_lines)
+    rng = random.Random(seed)
+    contents = {}
+    for index in range(num_files):
+        path = os.path.join('src', 'd%02d' % (index % 16), 'f%05d.c' % index)
+        contents[path] = ['%s line %d\n' % (path, line) for line in range(num_lines)]
+        write_lines(os.path.join(work_dir, path), contents[path])
+    pool = sorted(contents)[:pool_size]
+    os.mkdir(os.path.join(work_dir, 'patches'))
+    series = []
+    for index in range(num_patches):
+        name = 'p%05d.patch' % index
+        text = 'Patch number %d of the series.\n\n' % index
+        chosen = sorted(rng.sample(pool, files_per_patch))
+        for path in chosen:
+            old_lines = contents[path]
+            new_lines = list(old_lines)
+            for line in rng.sample(range(len(new_lines)), changes_per_file):
+                new_lines[line] = '%s changed by %s\n' % (path, name)
+            text += ''.join(difflib.unified_diff(old_lines, new_lines, 'a/' + path, 'b/' + path))
+            contents[path] = new_lines
+        write_lines(os.path.join(work_dir, 'patches', name), [text])
+        series.append(name + '\n')
+    write_lines(os.path.join(work_dir, 'patches', 'series'), series)
+    return chosen[0]
+
+def write_lines(path, lines):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fobj:
+        fobj.writelines(lines)
+
+def run_scenario(name, params, scale, repeat):
+    '''Return a map of the scenario's operation names to the times taken
+    (the patches are restored to their generated state before each round)'''
+    pyquilt = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyquilt')
+    work_dir = tempfile.mkdtemp(prefix='stack_bench.')
+    try:
+        sys.stderr.write('%s: making tree\n' % name)
+        target = make_tree(work_dir, params, scale)
+        pristine = os.path.join(work_dir, '.pristine_patches')
+        shutil.copytree(os.path.join(work_dir, 'patches'), pristine)
+        quiltrc = os.path.join(work_dir, '.quiltrc')
+        open(quiltrc, 'w').close()
+        env = dict(os.environ)
+        env['QUILT_PAGER'] = 'cat'
+        devnull = open(os.devnull, 'w')
+        times = {}
+        for _ in range(max(repeat, 1)):
+            shutil.rmtree(os.path.join(work_dir, 'patches'))
+            shutil.copytree(pristine, os.path.join(work_dir, 'patches'))
+            for op_name, op_args in _operations(target):
+                argv = [sys.executable, pyquilt, '--quiltrc', quiltrc] + op_args
+                start = time.time()
+                status = subprocess.call(argv, cwd=work_dir, env=env, stdout=devnull, stderr=devnull)
+                seconds = time.time() - start
+                if status != 0:
+                    raise RuntimeError('%s: "%s" failed (%d)' % (name, ' '.join(op_args), status))
+                times.setdefault(op_name, []).append(seconds)
+        return times
+    finally:
+        shutil.rmtree(work_dir)
+
+def summarise(samples):
+    samples = sorted(samples)
+    return {'min' : samples[0], 'median' : samples[len(samples) // 2], 'samples' : samples}
+
+def print_results(results):
+    print '%-28s %10s %10s' % ('operation', 'min (ms)', 'med (ms)')
+    for key in sorted(results):
+        print '%-28s %10.1f %10.1f' % (key, results[key]['min'] * 1000, results[key]['median'] * 1000)
+
+def compare_results(baseline, results, threshold):
+    '''Print the changes from the baseline and return the number of regressions'''
+    regressions = 0
+    print '%-28s %10s %10s %8s' % ('operation', 'base (ms)', 'now (ms)', 'change')
+    for key in sorted(set(baseline) | set(results)):
+        if key not in baseline or key not in results:
+            print '%-28s %s' % (key, 'only in baseline' if key in baseline else 'not in baseline')
+            continue
+        base = baseline[key]['median']
+        now = results[key]['median']
+        change = 100.0 * (now - base) / max(base, 1e-6)
+        regressed = change > threshold and now - base > _MIN_DELTA
+        if regressed:
+            regressions += 1
+        print '%-28s %10.1f %10.1f %+7.1f%%%s' % (key, base * 1000, now * 1000, change, '  REGRESSION' if regressed else '')
+    return regressions
+
+def load_results(path):
+    data = json.load(open(path))
+    if data.get('version', None) != FORMAT_VERSION:
+        sys.stderr.write('%s: unknown results format\n' % path)
+        sys.exit(2)
+    return data
+
+args = PARSER.parse_args()
+
+if args.opt_input:
+    data = load_results(args.opt_input)
+else:
+    known = [item[0] for item in SCENARIOS]
+    unknown = [name for name in args.arg_scenarios if name not in known]
+    if unknown:
+        sys.stderr.write('{0}: unknown scenario(s) (choose from {1})\n'.format(', '.join(unknown), ', '.join(known)))
+        sys.exit(2)
+    results = {}
+    for name, params in SCENARIOS:
+        if args.arg_scenarios and name not in args.arg_scenarios:
+            continue
+        for op_name, samples in run_scenario(name, params, args.opt_scale, args.opt_repeat).items():
+            results['%s/%s' % (name, op_name)] = summarise(samples)
+    data = {
+        'version' : FORMAT_VERSION,
+        'python' : sys.version.split()[0],
+        'scale' : args.opt_scale,
+        'repeat' : args.opt_repeat,
+        'results' : results,
+    }
+    if args.opt_output:
+        with open(args.opt_output, 'w') as fobj:
+            json.dump(data, fobj, indent=1, sort_keys=True)
+
+if args.opt_compare:
+    baseline = load_results(args.opt_compare)
+    if baseline['scale'] != data['scale']:
+        sys.stderr.write('Warning: baseline scale %s differs from %s\n' % (baseline['scale'], data['scale']))
+    sys.exit(1 if compare_results(baseline['results'], data['results'], args.opt_threshold) else 0)
+
+print_results(data['results'])
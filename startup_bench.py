@@ -0,0 +1,97 @@
+#!/bin/env python
+### Copyright (C) 2011 Peter Williams <peter@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Measure the cold start cost of each sub command: the time taken (in a
+fresh interpreter) by the pyquilt script in this directory to get as far
+as running the sub command (which includes importing the server client,
+the command line machinery and the module implementing the sub command).
+The sub command is asked for its help so that nothing is run.
+'''
+
+import argparse
+import subprocess
+import sys
+import os
+
+from pyquilt_pkg import cmd_line
+
+PARSER = argparse.ArgumentParser(description='Measure sub command start up times.')
+
+PARSER.add_argument(
+    '-n',
+    help='number of fresh interpreters to time for each sub command (default 5)',
+    dest='opt_repeat',
+    metavar='count',
+    type=int,
+    default=5,
+)
+
+PARSER.add_argument(
+    '--eager',
+    help='also load every sub command module (as was done before they were loaded lazily)',
+    dest='opt_eager',
+    action='store_true',
+)
+
+PARSER.add_argument(
+    'arg_sub_cmds',
+    help='the sub commands to time (default all)',
+    metavar='sub_cmd',
+    nargs='*',
+)
+
+_CHILD_SCRIPT = '''
+import sys
+import os
+import time
+start = time.time()
+script, name = sys.argv[1:3]
+if name == '--eager':
+    # the main parser's help needs every sub command's module
+    sys.argv = [script, '--help']
+else:
+    sys.argv = [script, name, '--help']
+saved_stdout = sys.stdout
+sys.stdout = open(os.devnull, 'w')
+try:
+    execfile(script, {'__name__' : '__main__'})
+except SystemExit:
+    pass
+sys.stdout = saved_stdout
+sys.stdout.write('%f %d\\n' % (time.time() - start, len(sys.modules)))
+'''
+
+def time_sub_cmd(name, eager):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([base_dir] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    argv = [sys.executable, '-c', _CHILD_SCRIPT, os.path.join(base_dir, 'pyquilt')] + (['--eager'] if eager else [name])
+    stdout = subprocess.Popen(argv, stdout=subprocess.PIPE, env=env).communicate()[0]
+    seconds, num_modules = stdout.split()
+    return float(seconds), int(num_modules)
+
+args = PARSER.parse_args()
+
+sub_cmds = args.arg_sub_cmds if args.arg_sub_cmds else [item[0] for item in cmd_line.SUB_CMDS]
+if args.opt_eager:
+    sub_cmds.append('--eager')
+
+print '%-12s %10s %10s %8s' % ('command', 'min (ms)', 'med (ms)', 'modules')
+for sub_cmd in sub_cmds:
+    samples = [time_sub_cmd(sub_cmd, sub_cmd == '--eager') for _ in range(max(args.opt_repeat, 1))]
+    times = sorted(sample[0] * 1000 for sample in samples)
+    print '%-12s %10.1f %10.1f %8d' % ('(all)' if sub_cmd == '--eager' else sub_cmd, times[0], times[len(times) // 2], samples[-1][1])
@@ -15,6 +15,8 @@
 ### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import argparse
+import tempfile
+import shutil
 import sys
 import os
 
@@ -39,29 +41,55 @@ PARSER.add_argument(
 ARGS = PARSER.parse_args()
 
 if not ARGS.arg_patch_file:
-    text = sys.stdin.read()
+    fobj = sys.stdin
 elif os.path.isfile(ARGS.arg_patch_file):
-    text = open(ARGS.arg_patch_file).read()
+    fobj = open(ARGS.arg_patch_file)
 
+# The patch is read (and the fixed version written) a file's diff at a
+# time so that big patches needn't fit in memory
+reader = patchlib.PatchReader(fobj)
+reports = []
+if ARGS.opt_dry_run:
+    out_fobj = None
+else:
+    out_dir = os.path.dirname(os.path.abspath(ARGS.arg_patch_file)) if ARGS.arg_patch_file else None
+    out_fobj = tempfile.NamedTemporaryFile(dir=out_dir, delete=False)
+header_written = False
 try:
-    patch = patchlib.Patch.parse_text(text)
+    for diff_plus in reader:
+        if out_fobj is None:
+            bad_lines = diff_plus.report_trailing_whitespace()
+        else:
+            if not header_written:
+                out_fobj.write(str(reader.header))
+                header_written = True
+            bad_lines = diff_plus.fix_trailing_whitespace()
+            out_fobj.write(str(diff_plus))
+        if bad_lines:
+            reports.append((diff_plus.get_file_path(strip_level=1), bad_lines))
+    if out_fobj is not None and not header_written:
+        out_fobj.write(str(reader.header))
 except patchlib.ParseError as pedata:
+    if out_fobj is not None:
+        out_fobj.close()
+        os.remove(out_fobj.name)
     print 'ERROR:', pedata.message, 'LINE NO:', pedata.lineno
     sys.exit(1)
 
 if ARGS.opt_dry_run:
-    reports = patch.report_trailing_whitespace(strip_level=1)
     for filename, bad_lines in reports:
         if len(bad_lines) > 1:
             sys.stderr.write('Warning: trailing whitespace in lines %s of %s\n' % (','.join(bad_lines), filename))
         else:
             sys.stderr.write('Warning: trailing whitespace in line %s of %s\n' % (bad_lines[0], filename))
 else:
-    reports = patch.fix_trailing_whitespace(strip_level=1)
+    out_fobj.close()
     if not ARGS.arg_patch_file:
-        sys.stdout.write(str(patch))
+        shutil.copyfileobj(open(out_fobj.name), sys.stdout)
+        os.remove(out_fobj.name)
     else:
-        open(ARGS.arg_patch_file, 'w').write(str(patch))
+        shutil.copymode(ARGS.arg_patch_file, out_fobj.name)
+        os.rename(out_fobj.name, ARGS.arg_patch_file)
     for filename, bad_lines in reports:
         if len(bad_lines) > 1:
             sys.stderr.write('Removing trailing whitespace from lines %s of %s\n' % (','.join(bad_lines), filename))